@@ -0,0 +1,273 @@
+"""流水线性能基准：启动本地模拟的 ComfyUI 与视觉模型服务，处理一个合成图片文件夹并输出 JSON 报告
+
+    python -m benchmark.run_benchmark --images 60 --mode batch --output bench.json
+    python -m benchmark.run_benchmark --mode sync --exec-delay 0.5 --comfyui-backends 2
+
+batch 模式与界面上的“开始批量处理”相同（scan_folder + process_images），sync 模式逐张调用
+process_image_job（即 sync_process_image）。报告包含吞吐量、各阶段及阶段内各步骤（上传、排队、执行、下载等）的 p50/p95/p99 耗时、
+传输字节数与峰值内存，可以保存下来在不同提交之间对比。
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 合成图片的尺寸：(宽, 高, 权重)，覆盖跳过、本地/ComfyUI 扩图、本地/ComfyUI 放大等各种路径
+IMAGE_SIZES = [
+    (1080, 1920, 2),  # 已符合目标
+    (720, 1280, 3),  # 9:16 分辨率不足，ComfyUI 放大
+    (1040, 1849, 2),  # 与 9:16 差取整误差且略小，本地放大
+    (1075, 1920, 2),  # 接近 9:16，本地扩图
+    (1200, 1600, 3),  # 3:4，ComfyUI 扩图
+    (1920, 1080, 2),  # 横图，ComfyUI 扩图
+    (800, 1000, 3),  # 扩图后还需放大
+    (300, 500, 1),  # 分辨率过低
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise Exception(f"模拟服务端口 {port} 在 {timeout} 秒内未就绪")
+
+
+def make_images(folder, count, seed):
+    """生成尺寸、比例、格式混合的合成图片（平滑噪声，压缩率接近真实照片）"""
+    from PIL import Image
+
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    sizes = [(w, h) for w, h, weight in IMAGE_SIZES for _ in range(weight)]
+    for index in range(count):
+        width, height = rng.choice(sizes)
+        channels = [Image.effect_noise((max(1, width // 16), max(1, height // 16)), 64 + 32 * c)
+                    .resize((width, height), Image.Resampling.BICUBIC) for c in range(3)]
+        img = Image.merge("RGB", channels)
+        if index % 3 == 0:
+            img.save(os.path.join(folder, f"{index:05d}.png"), compress_level=6)
+        else:
+            img.save(os.path.join(folder, f"{index:05d}.jpg"), quality=90)
+
+
+def percentiles(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def pick(q):
+        # 最近秩法
+        return round(ordered[min(len(ordered) - 1, max(0, int(q * len(ordered) + 0.5) - 1))], 4)
+
+    return {"count": len(ordered), "mean": round(sum(ordered) / len(ordered), 4),
+            "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1], 4)}
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def start_stubs(args):
+    processes, comfyui_ports = [], []
+    for _ in range(args.comfyui_backends):
+        port = free_port()
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "benchmark.stub_comfyui", "--port", str(port),
+             "--queue-delay", str(args.queue_delay), "--exec-delay", str(args.exec_delay),
+             "--workers", str(args.stub_workers)], cwd=ROOT_DIR, stdout=sys.stderr))
+        comfyui_ports.append(port)
+    vlm_port = free_port()
+    processes.append(subprocess.Popen(
+        [sys.executable, "-m", "benchmark.stub_vlm", "--port", str(vlm_port), "--delay", str(args.vlm_delay),
+         "--watermark-rate", str(args.watermark_rate)], cwd=ROOT_DIR, stdout=sys.stderr))
+    for port in comfyui_ports + [vlm_port]:
+        wait_for_port(port)
+    return processes, comfyui_ports, vlm_port
+
+
+async def stub_stats(comfyui_ports, vlm_port):
+    import aiohttp
+    import websockets
+
+    stats = {"comfyui": [], "vlm": None}
+    async with aiohttp.ClientSession() as session:
+        for port in comfyui_ports:
+            async with session.get(f"http://127.0.0.1:{port}/bench/stats") as resp:
+                stats["comfyui"].append(await resp.json())
+    async with websockets.connect(f"ws://127.0.0.1:{vlm_port}") as ws:
+        await ws.send(json.dumps({"tool": "bench_stats"}))
+        stats["vlm"] = json.loads(await ws.recv())
+    return stats
+
+
+async def run_jobs(args, folder):
+    # 环境变量已设置好，此时才导入（各模块在导入时读取配置）
+    from pipeline import process_images
+    from planner import scan_folder
+    from service import process_image_job, close_vlm_client
+    from comfyui_client.call_workflow import close_client, comfyui_scheduler
+
+    start = time.perf_counter()
+    # 与界面一致：已符合目标尺寸的图片同样要做水印检测
+    plan = scan_folder(folder, skip_compliant=False)
+    if args.mode == "batch":
+        jobs = await process_images(plan.entries)
+    else:
+        jobs = []
+        try:
+            for entry in plan.entries:
+                jobs.append(await process_image_job(entry.path))
+        finally:
+            await close_client()
+            await close_vlm_client()
+    wall = time.perf_counter() - start
+    transfers = [client.transfer_stats() for client in comfyui_scheduler.clients]
+    return plan, jobs, wall, transfers
+
+
+def report(args, plan, jobs, wall, transfers, stubs, rss_before):
+    stage_times = {}
+    for job in jobs:
+        for name, seconds in job.timings.items():
+            if seconds is not None:
+                stage_times.setdefault(name, []).append(seconds)
+    span_times = {}
+    for job in jobs:
+        for stage_name, name, seconds in job.spans:
+            span_times.setdefault(f"{stage_name}:{name}", []).append(seconds)
+    processed = [job for job in jobs if job.timings]
+    outcomes = {"ok": sum(1 for job in jobs if job.ok and not job.skip_reason),
+                "skipped": sum(1 for job in jobs if job.ok and job.skip_reason),
+                "failed": sum(1 for job in jobs if not job.ok)}
+    routes = {}
+    for job in jobs:
+        for name, (route, _) in job.routes.items():
+            routes[f"{name}:{route}"] = routes.get(f"{name}:{route}", 0) + 1
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "images": len(jobs),
+        "processed": len(processed),
+        "outcomes": outcomes,
+        "routes": routes,
+        "errors": sorted({job.error for job in jobs if job.error})[:20],
+        "wall_seconds": round(wall, 3),
+        "images_per_second": round(len(jobs) / wall, 3) if wall else None,
+        "processed_per_second": round(len(processed) / wall, 3) if wall else None,
+        "estimated_gpu_seconds": round(plan.estimated_seconds, 1),
+        "stage_latency": {name: percentiles(values) for name, values in stage_times.items()},
+        "span_latency": {name: percentiles(values) for name, values in sorted(span_times.items())},
+        "image_latency": percentiles([sum(t for t in job.timings.values() if t) for job in processed]),
+        "bytes": {
+            "comfyui_clients": transfers,
+            "comfyui_uploaded": sum(t["bytes_uploaded"] for t in transfers),
+            "comfyui_downloaded": sum(t["bytes_downloaded"] for t in transfers),
+            "comfyui_server": stubs["comfyui"],
+            "vlm_server": stubs["vlm"],
+            "per_image": round((sum(s["bytes_in"] + s["bytes_out"] for s in stubs["comfyui"])
+                                + stubs["vlm"]["bytes_in"] + stubs["vlm"]["bytes_out"]) / max(1, len(jobs))),
+        },
+        "peak_rss_bytes": peak_rss_bytes(),
+        "rss_before_run_bytes": rss_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="使用模拟服务对图片处理流水线做性能基准")
+    parser.add_argument("--images", type=int, default=60, help="合成图片数量")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mode", choices=["batch", "sync"], default="batch",
+                        help="batch：流水线批处理；sync：逐张 sync_process_image")
+    parser.add_argument("--folder", help="使用已有的图片文件夹，不生成合成图片")
+    parser.add_argument("--comfyui-backends", type=int, default=1, help="模拟的 ComfyUI 节点数")
+    parser.add_argument("--stub-workers", type=int, default=1, help="每个 ComfyUI 节点同时执行的任务数")
+    parser.add_argument("--queue-delay", type=float, default=0.0, help="ComfyUI 任务开始执行前的等待（秒）")
+    parser.add_argument("--exec-delay", type=float, default=0.2, help="ComfyUI 每个处理节点的执行耗时（秒）")
+    parser.add_argument("--vlm-delay", type=float, default=0.05, help="视觉模型单次推理耗时（秒）")
+    parser.add_argument("--watermark-rate", type=float, default=0.3, help="判定为有水印的比例")
+    parser.add_argument("--cache", action="store_true", help="启用 ComfyUI 结果缓存（默认关闭，以测量真实处理）")
+    parser.add_argument("--output", help="JSON 报告保存路径，默认只打印")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录（合成图片与输出）")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="ibp-bench-")
+    folder = args.folder or os.path.join(workdir, "images")
+    if not args.folder:
+        make_images(folder, args.images, args.seed)
+
+    processes, comfyui_ports, vlm_port = start_stubs(args)
+    try:
+        os.environ.update({
+            "COMFYUI_HOST": ",".join(f"http://127.0.0.1:{port}" for port in comfyui_ports),
+            "VLM_MODEL_WS_HOST": f"ws://127.0.0.1:{vlm_port}",
+            "COMFYUI_CACHE": "1" if args.cache else "0",
+            "COMFYUI_CACHE_DIR": os.path.join(workdir, "cache"),
+            "COMFYUI_WORKFLOWS_DIR": os.path.join(BENCHMARK_DIR, "workflows"),
+            "COMFYUI_MAPPINGS_DIR": os.path.join(BENCHMARK_DIR, "mappings"),
+            "COMFYUI_OUTPUT_DIR": os.path.join(workdir, "output"),
+        })
+        sys.path[:0] = [ROOT_DIR, os.path.join(ROOT_DIR, "webui")]
+        rss_before = peak_rss_bytes()
+        # 流水线的进度输出转到 stderr，stdout 只输出 JSON 报告，可以直接重定向到文件
+        with contextlib.redirect_stdout(sys.stderr):
+            plan, jobs, wall, transfers = asyncio.run(run_jobs(args, folder))
+            stubs = asyncio.run(stub_stats(comfyui_ports, vlm_port))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result = report(args, plan, jobs, wall, transfers, stubs, rss_before)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    if args.keep:
+        print(f"临时目录: {workdir}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
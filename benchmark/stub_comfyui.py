@@ -0,0 +1,227 @@
+"""本地模拟的 ComfyUI 服务，用于在没有 GPU 的机器上做性能基准
+
+实现 /api/upload/image、/prompt、/history/{id}、/view、/ws、/queue、/system_stats，
+按工作流中的节点真实地改变图片尺寸（扩图补边、模型放大 4 倍、按比例缩放），
+排队与执行耗时可配置。另外提供 /bench/stats 返回收发字节数等统计。
+
+    python -m benchmark.stub_comfyui --port 18188 --exec-delay 0.5
+"""
+import argparse
+import asyncio
+import io
+import json
+import time
+import uuid
+
+from aiohttp import web
+from PIL import Image, ImageOps
+
+# 不改变图片、也不计入执行耗时的节点
+PASSTHROUGH_NODES = ("LoadImage", "SaveImage", "PreviewImage", "UpscaleModelLoader")
+
+
+class StubComfyUI:
+    def __init__(self, queue_delay=0.0, exec_delay=0.5, workers=1):
+        self.queue_delay = queue_delay  # 每个任务开始执行前的固定等待（模拟调度开销）
+        self.exec_delay = exec_delay  # 每个处理节点的执行耗时（秒）
+        self.workers = workers  # 同时执行的任务数（模拟 GPU 数量）
+        self.inputs = {}  # 上传的图片：文件名 -> bytes
+        self.outputs = {}  # 生成的图片：文件名 -> bytes
+        self.output_counter = 0  # 与 ComfyUI 一致，每个服务各自给输出编号：ComfyUI_00001_.png
+        self.history = {}
+        self.clients = {}  # client_id -> WebSocketResponse
+        self.queue = asyncio.Queue()
+        self.running = {}
+        self.pending = {}
+        self.stats = {"bytes_in": 0, "bytes_out": 0, "uploads": 0, "prompts": 0, "views": 0}
+
+    def resolve_image(self, name):
+        """LoadImage 的文件名，支持 ``name [output]`` 标注引用输出目录"""
+        if name.endswith(" [output]"):
+            return self.outputs.get(name[:-len(" [output]")].split("/")[-1])
+        if name.endswith(" [input]"):
+            name = name[:-len(" [input]")]
+        return self.inputs.get(name)
+
+    async def upload(self, request):
+        data = await request.post()
+        field = data["image"]
+        body = field.file.read()
+        self.inputs[field.filename] = body
+        self.stats["bytes_in"] += len(body)
+        self.stats["uploads"] += 1
+        return web.json_response({"name": field.filename, "subfolder": "", "type": "input"})
+
+    async def prompt(self, request):
+        raw = await request.read()
+        self.stats["bytes_in"] += len(raw)
+        body = json.loads(raw)
+        workflow = body["prompt"]
+        for node_id, node in workflow.items():
+            if node.get("class_type") == "LoadImage" and self.resolve_image(node["inputs"]["image"]) is None:
+                return web.json_response({"error": {"message": "Prompt outputs failed validation"},
+                                          "node_errors": {node_id: {"errors": [{
+                                              "message": f"Invalid image file: {node['inputs']['image']}"}]}}},
+                                         status=400)
+        prompt_id = uuid.uuid4().hex
+        self.stats["prompts"] += 1
+        self.pending[prompt_id] = workflow
+        await self.queue.put((prompt_id, workflow, body.get("client_id")))
+        return web.json_response({"prompt_id": prompt_id, "number": self.stats["prompts"], "node_errors": {}})
+
+    async def send(self, client_id, message_type, data):
+        ws = self.clients.get(client_id)
+        if ws is not None and not ws.closed:
+            try:
+                await ws.send_str(json.dumps({"type": message_type, "data": data}))
+            except ConnectionError:
+                pass
+
+    def execute(self, workflow):
+        """按连线计算每个节点的输出图片，返回 {保存节点ID: 图片字节}"""
+        cache = {}
+
+        def evaluate(node_id):
+            if node_id in cache:
+                return cache[node_id]
+            node = workflow[node_id]
+            inputs = node.get("inputs", {})
+            links = {key: value for key, value in inputs.items() if isinstance(value, list) and len(value) == 2}
+            upstream = links.get("image") or links.get("images") or next(iter(links.values()), None)
+            img = evaluate(upstream[0]) if upstream else None
+            class_type = node.get("class_type")
+            if class_type == "LoadImage":
+                img = Image.open(io.BytesIO(self.resolve_image(inputs["image"]))).convert("RGB")
+            elif class_type == "ImagePadForOutpaint":
+                img = ImageOps.expand(img, (inputs.get("left", 0), inputs.get("top", 0),
+                                            inputs.get("right", 0), inputs.get("bottom", 0)), fill=(128, 128, 128))
+            elif class_type == "ImageUpscaleWithModel":
+                img = img.resize((img.width * 4, img.height * 4), Image.Resampling.BILINEAR)
+            elif class_type == "ImageScaleBy":
+                scale = float(inputs.get("scale_by", 1))
+                img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                                 Image.Resampling.BILINEAR)
+            cache[node_id] = img
+            return img
+
+        results = {}
+        for node_id, node in workflow.items():
+            if node.get("class_type") == "SaveImage":
+                buffer = io.BytesIO()
+                evaluate(node_id).save(buffer, format="PNG", compress_level=1)
+                results[node_id] = buffer.getvalue()
+        return results
+
+    async def worker(self):
+        while True:
+            prompt_id, workflow, client_id = await self.queue.get()
+            self.pending.pop(prompt_id, None)
+            self.running[prompt_id] = workflow
+            try:
+                await asyncio.sleep(self.queue_delay)
+                started = int(time.time() * 1000)
+                await self.send(client_id, "execution_start", {"prompt_id": prompt_id, "timestamp": started})
+                steps = sum(1 for node in workflow.values() if node.get("class_type") not in PASSTHROUGH_NODES)
+                await asyncio.sleep(self.exec_delay * max(1, steps))
+                try:
+                    saved = await asyncio.to_thread(self.execute, workflow)
+                except Exception as e:
+                    self.history[prompt_id] = {"prompt": [0, prompt_id, workflow], "outputs": {}, "status": {
+                        "status_str": "error", "completed": False,
+                        "messages": [["execution_start", {"timestamp": started}]]}}
+                    await self.send(client_id, "execution_error", {
+                        "prompt_id": prompt_id, "node_id": None, "node_type": None, "exception_message": str(e)})
+                    continue
+                outputs = {}
+                for node_id, data in saved.items():
+                    self.output_counter += 1
+                    filename = f"ComfyUI_{self.output_counter:05d}_.png"
+                    self.outputs[filename] = data
+                    outputs[node_id] = {"images": [{"filename": filename, "subfolder": "", "type": "output"}]}
+                    await self.send(client_id, "executed", {"prompt_id": prompt_id, "node": node_id,
+                                                            "output": outputs[node_id]})
+                finished = int(time.time() * 1000)
+                # 与 ComfyUI 一致：先写历史，再推送 node 为空的 executing 表示结束
+                self.history[prompt_id] = {"prompt": [0, prompt_id, workflow], "outputs": outputs, "status": {
+                    "status_str": "success", "completed": True,
+                    "messages": [["execution_start", {"prompt_id": prompt_id, "timestamp": started}],
+                                 ["execution_success", {"prompt_id": prompt_id, "timestamp": finished}]]}}
+                await self.send(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+            finally:
+                self.running.pop(prompt_id, None)
+                self.queue.task_done()
+
+    async def ws(self, request):
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        client_id = request.query.get("clientId") or uuid.uuid4().hex
+        self.clients[client_id] = ws
+        await ws.send_str(json.dumps({"type": "status", "data": {"sid": client_id}}))
+        async for _ in ws:
+            pass
+        if self.clients.get(client_id) is ws:
+            del self.clients[client_id]
+        return ws
+
+    async def get_history(self, request):
+        prompt_id = request.match_info["prompt_id"]
+        entry = self.history.get(prompt_id)
+        return web.json_response({prompt_id: entry} if entry else {})
+
+    async def view(self, request):
+        filename = request.query.get("filename", "")
+        store = self.inputs if request.query.get("type") == "input" else self.outputs
+        data = store.get(filename)
+        if data is None:
+            raise web.HTTPNotFound()
+        self.stats["bytes_out"] += len(data)
+        self.stats["views"] += 1
+        return web.Response(body=data, content_type="image/png")
+
+    async def get_queue(self, request):
+        return web.json_response({
+            "queue_running": [[0, pid, {}, {}, []] for pid in self.running],
+            "queue_pending": [[0, pid, {}, {}, []] for pid in self.pending],
+        })
+
+    async def system_stats(self, request):
+        return web.json_response({"system": {"os": "stub"}, "devices": []})
+
+    async def bench_stats(self, request):
+        return web.json_response(self.stats)
+
+    def make_app(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.add_routes([
+            web.post("/api/upload/image", self.upload),
+            web.post("/upload/image", self.upload),
+            web.post("/prompt", self.prompt),
+            web.get("/history/{prompt_id}", self.get_history),
+            web.get("/view", self.view),
+            web.get("/ws", self.ws),
+            web.get("/queue", self.get_queue),
+            web.get("/system_stats", self.system_stats),
+            web.get("/bench/stats", self.bench_stats),
+        ])
+
+        async def start_workers(app):
+            app["workers"] = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+        app.on_startup.append(start_workers)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟 ComfyUI 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18188)
+    parser.add_argument("--queue-delay", type=float, default=0.0, help="每个任务开始执行前的等待（秒）")
+    parser.add_argument("--exec-delay", type=float, default=0.5, help="每个处理节点的执行耗时（秒）")
+    parser.add_argument("--workers", type=int, default=1, help="同时执行的任务数")
+    args = parser.parse_args()
+    stub = StubComfyUI(args.queue_delay, args.exec_delay, args.workers)
+    web.run_app(stub.make_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""本地模拟的 Janus 水印识别 websocket 服务，协议与 deepseek_janus_pro_7b/ws_server.py 一致
+
+支持旧协议（JSON 中的 image_base64）和 v2（消息头 + 二进制帧），响应带回请求 id。
+是否有水印由图片内容哈希决定（同一张图片结果固定），比例由 --watermark-rate 控制。
+发送 {"tool": "bench_stats"} 返回收发字节数等统计。
+
+    python -m benchmark.stub_vlm --port 19200 --delay 0.05
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+
+import websockets
+
+
+class StubVLM:
+    def __init__(self, delay=0.05, watermark_rate=0.3, concurrency=8):
+        self.delay = delay  # 单次推理耗时（秒）
+        self.watermark_rate = watermark_rate
+        self.slots = asyncio.Semaphore(concurrency)  # 模拟批大小：同时推理的请求数
+        self.stats = {"bytes_in": 0, "bytes_out": 0, "requests": 0}
+
+    async def understand(self, image_bytes):
+        async with self.slots:
+            await asyncio.sleep(self.delay)
+        digest = hashlib.sha256(image_bytes).digest()
+        probability = int.from_bytes(digest[:4], "big") / 2 ** 32
+        has_water_mark = probability < self.watermark_rate
+        return {"water_mark": "Y" if has_water_mark else "N", "probability": round(1 - probability, 4)}
+
+    async def handle_request(self, websocket, request, image_bytes=None):
+        if request.get("tool") == "bench_stats":
+            result = dict(self.stats)
+        elif request.get("tool") == "health":
+            result = {"status": "ready", "ready": True}
+        elif request.get("tool") == "image_understanding":
+            if image_bytes is None:
+                image_bytes = base64.b64decode(request.get("image_base64", ""))
+            self.stats["requests"] += 1
+            result = await self.understand(image_bytes)
+        else:
+            result = {"error": "未知工具"}
+        if request.get("id") is not None:
+            result["id"] = request["id"]
+        message = json.dumps(result)
+        self.stats["bytes_out"] += len(message)
+        try:
+            await websocket.send(message)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def handle_websocket(self, websocket):
+        tasks = set()
+        header = None
+
+        def dispatch(request, image_bytes=None):
+            task = asyncio.create_task(self.handle_request(websocket, request, image_bytes))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        try:
+            async for message in websocket:
+                self.stats["bytes_in"] += len(message)
+                if isinstance(message, bytes):
+                    if header is not None:
+                        dispatch(header, message)
+                        header = None
+                    continue
+                request = json.loads(message)
+                if request.get("binary"):
+                    header = request
+                else:
+                    dispatch(request)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def serve(self, host, port):
+        async with websockets.serve(self.handle_websocket, host, port, max_size=64 * 1024 * 1024):
+            await asyncio.Future()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟 Janus 水印识别服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=19200)
+    parser.add_argument("--delay", type=float, default=0.05, help="单次推理耗时（秒）")
+    parser.add_argument("--watermark-rate", type=float, default=0.3, help="判定为有水印的比例")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时推理的请求数")
+    args = parser.parse_args()
+    stub = StubVLM(args.delay, args.watermark_rate, args.concurrency)
+    asyncio.run(stub.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
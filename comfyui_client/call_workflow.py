@@ -1,200 +1,285 @@
-import base64
+import asyncio
+import copy
+import hashlib
 import json
 import os
 import time
 
-import requests
 from dotenv import load_dotenv
 from loguru import logger
-from .comfyui_client import ComfyUIClient
+from . import tracing
+from .comfyui_client import ServerImage
+from .result_cache import ResultCache, content_sha256, copy_atomic
+from .scheduler import ComfyUIScheduler, parse_hosts
+from .workflow_composer import compose_workflows
 
 load_dotenv()
 # 配置日志
 
-# 全局ComfyUI客户端（当前上下文不可用时的备选方案）
+# COMFYUI_HOST 可以是逗号分隔的多个节点，任务按队列深度分配到各节点
 comfyui_host = os.getenv("COMFYUI_HOST", "http://localhost:8188")
-comfyui_client = ComfyUIClient(comfyui_host)
+comfyui_scheduler = ComfyUIScheduler(parse_hosts(comfyui_host))
+# 全局ComfyUI客户端（第一个节点，用于加载参数映射表等本地操作）
+comfyui_client = comfyui_scheduler.clients[0]
 
 # 获取当前脚本的目录
 current_dir = os.path.dirname(os.path.abspath(__file__))
-# 创建tmp目录路径
-tmp_dir = os.path.join(current_dir, "tmp")
-# 如果tmp目录不存在，则创建
-os.makedirs(tmp_dir, exist_ok=True)
-
-
-async def extend_image(image_base64, left, right, top, bottom):
-    """使用ComfyUI进行扩图"""
+# 工作流 JSON 目录与结果下载根目录，可通过环境变量改到其他位置（例如基准测试）
+workflows_dir = os.getenv("COMFYUI_WORKFLOWS_DIR", os.path.join(current_dir, "workflows"))
+output_root = os.getenv("COMFYUI_OUTPUT_DIR", current_dir)
+
+# 阶段结果缓存，COMFYUI_CACHE=0 关闭
+result_cache = ResultCache() if os.getenv("COMFYUI_CACHE", "1") != "0" else None
+_workflow_hashes = {}  # workflow_id -> ((mtime_ns, size), ...), hash)
+
+
+async def close_client():
+    """关闭所有节点客户端的连接池、/ws 订阅和健康检查（一批任务结束时调用）"""
+    await comfyui_scheduler.close()
+    if result_cache is not None:
+        await asyncio.to_thread(result_cache.flush)
+        logger.info(f"结果缓存统计: {result_cache.stats()}")
+    for client in comfyui_scheduler.clients:
+        logger.info(f"ComfyUI 传输统计: {client.transfer_stats()}")
+
+
+def workflow_hash(workflow_id):
+    """工作流 JSON 与参数映射表的内容哈希；文件变化时清除该工作流的旧缓存"""
+    paths = [os.path.join(workflows_dir, f"{workflow_id}.json"),
+             os.path.join(comfyui_client.mappings_dir, f"{workflow_id}.json")]
+    signature = tuple((st.st_mtime_ns, st.st_size) for st in map(os.stat, paths))
+    cached = _workflow_hashes.get(workflow_id)
+    if cached and cached[0] == signature:
+        return cached[1]
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    current = digest.hexdigest()
+    _workflow_hashes[workflow_id] = (signature, current)
+    if result_cache is not None:
+        result_cache.invalidate_workflow(workflow_id, current)
+    return current
+
+
+def load_workflow(workflow_id):
+    """读取 workflows/ 下的工作流 JSON"""
+    workflow_file = os.path.join(workflows_dir, f"{workflow_id}.json")  # 构造工作流文件路径
+    with open(workflow_file, "r", encoding="utf-8", errors="ignore") as f:
+        return json.load(f)
+
+
+def apply_params(workflow_id, workflow, mapping, params):
+    """将参数应用到工作流中的相应节点"""
+    for param_key, value in params.items():
+        if param_key in mapping:
+            node_id, input_key = mapping[param_key]  # 解析节点ID和输入键
+            if node_id not in workflow:
+                raise Exception(f"工作流 {workflow_id} 中未找到节点 {node_id}")
+            workflow[node_id]["inputs"][input_key] = value  # 设置节点输入值
+    return workflow
+
+
+async def _attach(attach, output_dir, keep_on_server):
+    """重新等待之前提交、可能仍在运行的任务；任务已不存在或失败时返回 None 以重新提交"""
+    base_url, prompt_id = attach
+    client = comfyui_scheduler.client_for(base_url)
+    if client is None:
+        return None
     try:
-        # 生成唯一的文件名
-        filename = f"{os.urandom(16).hex()}.jpg"
-        # 创建完整的文件路径
-        image_path = os.path.join(tmp_dir, filename)
-
-        # 将base64数据解码并保存为文件
-        with open(image_path, "wb") as f:
-            f.write(base64.b64decode(image_base64))
-
-        # 现在image_path变量包含图片的绝对路径
-        print(f"图片已保存至: {image_path}")
-        image = comfyui_client.upload_image(image_path)
-        print(f"图片已上传到ComfyUI，图片名称：{image}")
-
-        workflow_id = 'extend_image_api'
-        workflow_file = os.path.join(current_dir, f"workflows/{workflow_id}.json")  # 构造工作流文件路径
-        with open(workflow_file, "r", encoding="utf-8", errors="ignore") as f:
-            workflow = json.load(f)
-        logger.info(f"使用工作流 {workflow_id} 生成图像...")
+        outputs = await client.attach_prompt(prompt_id)
+        if outputs is None:
+            logger.info(f"任务 {prompt_id} 已不在 {base_url} 上，重新提交")
+            return None
+        logger.info(f"已重新接上任务 {prompt_id}（{base_url}）")
+        if keep_on_server:
+            return client.server_image(outputs)
+        return await client._download_outputs(outputs, output_dir, prefix=prompt_id)
+    except Exception as e:
+        logger.warning(f"重新接上任务 {prompt_id} 失败，重新提交: {e}")
+        return None
+
+
+async def _run_cached(cache_id, cache_hash, image, params, output_dir, build_prompt, keep_on_server=False,
+                      attach=None, on_submit=None):
+    """带结果缓存地上传图片、提交工作流、等待完成并下载结果
+
+    Args:
+        cache_id (str): 缓存中记录的工作流ID（合并提交时为各阶段ID拼接）
+        cache_hash (str): 工作流内容哈希
+        image (str | bytes | memoryview | ServerImage): 输入图片；ServerImage 不上传，且任务固定在其所在节点
+        params (dict | list): 参与缓存键计算的参数
+        build_prompt (callable): 接收上传后的图片名称，返回要提交的工作流
+        keep_on_server (bool): 结果留在服务器上，返回 ServerImage 而不下载（不写入结果缓存）
+        attach (tuple): 之前提交过的 (节点地址, prompt_id)，优先重新等待该任务
+        on_submit (callable): 提交成功后回调 on_submit(节点地址, prompt_id)，用于记录日志以便恢复
+    """
+    if attach:
+        image_path = await _attach(attach, output_dir, keep_on_server)
+        if image_path is not None:
+            return image_path
 
+    remote_input = isinstance(image, ServerImage)
+    cache_key = None
+    # 服务器上的中间结果没有本地内容可算哈希，不走缓存
+    if result_cache is not None and not remote_input:
+        content_hash = await asyncio.to_thread(content_sha256, image)
+        cache_key = ResultCache.make_key(content_hash, cache_id, cache_hash, params)
+        cached_path = result_cache.get(cache_key)
+        if cached_path:
+            logger.info(f"工作流 {cache_id} 命中缓存: {cached_path}")
+            os.makedirs(output_dir, exist_ok=True)
+            local_path = os.path.join(output_dir, os.path.basename(cached_path))
+            if not os.path.exists(local_path):
+                # 复制而不是硬链接，本地结果之后被改写也不影响缓存
+                await asyncio.to_thread(copy_atomic, cached_path, local_path)
+            return local_path
+
+    async def submit(client):
+        if remote_input:
+            image_name = image.annotated
+        else:
+            with tracing.span("comfyui_upload"):
+                image_name = await client.upload_image(image)
+            logger.debug(f"图片已上传到ComfyUI（{client.base_url}），图片名称：{image_name}")
+        prompt = build_prompt(image_name)
+
+        await client.connect_ws()  # 先订阅进度推送，再提交
+        prompt_id = await client.queue_prompt(prompt)  # 提交工作流，获取提示ID
+        logger.info(f"已提交工作流 {cache_id} 到 {client.base_url}，prompt_id: {prompt_id}")
+        if on_submit:
+            on_submit(client.base_url, prompt_id)
+        # 等待 /ws 推送任务完成，再按历史中的时间戳拆分为排队与执行耗时
+        submitted = time.perf_counter()
+        outputs = await client.wait_for_prompt(prompt_id)
+        waited = time.perf_counter() - submitted
+        executed = client.execution_seconds(prompt_id)
+        if executed is not None:
+            executed = min(executed, waited)
+            tracing.record("comfyui_queue_wait", waited - executed)
+            tracing.record("comfyui_execution", executed)
+        else:
+            tracing.record("comfyui_wait", waited)
+        if keep_on_server:
+            return client.server_image(outputs)
+        with tracing.span("comfyui_download"):
+            return await client._download_outputs(outputs, output_dir, prefix=prompt_id)
+
+    # 节点在途中失联时调度器会换节点重新执行 submit；输入在服务器上时只能在该节点执行
+    image_path = await comfyui_scheduler.run(submit, base_url=image.base_url if remote_input else None)
+    if isinstance(image_path, ServerImage):
+        logger.info(f"结果保留在服务器上: {image_path}")
+        return image_path
+    logger.info(f"图片下载完成: {image_path}")
+    if cache_key is not None:
+        # 复制结果文件（以及定期重写索引）在线程中执行，不阻塞事件循环
+        await asyncio.to_thread(result_cache.put, cache_key, image_path, cache_id, cache_hash)
+    return image_path
+
+
+async def run_image_workflow(workflow_id, image, params, output_dir, keep_on_server=False, attach=None,
+                             on_submit=None):
+    """上传图片、提交工作流、等待完成并下载结果
+
+    Args:
+        workflow_id (str): 工作流ID
+        image (str | bytes | memoryview | ServerImage): 图片文件路径或内存中的图片数据，直接以 multipart 上传；
+            也可以是上一阶段留在服务器上的结果
+        params (dict): 除 image 外的工作流参数
+        output_dir (str): 结果下载目录
+        keep_on_server (bool): 结果留在服务器上供下一阶段引用，不下载
+        attach (tuple): 之前提交过的 (节点地址, prompt_id)，见 _run_cached
+        on_submit (callable): 提交成功后的回调，见 _run_cached
+
+    Returns:
+        str | ServerImage: 本地结果路径（或服务器上的结果），失败时返回 None
+    """
+    try:
+        workflow = load_workflow(workflow_id)
         # 加载参数映射表
         mapping = comfyui_client.load_mapping(workflow_id)
-        params = {"image": image, "left": left, "right": right, "top": top, "bottom": bottom}  # 创建基本参数字典
-
-        # 将参数应用到工作流中的相应节点
-        for param_key, value in params.items():
-            if param_key in mapping:
-                node_id, input_key = mapping[param_key]  # 解析节点ID和输入键
-                if node_id not in workflow:
-                    raise Exception(f"工作流 {workflow_id} 中未找到节点 {node_id}")
-                workflow[node_id]["inputs"][input_key] = value  # 设置节点输入值
-
-        logger.info(f"提交工作流 {workflow_id} 到ComfyUI...")  # 日志记录
-        response = requests.post(f"{comfyui_host}/prompt", json={"prompt": workflow})  # 提交工作流
-        if response.status_code != 200:
-            raise Exception(f"提交工作流失败: {response.status_code} - {response.text}")  # 错误处理
-
-        prompt_id = response.json()["prompt_id"]  # 获取提示ID
-        logger.info(f"已排队的工作流，prompt_id: {prompt_id}")  # 日志记录
-        time.sleep(30)
-
-        # 异步等待并下载图像
-        try:
-            output_dir = os.path.join(current_dir, "extend_image")
-            image_path = await comfyui_client.poll_for_video_or_image_or_audio(prompt_id, output_dir, max_attempts=30,
-                                                                               is_video=False)
-            logger.info(f"图片下载完成: {image_path}")
-            return image_path
-        except Exception as e:
-            logger.error(f"图片处理失败: {e}")
 
+        def build_prompt(image_name):
+            return apply_params(workflow_id, copy.deepcopy(workflow), mapping, {"image": image_name, **params})
+
+        return await _run_cached(workflow_id, workflow_hash(workflow_id), image, params, output_dir, build_prompt,
+                                 keep_on_server, attach, on_submit)
 
     except Exception as e:
-        logger.error(f"错误: {e}")
+        logger.error(f"图片处理失败: {e}")
 
 
-async def remove_watermark(image_base64, ):
-    """使用ComfyUI进行水印去除"""
-    try:
-        # 生成唯一的文件名
-        filename = f"{os.urandom(16).hex()}.jpg"
-        # 创建完整的文件路径
-        image_path = os.path.join(tmp_dir, filename)
-
-        # 将base64数据解码并保存为文件
-        with open(image_path, "wb") as f:
-            f.write(base64.b64decode(image_base64))
-
-        # 现在image_path变量包含图片的绝对路径
-        print(f"图片已保存至: {image_path}")
-        image = comfyui_client.upload_image(image_path)
-        print(f"图片已上传到ComfyUI，图片名称：{image}")
-
-        workflow_id = 'remove_water_mark_api'
-        workflow_file = os.path.join(current_dir, f"workflows/{workflow_id}.json")  # 构造工作流文件路径
-        with open(workflow_file, "r", encoding="utf-8", errors="ignore") as f:
-            workflow = json.load(f)
-        logger.info(f"使用工作流 {workflow_id} 生成图像...")
+# 阶段名 -> (工作流ID, 结果下载目录)
+STAGE_WORKFLOWS = {
+    "remove": ("remove_water_mark_api", os.path.join(output_root, "remove_water_mark")),
+    "extend": ("extend_image_api", os.path.join(output_root, "extend_image")),
+    "scale": ("scale_image_api", os.path.join(output_root, "scale_image")),
+}
 
-        # 加载参数映射表
-        mapping = comfyui_client.load_mapping(workflow_id)
-        params = {"image": image, }  # 创建基本参数字典
-
-        # 将参数应用到工作流中的相应节点
-        for param_key, value in params.items():
-            if param_key in mapping:
-                node_id, input_key = mapping[param_key]  # 解析节点ID和输入键
-                if node_id not in workflow:
-                    raise Exception(f"工作流 {workflow_id} 中未找到节点 {node_id}")
-                workflow[node_id]["inputs"][input_key] = value  # 设置节点输入值
-
-        logger.info(f"提交工作流 {workflow_id} 到ComfyUI...")  # 日志记录
-        response = requests.post(f"{comfyui_host}/prompt", json={"prompt": workflow})  # 提交工作流
-        if response.status_code != 200:
-            raise Exception(f"提交工作流失败: {response.status_code} - {response.text}")  # 错误处理
-
-        prompt_id = response.json()["prompt_id"]  # 获取提示ID
-        logger.info(f"已排队的工作流，prompt_id: {prompt_id}")  # 日志记录
-        time.sleep(30)
-
-        # 异步等待并下载图像
-        try:
-            output_dir = os.path.join(current_dir, "remove_water_mark")
-            image_path = await comfyui_client.poll_for_video_or_image_or_audio(prompt_id, output_dir, max_attempts=30,
-                                                                               is_video=False)
-            logger.info(f"图片下载完成: {image_path}")
-            return image_path
-        except Exception as e:
-            logger.error(f"图片处理失败: {e}")
 
+async def download_server_image(image, output_dir):
+    """把留在服务器上的中间结果下载到本地（后续阶段改为本地处理时使用）"""
+    client = comfyui_scheduler.client_for(image.base_url)
+    if client is None:
+        logger.error(f"图片所在的 ComfyUI 节点 {image.base_url} 不在当前节点列表中")
+        return None
+    try:
+        with tracing.span("comfyui_download"):
+            return await client.download_server_image(image, output_dir)
     except Exception as e:
-        logger.error(f"错误: {e}")
+        logger.error(f"下载服务器上的图片失败: {e}")
 
 
-async def scale_image(image_base64, scale_by):
-    """使用ComfyUI进行水印去除"""
+async def run_fused_workflow(image, stages, attach=None, on_submit=None):
+    """把多个阶段合并成一个工作流提交：只上传一次、排队一次、下载最终结果一次
+
+    Args:
+        image (str | bytes | memoryview | ServerImage): 图片文件路径、内存中的图片数据或服务器上的图片
+        stages (list): [(阶段名, 参数), ...]，阶段名见 STAGE_WORKFLOWS，按执行顺序排列
+        attach (tuple): 之前提交过的 (节点地址, prompt_id)，见 _run_cached
+        on_submit (callable): 提交成功后的回调，见 _run_cached
+
+    Returns:
+        str: 最后一个阶段的本地结果路径，失败时返回 None
+    """
     try:
+        workflow_ids = [STAGE_WORKFLOWS[name][0] for name, _ in stages]
+        output_dir = STAGE_WORKFLOWS[stages[-1][0]][1]
+        parts = [(workflow_id, load_workflow(workflow_id), comfyui_client.load_mapping(workflow_id), params)
+                 for workflow_id, (_, params) in zip(workflow_ids, stages)]
+        # 合并一次即可，每次提交只替换输入图片名称
+        workflow, mapping = compose_workflows(parts)
+
+        def build_prompt(image_name):
+            return apply_params("+".join(workflow_ids), copy.deepcopy(workflow), mapping, {"image": image_name})
+
+        cache_id = "+".join(workflow_ids)
+        cache_hash = hashlib.sha256("".join(workflow_hash(workflow_id) for workflow_id in workflow_ids)
+                                    .encode("utf-8")).hexdigest()
+        if result_cache is not None:
+            result_cache.invalidate_workflow(cache_id, cache_hash)
+        params = [params for _, params in stages]
+        return await _run_cached(cache_id, cache_hash, image, params, output_dir, build_prompt,
+                                 attach=attach, on_submit=on_submit)
 
-        # 生成唯一的文件名
-        filename = f"{os.urandom(16).hex()}.jpg"
-        # 创建完整的文件路径
-        image_path = os.path.join(tmp_dir, filename)
+    except Exception as e:
+        logger.error(f"合并工作流处理失败: {e}")
 
-        # 将base64数据解码并保存为文件
-        with open(image_path, "wb") as f:
-            f.write(base64.b64decode(image_base64))
 
-        # 现在image_path变量包含图片的绝对路径
-        print(f"图片已保存至: {image_path}")
-        image = comfyui_client.upload_image(image_path)
-        print(f"图片已上传到ComfyUI，图片名称：{image}")
+async def extend_image(image, left, right, top, bottom, keep_on_server=False, **kwargs):
+    """使用ComfyUI进行扩图"""
+    params = {"left": left, "right": right, "top": top, "bottom": bottom}
+    return await run_image_workflow('extend_image_api', image, params,
+                                    os.path.join(output_root, "extend_image"), keep_on_server, **kwargs)
 
-        workflow_id = 'scale_image_api'
-        workflow_file = os.path.join(current_dir, f"workflows/{workflow_id}.json")  # 构造工作流文件路径
-        with open(workflow_file, "r", encoding="utf-8", errors="ignore") as f:
-            workflow = json.load(f)
-        logger.info(f"使用工作流 {workflow_id} 生成图像...")
 
-        # 加载参数映射表
-        mapping = comfyui_client.load_mapping(workflow_id)
+async def remove_watermark(image, keep_on_server=False, **kwargs):
+    """使用ComfyUI进行水印去除"""
+    return await run_image_workflow('remove_water_mark_api', image, {},
+                                    os.path.join(output_root, "remove_water_mark"), keep_on_server, **kwargs)
 
-        params = {"image": image, "scale_by": scale_by}  # 创建基本参数字典
-
-        # 将参数应用到工作流中的相应节点
-        for param_key, value in params.items():
-            if param_key in mapping:
-                node_id, input_key = mapping[param_key]  # 解析节点ID和输入键
-                if node_id not in workflow:
-                    raise Exception(f"工作流 {workflow_id} 中未找到节点 {node_id}")
-                workflow[node_id]["inputs"][input_key] = value  # 设置节点输入值
-
-        logger.info(f"提交工作流 {workflow_id} 到ComfyUI...")  # 日志记录
-        response = requests.post(f"{comfyui_host}/prompt", json={"prompt": workflow})  # 提交工作流
-        if response.status_code != 200:
-            raise Exception(f"提交工作流失败: {response.status_code} - {response.text}")  # 错误处理
-
-        prompt_id = response.json()["prompt_id"]  # 获取提示ID
-        logger.info(f"已排队的工作流，prompt_id: {prompt_id}")  # 日志记录
-        time.sleep(30)
-
-        # 异步等待并下载图像
-        try:
-            output_dir = os.path.join(current_dir, "scale_image")
-            image_path = await comfyui_client.poll_for_video_or_image_or_audio(prompt_id, output_dir, max_attempts=30,
-                                                                               is_video=False)
-            logger.info(f"图片下载完成: {image_path}")
-            return image_path
-        except Exception as e:
-            logger.error(f"图片处理失败: {e}")
 
-    except Exception as e:
-        logger.error(f"错误: {e}")
+async def scale_image(image, scale_by, keep_on_server=False, **kwargs):
+    """使用ComfyUI进行放大"""
+    return await run_image_workflow('scale_image_api', image, {"scale_by": scale_by},
+                                    os.path.join(output_root, "scale_image"), keep_on_server, **kwargs)
@@ -1,33 +1,118 @@
-import requests
+import hashlib
 import json
 import time
+import uuid
+from collections import OrderedDict
 from loguru import logger
 import os
 import aiohttp
 import asyncio
 
+from .tracing import BYTES_TOTAL
+
 current_dir = os.path.dirname(os.path.abspath(__file__))
 
 
+class ServerImage:
+    """保存在 ComfyUI 服务器上的图片（上一阶段的输出），下一阶段直接引用而不下载再上传"""
+
+    def __init__(self, base_url, filename, subfolder="", type="output"):
+        self.base_url = base_url
+        self.filename = filename
+        self.subfolder = subfolder
+        self.type = type
+
+    @property
+    def annotated(self):
+        """LoadImage 可识别的带目录标注的文件名，例如 ``sub/a.png [output]``"""
+        name = f"{self.subfolder}/{self.filename}" if self.subfolder else self.filename
+        return f"{name} [{self.type}]"
+
+    def to_dict(self):
+        return {"base_url": self.base_url, "filename": self.filename, "subfolder": self.subfolder, "type": self.type}
+
+    def __repr__(self):
+        return f"ServerImage({self.base_url}, {self.annotated})"
+
+
 class ComfyUIClient:
-    def __init__(self, base_url):
+    def __init__(self, base_url, max_connections=None, timeout=None, prompt_timeout=None):
         """初始化ComfyUI客户端
-        
+
+        所有网络操作都是协程，共用一个长连接池（keep-alive）；也可以作为异步上下文管理器使用：
+        ``async with ComfyUIClient(url) as client: ...``
+
         Args:
             base_url (str): ComfyUI服务的基础URL
+            max_connections (int): 连接池最大连接数，默认读取 COMFYUI_MAX_CONNECTIONS
+            timeout (float): 单次请求的连接/读取超时（秒），默认读取 COMFYUI_TIMEOUT
+            prompt_timeout (float): 等待一个任务排队加执行完成的最长时间（秒），默认读取 COMFYUI_PROMPT_TIMEOUT
         """
-        self.base_url = base_url  # 初始化基础URL
+        self.base_url = base_url.rstrip("/")  # 初始化基础URL
+        # 各节点各自给输出编号（ComfyUI_00001_.png），下载到本地时用节点标识区分
+        self.host_tag = hashlib.sha1(self.base_url.encode("utf-8")).hexdigest()[:8]
+        self.max_connections = max_connections or int(os.getenv("COMFYUI_MAX_CONNECTIONS", "16"))
+        self.timeout = timeout or float(os.getenv("COMFYUI_TIMEOUT", "60"))
+        self.prompt_timeout = prompt_timeout or float(os.getenv("COMFYUI_PROMPT_TIMEOUT", "300"))
+        self._session = None
+        self.bytes_uploaded = 0  # 上传与下载的字节数，用于统计传输量
+        self.bytes_downloaded = 0
         # self.available_models = self._get_available_models()  # 获取可用模型列表
-        self.mappings_dir = os.path.join(current_dir,"mappings")  # 参数映射表文件夹
+        # 参数映射表文件夹
+        self.mappings_dir = os.getenv("COMFYUI_MAPPINGS_DIR", os.path.join(current_dir, "mappings"))
 
-    def _get_available_models(self):
+        # /ws 进度推送订阅：同一个 clientId 提交的任务，完成/失败消息都会推送到这条连接上
+        self.client_id = uuid.uuid4().hex
+        ws_base = base_url.rstrip("/").replace("https://", "wss://", 1).replace("http://", "ws://", 1)
+        self.ws_url = f"{ws_base}/ws?clientId={self.client_id}"
+        self.ws_reconnect_interval = 3  # 断线重连间隔（秒）
+        self._loop = None
+        self._ws_task = None
+        self._ws_connected = None
+        self._ws_attempted = None  # 首次连接尝试已有结果（成功、失败或等待超时）
+        self._ws_generation = 0  # 每次（重新）连上 /ws 自增，用于判断是否可能漏掉消息
+        self._pending = {}  # prompt_id -> Future
+        self._finished = OrderedDict()  # 等待者注册前就已结束的任务：prompt_id -> 异常或 None
+        self._ws_outputs = {}  # prompt_id -> {node_id: output}，来自 executed 消息
+        self._executions = OrderedDict()  # prompt_id -> 历史中的 (开始, 结束) 毫秒时间戳，用于区分排队与执行耗时
+
+    async def __aenter__(self):
+        self._ensure_loop()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _get_session(self):
+        """返回当前事件循环上的共享会话，不存在时创建"""
+        self._ensure_loop()
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            timeout = aiohttp.ClientTimeout(total=None, connect=self.timeout, sock_read=self.timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def close(self):
+        """停止 /ws 订阅并关闭连接池"""
+        if self._ws_task is not None and not self._ws_task.done():
+            self._ws_task.cancel()
+            try:
+                await self._ws_task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._ws_task = None
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _get_available_models(self):
         """获取ComfyUI中可用的检查点模型列表"""
         try:
-            response = requests.get(f"{self.base_url}/object_info/CheckpointLoaderSimple")
-            if response.status_code != 200:
-                logger.warning("无法获取模型列表；使用默认处理")
-                return []
-            data = response.json()
+            async with self._get_session().get(f"{self.base_url}/object_info/CheckpointLoaderSimple") as response:
+                if response.status != 200:
+                    logger.warning("无法获取模型列表；使用默认处理")
+                    return []
+                data = await response.json()
             models = data["CheckpointLoaderSimple"]["input"]["required"]["ckpt_name"][0]
             logger.info(f"可用模型: {models}")
             return models
@@ -59,11 +144,14 @@ class ComfyUIClient:
             raise Exception(f"解析参数映射表文件 '{mapping_path}' 失败")
 
 
-    def upload_image(self, image_path):
+    async def upload_image(self, image, filename=None):
         """上传图像到ComfyUI的input目录
+
+        文件路径以流的方式直接读取上传，内存中的数据（bytes/memoryview）不经过临时文件。
         
         Args:
-            image_path (str): 要上传的图像路径
+            image (str | bytes | memoryview): 要上传的图像路径或图像数据
+            filename (str): 服务器上的文件名，默认根据路径生成唯一名称
             
         Returns:
             str: 上传后服务器上的文件名
@@ -73,82 +161,363 @@ class ComfyUIClient:
         """
         try:
             url = f"{self.base_url}/api/upload/image"
-            filename = os.path.basename(image_path)
-            with open(image_path, 'rb') as f:
-                files = {'image': (filename, f)}
-                data = {'overwrite': 'true'}
-                response = requests.post(url, files=files, data=data)
-                response.raise_for_status()
-                return response.json()['name']
+            if isinstance(image, (bytes, bytearray, memoryview)):
+                name = await self._post_upload(url, image, filename or f"{uuid.uuid4().hex}.png")
+                self.bytes_uploaded += len(image)
+                BYTES_TOTAL.labels("upload").inc(len(image))
+                return name
+            # 加前缀避免不同目录/并发任务中的同名文件互相覆盖
+            filename = filename or f"{uuid.uuid4().hex[:8]}_{os.path.basename(image)}"
+            with open(image, 'rb') as f:
+                name = await self._post_upload(url, f, filename)
+            size = os.path.getsize(image)
+            self.bytes_uploaded += size
+            BYTES_TOTAL.labels("upload").inc(size)
+            return name
         except Exception as e:
-            raise Exception(f"上传图像失败: {e}")
+            raise Exception(f"上传图像失败: {e}") from e
+
+    async def _post_upload(self, url, body, filename):
+        data = aiohttp.FormData()
+        data.add_field('image', body, filename=filename, content_type='application/octet-stream')
+        data.add_field('overwrite', 'true')
+        async with self._get_session().post(url, data=data) as response:
+            response.raise_for_status()
+            return (await response.json())['name']
+
+    async def queue_prompt(self, workflow):
+        """提交工作流到 /prompt，带上本客户端的 client_id 以接收 /ws 推送
+
+        Returns:
+            str: prompt_id
+
+        Raises:
+            Exception: 如果提交失败
+        """
+        payload = {"prompt": workflow, "client_id": self.client_id}
+        async with self._get_session().post(f"{self.base_url}/prompt", json=payload) as response:
+            if response.status != 200:
+                raise Exception(f"提交工作流失败: {response.status} - {await response.text()}")
+            return (await response.json())["prompt_id"]
 
     async def download_video_or_image_or_audio_async(self, video_url, save_path):
-        """异步下载视频文件"""
+        """异步下载视频文件
+
+        先写临时文件再替换到 save_path：不会留下写了一半的文件，也不会写进与其他路径硬链接共享的旧文件。
+        """
+        tmp_path = f"{save_path}.{uuid.uuid4().hex[:8]}.part"
         try:
             logger.info(f"开始异步下载视频: {video_url}")
-            async with aiohttp.ClientSession() as session:
-                async with session.get(video_url) as resp:
-                    if resp.status == 200:
-                        with open(save_path, 'wb') as f:
-                            while True:
-                                chunk = await resp.content.read(64 * 1024)  # 每次读取64KB
-                                if not chunk:
-                                    break
-                                f.write(chunk)
-                        logger.info(f"视频已保存至: {save_path}")
-                        return save_path
-                    else:
-                        raise Exception(f"下载失败，状态码: {resp.status}")
+            async with self._get_session().get(video_url) as resp:
+                if resp.status == 200:
+                    with open(tmp_path, 'wb') as f:
+                        async for chunk in resp.content.iter_chunked(64 * 1024):  # 每次读取64KB
+                            f.write(chunk)
+                            self.bytes_downloaded += len(chunk)
+                            BYTES_TOTAL.labels("download").inc(len(chunk))
+                    os.replace(tmp_path, save_path)
+                    logger.info(f"视频已保存至: {save_path}")
+                    return save_path
+                else:
+                    raise Exception(f"下载失败，状态码: {resp.status}")
         except Exception as e:
             logger.error(f"异步下载出错: {e}")
             raise
+        finally:
+            # 失败或取消时清理临时文件
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
-    async def poll_for_video_or_image_or_audio(self, prompt_id, output_dir,max_attempts=60, interval=2, is_video=False,
-                                                 is_audio=False):
-        """异步轮询 ComfyUI 历史接口以获取视频、图像或音频 URL 并下载"""
+    async def get_system_stats(self):
+        """读取 /system_stats，用于健康检查"""
+        async with self._get_session().get(f"{self.base_url}/system_stats") as resp:
+            resp.raise_for_status()
+            return await resp.json()
 
+    async def get_queue_depth(self):
+        """服务器上运行中与排队中的任务总数"""
+        async with self._get_session().get(f"{self.base_url}/queue") as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+        return len(data.get("queue_running", [])) + len(data.get("queue_pending", []))
+
+    async def is_prompt_queued(self, prompt_id):
+        """任务是否仍在服务器的运行/排队队列中"""
+        async with self._get_session().get(f"{self.base_url}/queue") as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+        # 队列项格式为 [序号, prompt_id, prompt, extra_data, outputs_to_execute]
+        return any(len(item) > 1 and item[1] == prompt_id
+                   for item in data.get("queue_running", []) + data.get("queue_pending", []))
+
+    async def _fetch_history(self, prompt_id):
+        """查询一次 /history/{prompt_id}，任务未结束时返回 None"""
+        async with self._get_session().get(f"{self.base_url}/history/{prompt_id}") as resp:
+            if resp.status != 200:
+                logger.warning(f"HTTP 状态码错误：{resp.status}")
+                return None
+            history = await resp.json()
+            entry = history.get(prompt_id)
+            if entry:
+                self._remember_execution(prompt_id, entry)
+            return entry
+
+    def _remember_execution(self, prompt_id, entry):
+        """从历史的 status.messages 中取出 execution_start / execution_success 时间戳"""
+        timestamps = {}
+        for message in (entry.get("status") or {}).get("messages") or []:
+            if len(message) == 2 and isinstance(message[1], dict) and "timestamp" in message[1]:
+                timestamps[message[0]] = message[1]["timestamp"]
+        if "execution_start" in timestamps and "execution_success" in timestamps:
+            self._executions[prompt_id] = (timestamps["execution_start"], timestamps["execution_success"])
+            while len(self._executions) > 1024:
+                self._executions.popitem(last=False)
+
+    def execution_seconds(self, prompt_id):
+        """任务在服务器上实际执行的秒数（不含排队）；历史中没有时间戳时返回 None"""
+        timestamps = self._executions.pop(prompt_id, None)
+        if timestamps is None:
+            return None
+        return max(0.0, (timestamps[1] - timestamps[0]) / 1000)
+
+    def transfer_stats(self):
+        return {"host": self.base_url, "bytes_uploaded": self.bytes_uploaded,
+                "bytes_downloaded": self.bytes_downloaded}
+
+    @staticmethod
+    def _find_output(outputs, is_video=False, is_audio=False):
+        """从工作流输出中找到视频/图像/音频节点的第一个文件信息"""
         if is_audio:
             content_type = "audios"
-            logger.info("开始轮询音频生成结果...")
         elif is_video:
             content_type = "videos"
-            logger.info("开始轮询视频生成结果...")
         else:
             content_type = "images"
-            logger.info("开始轮询图像生成结果...")
+        label = '音频' if is_audio else '视频' if is_video else '图像'
+
+        # 查找输出节点
+        content_node = next((nid for nid, out in outputs.items() if content_type in out), None)
+        if not content_node:
+            raise Exception(f"未找到包含{label}的输出节点: {list(outputs)}")
+        return outputs[content_node][content_type][0], label
+
+    async def _download_outputs(self, outputs, output_dir, is_video=False, is_audio=False, prefix=None):
+        """从工作流输出中找到视频/图像/音频节点并下载第一个文件
+
+        本地文件名加上 prefix（通常为 prompt_id），未给出时加节点标识，
+        多个节点各自编号的同名输出不会互相覆盖。
+        """
+        info, label = self._find_output(outputs, is_video, is_audio)
+        filename = info["filename"]
+        subfolder = info.get('subfolder', '')
+        file_url = (f"{self.base_url}/view?filename={filename}"
+                    f"&subfolder={subfolder}&type={info.get('type', 'output')}")
+        logger.info(f"生成的{label} URL: {file_url}")
+
+        os.makedirs(output_dir, exist_ok=True)
+        parts = [prefix or self.host_tag, subfolder.replace("/", "_").replace("\\", "_"), filename]
+        local_path = os.path.join(output_dir, "_".join(part for part in parts if part))
+
+        await self.download_video_or_image_or_audio_async(file_url, local_path)
+        return local_path
+
+    async def poll_for_video_or_image_or_audio(self, prompt_id, output_dir,max_attempts=60, interval=2, is_video=False,
+                                                 is_audio=False):
+        """异步轮询 ComfyUI 历史接口以获取视频、图像或音频 URL 并下载"""
+        label = '音频' if is_audio else '视频' if is_video else '图像'
+        logger.info(f"开始轮询{label}生成结果...")
 
         for attempt in range(max_attempts):
             logger.info(f"轮询尝试 {attempt + 1}/{max_attempts}")
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{self.base_url}/history/{prompt_id}") as resp:
-                    if resp.status != 200:
-                        logger.warning(f"HTTP 状态码错误：{resp.status}")
-                        await asyncio.sleep(interval)
-                        continue
-
-                    history = await resp.json()
-                    if history.get(prompt_id):
-                        outputs = history[prompt_id]["outputs"]
-                        logger.info("工作流输出: %s", json.dumps(outputs, indent=2))
-
-                        # 查找输出节点
-                        content_node = next((nid for nid, out in outputs.items() if content_type in out), None)
-                        if not content_node:
-                            raise Exception(
-                                f"未找到包含{'音频' if is_audio else '视频' if is_video else '图像'}的输出节点: {outputs}")
-
-                        filename = outputs[content_node][content_type][0]["filename"]
-                        file_url = f"{self.base_url}/view?filename={filename}&subfolder=&type=output"
-                        logger.info(f"生成的{'音频' if is_audio else '视频' if is_video else '图像'} URL: {file_url}")
-
-                        os.makedirs(output_dir, exist_ok=True)
-                        local_path = os.path.join(output_dir, filename)
-
-                        await self.download_video_or_image_or_audio_async(file_url, local_path)
-                        return local_path
-
+            entry = await self._fetch_history(prompt_id)
+            if entry:
+                return await self._download_outputs(entry["outputs"], output_dir, is_video, is_audio,
+                                                    prefix=prompt_id)
             await asyncio.sleep(interval)
 
-        raise Exception(
-            f"{'音频' if is_audio else '视频' if is_video else '图像'}任务 {prompt_id} 在 {max_attempts} 秒内未完成")
+        raise Exception(f"{label}任务 {prompt_id} 在 {max_attempts * interval} 秒内未完成")
+
+    def _ensure_loop(self):
+        """事件循环变化时（例如每张图片一次 asyncio.run）重置与循环绑定的状态"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # 旧循环上的会话和任务已随循环结束，无法在新循环上使用
+            self._loop = loop
+            self._session = None
+            self._ws_task = None
+            self._ws_connected = asyncio.Event()
+            self._ws_attempted = asyncio.Event()
+            self._pending = {}
+            self._finished.clear()
+            self._ws_outputs = {}
+        return loop
+
+    async def connect_ws(self, wait=5):
+        """确保 /ws 订阅在运行；只在首次连接时最多等待 wait 秒，连不上时由历史轮询兜底
+
+        首次尝试失败后立即返回，不再每次提交都等待；后台任务会继续重连，连上后自动改用推送。
+
+        Returns:
+            bool: 当前是否已连接
+        """
+        self._ensure_loop()
+        if self._ws_task is None or self._ws_task.done():
+            self._ws_task = asyncio.create_task(self._ws_listen())
+        if not self._ws_attempted.is_set() and wait:
+            try:
+                await asyncio.wait_for(self._ws_attempted.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                self._ws_attempted.set()
+        if not self._ws_connected.is_set() and wait:
+            logger.debug(f"{self.ws_url} 未连接，使用历史轮询")
+        return self._ws_connected.is_set()
+
+    async def _ws_listen(self):
+        """常驻任务：订阅 /ws，断线后自动重连"""
+        while True:
+            try:
+                async with self._get_session().ws_connect(self.ws_url, heartbeat=30,
+                                                        timeout=aiohttp.ClientWSTimeout(ws_receive=None, ws_close=10)) as ws:
+                    self._ws_generation += 1
+                    self._ws_connected.set()
+                    self._ws_attempted.set()
+                    logger.info(f"已订阅 ComfyUI 进度推送: {self.ws_url}")
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self._handle_ws_message(msg.data)
+                        elif msg.type == aiohttp.WSMsgType.ERROR:
+                            break
+                        # BINARY 为预览图，忽略
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"ComfyUI /ws 连接异常: {e}")
+            finally:
+                self._ws_connected.clear()
+                self._ws_attempted.set()
+            logger.warning(f"ComfyUI /ws 已断开，{self.ws_reconnect_interval} 秒后重连")
+            await asyncio.sleep(self.ws_reconnect_interval)
+
+    def _handle_ws_message(self, raw):
+        try:
+            message = json.loads(raw)
+        except ValueError:
+            return
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if not prompt_id:
+            return
+
+        if msg_type == "executed":
+            self._ws_outputs.setdefault(prompt_id, {})[data.get("node")] = data.get("output") or {}
+        elif msg_type == "executing" and data.get("node") is None:
+            # node 为空表示整个任务结束（此时历史记录已写入；execution_success 早于历史写入，不使用）
+            self._resolve(prompt_id, None)
+        elif msg_type == "execution_error":
+            self._resolve(prompt_id, Exception(
+                f"工作流执行失败 (节点 {data.get('node_id')} {data.get('node_type')}): {data.get('exception_message')}"))
+        elif msg_type == "execution_interrupted":
+            self._resolve(prompt_id, Exception(f"工作流 {prompt_id} 被中断"))
+
+    def _resolve(self, prompt_id, error):
+        future = self._pending.pop(prompt_id, None)
+        if future is None:
+            # 等待者还没注册（任务比提交返回还快），先记下结果
+            self._finished[prompt_id] = error
+            while len(self._finished) > 1000:
+                self._finished.popitem(last=False)
+            return
+        if not future.done():
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    async def wait_for_prompt(self, prompt_id, timeout=None, fallback_interval=2, poll=False):
+        """等待任务结束并返回其输出 outputs
+
+        优先使用 /ws 推送；连接断开期间（以及重连后补查一次）退回到 /history 轮询。
+        poll=True 时始终轮询历史（其他 client_id 提交的任务，完成消息不会推送到本连接）。
+
+        Raises:
+            Exception: 任务执行失败或超时（timeout 默认为 prompt_timeout）
+        """
+        loop = self._ensure_loop()
+        timeout = timeout or self.prompt_timeout
+        deadline = loop.time() + timeout
+        if prompt_id in self._finished:
+            error = self._finished.pop(prompt_id)
+            if error is not None:
+                raise error
+            return await self._collect_outputs(prompt_id)
+
+        future = self._pending.get(prompt_id) or loop.create_future()
+        self._pending[prompt_id] = future
+        checked_generation = self._ws_generation
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise Exception(f"任务 {prompt_id} 在 {timeout} 秒内未完成")
+                done, _ = await asyncio.wait({future}, timeout=min(fallback_interval, remaining))
+                if done:
+                    future.result()
+                    return await self._collect_outputs(prompt_id)
+                connected = self._ws_connected.is_set()
+                if poll or not connected or checked_generation != self._ws_generation:
+                    # 订阅不可用或刚重连（可能漏掉了完成消息），查一次历史
+                    checked_generation = self._ws_generation
+                    entry = await self._fetch_history(prompt_id)
+                    if entry:
+                        self._ws_outputs.pop(prompt_id, None)
+                        return entry.get("outputs", {})
+        finally:
+            self._pending.pop(prompt_id, None)
+
+    async def _collect_outputs(self, prompt_id):
+        """任务完成后读取完整输出（缓存命中的节点不会推送 executed），失败时退回 ws 收到的输出"""
+        ws_outputs = self._ws_outputs.pop(prompt_id, {})
+        try:
+            entry = await self._fetch_history(prompt_id)
+            if entry:
+                return entry.get("outputs", {})
+        except Exception as e:
+            logger.warning(f"读取任务 {prompt_id} 历史失败，使用推送的输出: {e}")
+        return ws_outputs
+
+    async def wait_for_video_or_image_or_audio(self, prompt_id, output_dir, timeout=None, is_video=False,
+                                               is_audio=False):
+        """等待任务完成（事件驱动）并下载视频、图像或音频"""
+        outputs = await self.wait_for_prompt(prompt_id, timeout=timeout)
+        return await self._download_outputs(outputs, output_dir, is_video, is_audio, prefix=prompt_id)
+
+    async def attach_prompt(self, prompt_id, timeout=None):
+        """重新等待之前提交的任务（例如进程重启后），返回其 outputs；服务器上已没有该任务时返回 None
+
+        任务由旧的 client_id 提交，完成消息不会推送给本客户端，因此按间隔轮询历史。
+        """
+        entry = await self._fetch_history(prompt_id)
+        if entry:
+            return entry.get("outputs", {})
+        if not await self.is_prompt_queued(prompt_id):
+            # 两次查询之间可能刚好完成，再查一次历史
+            entry = await self._fetch_history(prompt_id)
+            return entry.get("outputs", {}) if entry else None
+        return await self.wait_for_prompt(prompt_id, timeout=timeout, poll=True)
+
+    async def wait_for_server_image(self, prompt_id, timeout=None):
+        """等待任务完成，只返回输出图片在服务器上的引用，不下载"""
+        outputs = await self.wait_for_prompt(prompt_id, timeout=timeout)
+        return self.server_image(outputs)
+
+    def server_image(self, outputs):
+        """工作流输出中的图片在服务器上的引用"""
+        info, _ = self._find_output(outputs)
+        return ServerImage(self.base_url, info["filename"], info.get("subfolder", ""), info.get("type", "output"))
+
+    async def download_server_image(self, image, output_dir):
+        """下载保存在本服务器上的图片到 output_dir"""
+        outputs = {"image": {"images": [{"filename": image.filename, "subfolder": image.subfolder,
+                                          "type": image.type}]}}
+        return await self._download_outputs(outputs, output_dir)
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from loguru import logger
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """流式计算文件内容的 sha256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_sha256(image):
+    """计算图片内容哈希，image 可以是文件路径或 bytes/memoryview"""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(image).hexdigest()
+    return file_sha256(image)
+
+
+def copy_atomic(src, dst):
+    """复制到临时文件再替换到 dst：dst 总是新的 inode，不会写进与其他路径共享的文件"""
+    # 每次调用使用自己的临时文件，并发写同一个 dst 时互不干扰
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(dst) + ".", suffix=".tmp", dir=os.path.dirname(dst) or ".")
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class ResultCache:
+    """ComfyUI 阶段结果的磁盘缓存
+
+    键由 (输入内容哈希, 工作流ID, 工作流JSON哈希, 参数) 组成，按总字节数做 LRU 淘汰。
+    索引保存在缓存目录下的 index.json 中：每 index_every 次写入或 flush() 时才整体重写，
+    进程意外退出时未写入索引的缓存文件在下次加载时删除。
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None, index_every=None):
+        self.cache_dir = cache_dir or os.getenv("COMFYUI_CACHE_DIR", os.path.join(current_dir, "cache"))
+        self.max_bytes = max_bytes or int(os.getenv("COMFYUI_CACHE_MAX_BYTES", str(10 * 1024 ** 3)))
+        self.index_every = index_every or int(os.getenv("COMFYUI_CACHE_INDEX_EVERY", "50"))
+        self.index_path = os.path.join(self.cache_dir, "index.json")
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._unsaved = 0  # 上次写索引后的写入次数
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._entries = self._load_index()
+        self._remove_orphans()
+        self._bytes = sum(entry["size"] for entry in self._entries.values())
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (ValueError, OSError) as e:
+            logger.warning(f"缓存索引损坏，已重置: {e}")
+            return {}
+        # 丢弃文件已不存在的条目
+        return {key: entry for key, entry in entries.items()
+                if os.path.exists(os.path.join(self.cache_dir, entry["file"]))}
+
+    def _remove_orphans(self):
+        """删除索引中没有记录的缓存文件（写入索引前进程退出留下的）"""
+        known = {entry["file"] for entry in self._entries.values()} | {os.path.basename(self.index_path)}
+        with os.scandir(self.cache_dir) as it:
+            orphans = [entry.path for entry in it if entry.is_file() and entry.name not in known]
+        for path in orphans:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _save_index(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.index_path)
+        self._unsaved = 0
+
+    @staticmethod
+    def make_key(content_hash, workflow_id, workflow_hash, params):
+        raw = json.dumps([content_hash, workflow_id, workflow_hash, params], sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @property
+    def total_bytes(self):
+        return self._bytes
+
+    def get(self, key):
+        """命中时返回缓存文件路径，否则返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                path = os.path.join(self.cache_dir, entry["file"])
+                if os.path.exists(path):
+                    entry["last_used"] = time.time()
+                    self.hits += 1
+                    return path
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, result_path, workflow_id, workflow_hash):
+        """把结果文件复制一份放入缓存，返回缓存中的路径（会复制文件，应在线程中调用）
+
+        不用硬链接：下载目录中的同名文件之后可能被改写，共享 inode 会把缓存内容一起改掉。
+        """
+        name = f"{key}{os.path.splitext(result_path)[1]}"
+        cached_path = os.path.join(self.cache_dir, name)
+        # 复制不持锁，不阻塞其他任务查询缓存；同一个键的内容相同，并发写入时后替换的一方胜出即可
+        copy_atomic(result_path, cached_path)
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is not None:
+                self._bytes -= previous["size"]
+            self._entries[key] = {
+                "file": name,
+                "size": os.path.getsize(cached_path),
+                "workflow_id": workflow_id,
+                "workflow_hash": workflow_hash,
+                "last_used": time.time(),
+            }
+            self._bytes += self._entries[key]["size"]
+            self._evict()
+            self._unsaved += 1
+            if self._unsaved >= self.index_every:
+                self._save_index()
+            return cached_path
+
+    def _evict(self):
+        if self._bytes <= self.max_bytes:
+            return
+        for key, _ in sorted(self._entries.items(), key=lambda item: item[1]["last_used"]):
+            if self._bytes <= self.max_bytes:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry["size"]
+        try:
+            os.remove(os.path.join(self.cache_dir, entry["file"]))
+        except FileNotFoundError:
+            pass
+
+    def invalidate_workflow(self, workflow_id, current_hash):
+        """工作流文件变化后，删除该工作流旧版本产生的全部缓存"""
+        with self._lock:
+            stale = [key for key, entry in self._entries.items()
+                     if entry["workflow_id"] == workflow_id and entry["workflow_hash"] != current_hash]
+            for key in stale:
+                self._remove(key)
+            if stale:
+                logger.info(f"工作流 {workflow_id} 已变化，清除 {len(stale)} 条缓存")
+                self._save_index()
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+            self._save_index()
+
+    def flush(self):
+        """把尚未写入的条目和命中时更新的 last_used 写入索引（一批任务结束时调用）"""
+        with self._lock:
+            self._save_index()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+        }
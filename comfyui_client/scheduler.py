@@ -0,0 +1,153 @@
+import asyncio
+import os
+
+import aiohttp
+from loguru import logger
+
+from .comfyui_client import ComfyUIClient
+
+
+def parse_hosts(value):
+    """COMFYUI_HOST 支持逗号分隔的多个地址"""
+    return [host.strip() for host in (value or "").split(",") if host.strip()]
+
+
+def is_backend_failure(error):
+    """判断异常是否由后端不可用引起（连接失败、超时、5xx），此类任务可以换节点重试"""
+    while error is not None:
+        if isinstance(error, (aiohttp.ClientConnectionError, ConnectionError, asyncio.TimeoutError)):
+            return True
+        if isinstance(error, aiohttp.ClientResponseError) and error.status >= 500:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class Backend:
+    """一个 ComfyUI 节点及其负载与健康状态"""
+
+    def __init__(self, client):
+        self.client = client
+        self.healthy = True
+        self.inflight = 0  # 本进程提交到该节点、尚未结束的任务数
+        self.queue_depth = 0  # 最近一次 /queue 查询到的运行中 + 排队中任务数
+        self.failures = 0
+
+    @property
+    def load(self):
+        # 远端队列里也包含本进程的任务，取两者较大值避免重复计算
+        return max(self.inflight, self.queue_depth)
+
+    def __repr__(self):
+        return f"Backend({self.client.base_url}, healthy={self.healthy}, load={self.load})"
+
+
+class ComfyUIScheduler:
+    """多个 ComfyUI 节点之间的调度器
+
+    每个任务路由到待处理队列最短的健康节点；后台定期通过 /system_stats 做健康检查、
+    通过 /queue 刷新队列深度；节点在任务途中失联时，把任务重新提交到其他节点。
+    """
+
+    def __init__(self, hosts, health_interval=None, max_attempts=None, client_factory=ComfyUIClient):
+        if isinstance(hosts, str):
+            hosts = parse_hosts(hosts)
+        if not hosts:
+            raise ValueError("至少需要一个 ComfyUI 地址")
+        self.backends = [Backend(client_factory(host)) for host in hosts]
+        self.health_interval = health_interval or float(os.getenv("COMFYUI_HEALTH_INTERVAL", "5"))
+        self.max_attempts = max_attempts or len(self.backends) + 1
+        self._loop = None
+        self._health_task = None
+
+    @property
+    def clients(self):
+        return [backend.client for backend in self.backends]
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._health_task is None or self._health_task.done():
+            self._loop = loop
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*[self.check_backend(backend) for backend in self.backends])
+            await asyncio.sleep(self.health_interval)
+
+    async def check_backend(self, backend):
+        try:
+            await backend.client.get_system_stats()
+            backend.queue_depth = await backend.client.get_queue_depth()
+        except Exception as e:
+            if backend.healthy:
+                logger.warning(f"ComfyUI 节点 {backend.client.base_url} 健康检查失败，移出调度: {e}")
+            backend.healthy = False
+            return
+        if not backend.healthy:
+            logger.info(f"ComfyUI 节点 {backend.client.base_url} 已恢复")
+        backend.healthy = True
+        backend.failures = 0
+
+    def pick(self, exclude=()):
+        """选择负载最低的健康节点；全部不健康时仍从未排除的节点中选，避免直接失败"""
+        candidates = [b for b in self.backends if b.healthy and b not in exclude]
+        if not candidates:
+            candidates = [b for b in self.backends if b not in exclude] or self.backends
+        return min(candidates, key=lambda backend: backend.load)
+
+    def mark_failed(self, backend, error):
+        backend.failures += 1
+        backend.healthy = False
+        logger.warning(f"ComfyUI 节点 {backend.client.base_url} 任务失败，移出调度: {error}")
+
+    async def run(self, job, base_url=None):
+        """在某个节点上执行 job(client)，节点故障时换节点重新执行
+
+        Args:
+            job (callable): 接收 ComfyUIClient 的协程函数，需包含上传、提交、等待、下载的完整过程
+            base_url (str): 指定节点（输入图片只保存在该节点上时），此时不做故障转移
+        """
+        self._ensure_started()
+        if base_url is not None:
+            backend = next((b for b in self.backends if b.client.base_url == base_url), None)
+            if backend is None:
+                raise Exception(f"未知的 ComfyUI 节点: {base_url}")
+            backend.inflight += 1
+            try:
+                return await job(backend.client)
+            finally:
+                backend.inflight -= 1
+        tried = []
+        while True:
+            backend = self.pick(exclude=tried)
+            backend.inflight += 1
+            try:
+                return await job(backend.client)
+            except Exception as e:
+                tried.append(backend)
+                if not is_backend_failure(e) or len(tried) >= self.max_attempts:
+                    raise
+                self.mark_failed(backend, e)
+                logger.info(f"任务将重新提交到其他节点（第 {len(tried) + 1} 次尝试）")
+            finally:
+                backend.inflight -= 1
+
+    def stats(self):
+        return [{"host": b.client.base_url, "healthy": b.healthy, "inflight": b.inflight,
+                 "queue_depth": b.queue_depth, "failures": b.failures} for b in self.backends]
+
+    def client_for(self, base_url):
+        """按地址查找节点客户端，不存在时返回 None（例如重启后节点列表已变化）"""
+        return next((b.client for b in self.backends if b.client.base_url == base_url), None)
+
+    async def close(self):
+        if self._health_task is not None and not self._health_task.done():
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+        self._health_task = None
+        for backend in self.backends:
+            await backend.client.close()
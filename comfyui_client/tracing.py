@@ -0,0 +1,102 @@
+"""处理流程的耗时追踪与 Prometheus 指标
+
+每张图片的各阶段（check/remove/extend/scale）以及阶段内的细分步骤（编码、上传、排队、执行、下载、
+视觉模型往返）都记为一个 span：耗时汇总到直方图，同时追加到当前图片的 span 列表中，
+图片处理结束后输出一行结构化日志。当前图片与阶段通过 contextvars 传递，
+asyncio 任务和 to_thread 都会继承，调用方不需要逐层传参。
+
+    with tracing.stage(job.spans, "extend"):
+        with tracing.span("comfyui_upload"):
+            ...
+
+指标通过 METRICS_PORT 端口的 /metrics 以 Prometheus 文本格式暴露（见 start_metrics_server）。
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from loguru import logger
+from prometheus_client import Counter, Histogram, start_http_server
+
+# 覆盖从几毫秒的编码到几分钟的 ComfyUI 排队
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+STAGE_SECONDS = Histogram("ibp_stage_seconds", "每个阶段的耗时", ["stage"], buckets=BUCKETS)
+SPAN_SECONDS = Histogram("ibp_span_seconds", "阶段内各步骤的耗时", ["span", "stage"], buckets=BUCKETS)
+IMAGES_TOTAL = Counter("ibp_images_total", "处理结束的图片数", ["outcome"])
+STAGE_ERRORS_TOTAL = Counter("ibp_stage_errors_total", "阶段失败次数", ["stage"])
+BYTES_TOTAL = Counter("ibp_comfyui_bytes_total", "与 ComfyUI 之间传输的字节数", ["direction"])
+
+# (span 列表, 阶段名)；不在任何图片的处理过程中时为 None
+_current = ContextVar("ibp_trace", default=None)
+_metrics_started = False
+
+
+def record(name, seconds):
+    """记录一个已经测得耗时的 span（例如由 ComfyUI 历史时间戳计算出的排队与执行时间）"""
+    current = _current.get()
+    stage_name = current[1] if current else ""
+    SPAN_SECONDS.labels(name, stage_name).observe(seconds)
+    if current is not None:
+        current[0].append((stage_name, name, seconds))
+
+
+@contextmanager
+def span(name):
+    """计时一个步骤，异常时同样记录"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+@contextmanager
+def stage(spans, name):
+    """把后续的 span 归入 spans 列表中的 name 阶段，并记录阶段耗时"""
+    token = _current.set((spans, name))
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+
+def image_finished(job):
+    """图片处理结束：计数并输出一行包含全部 span 的结构化日志"""
+    if job.error == "已取消":
+        outcome = "cancelled"
+    elif job.error:
+        outcome = "failed"
+    elif job.skip_reason:
+        outcome = "skipped"
+    else:
+        outcome = "ok"
+    IMAGES_TOTAL.labels(outcome).inc()
+    if not job.timings:
+        return
+    trace = {
+        "image": job.source_path,
+        "outcome": outcome,
+        "stages": {name: round(seconds, 4) for name, seconds in job.timings.items() if seconds is not None},
+        "spans": [{"stage": stage_name, "span": name, "seconds": round(seconds, 4)}
+                  for stage_name, name, seconds in job.spans],
+    }
+    logger.info(f"trace {json.dumps(trace, ensure_ascii=False)}")
+
+
+def start_metrics_server(port=None):
+    """在后台线程启动 /metrics 服务；端口默认读取 METRICS_PORT，为 0 时不启动"""
+    global _metrics_started
+    port = int(os.getenv("METRICS_PORT", "9108") if port is None else port)
+    if _metrics_started or not port:
+        return
+    try:
+        start_http_server(port)
+        _metrics_started = True
+        logger.info(f"Prometheus 指标: http://0.0.0.0:{port}/metrics")
+    except OSError as e:
+        logger.warning(f"无法在端口 {port} 启动指标服务: {e}")
@@ -0,0 +1,106 @@
+import copy
+
+# 保存结果的节点类型：阶段的输出图片取自这些节点的 images 输入
+SAVE_NODE_TYPES = ("SaveImage", "PreviewImage")
+# 读取输入图片的节点类型：后一阶段的这类节点会被替换为前一阶段的输出
+LOAD_NODE_TYPES = ("LoadImage",)
+
+
+def _is_link(value):
+    """API 格式中节点之间的连线形如 ["节点ID", 输出槽位]"""
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], int)
+
+
+def find_output_link(workflow_id, workflow):
+    """找到阶段最终输出图片的连线（唯一的保存节点的 images 输入）"""
+    save_nodes = [node_id for node_id, node in workflow.items() if node.get("class_type") in SAVE_NODE_TYPES]
+    if len(save_nodes) != 1:
+        raise Exception(f"工作流 {workflow_id} 需要恰好一个保存图片的节点，实际找到 {len(save_nodes)} 个")
+    link = workflow[save_nodes[0]]["inputs"].get("images")
+    if not _is_link(link):
+        raise Exception(f"工作流 {workflow_id} 的保存节点 {save_nodes[0]} 没有连接图片输入")
+    return save_nodes[0], link
+
+
+def find_input_node(workflow_id, workflow, mapping):
+    """参数映射表中 image 参数对应的 LoadImage 节点"""
+    if "image" not in mapping:
+        raise Exception(f"工作流 {workflow_id} 的参数映射表缺少 image 参数")
+    node_id = mapping["image"][0]
+    node = workflow.get(node_id)
+    if node is None or node.get("class_type") not in LOAD_NODE_TYPES:
+        raise Exception(f"工作流 {workflow_id} 的 image 参数没有指向 LoadImage 节点")
+    return node_id
+
+
+def compose_workflows(stages):
+    """把多个阶段的工作流串接成一个 ComfyUI 提交
+
+    每个阶段的节点重新编号，后一阶段的 LoadImage 被删除，引用它的图片输出改为前一阶段
+    保存节点的输入；只保留最后一个阶段的保存节点，中间结果不落盘。
+
+    Args:
+        stages (list): [(workflow_id, workflow, mapping, params), ...]，按执行顺序排列，
+            params 中不含 image；workflow 不会被修改
+
+    Returns:
+        tuple: (合并后的工作流, 参数映射表)，映射表只包含第一阶段的 image 参数
+    """
+    if not stages:
+        raise ValueError("至少需要一个阶段")
+    composed = {}
+    next_id = 1
+    previous_output = None  # 上一阶段输出图片的连线（已重新编号）
+    first_input = None
+
+    for index, (workflow_id, workflow, mapping, params) in enumerate(stages):
+        workflow = copy.deepcopy(workflow)
+        # 先在原编号上应用参数，再整体重新编号
+        for param_key, value in params.items():
+            if param_key not in mapping:
+                continue
+            node_id, input_key = mapping[param_key]
+            if node_id not in workflow:
+                raise Exception(f"工作流 {workflow_id} 中未找到节点 {node_id}")
+            workflow[node_id]["inputs"][input_key] = value
+
+        input_node = find_input_node(workflow_id, workflow, mapping)
+        save_node, output_link = find_output_link(workflow_id, workflow)
+        is_first, is_last = index == 0, index == len(stages) - 1
+
+        dropped = set()
+        if not is_first:
+            dropped.add(input_node)
+        if not is_last:
+            dropped.add(save_node)
+
+        renumber = {}
+        for node_id in workflow:
+            if node_id not in dropped:
+                renumber[node_id] = str(next_id)
+                next_id += 1
+
+        def relink(value):
+            if not _is_link(value):
+                return value
+            source, slot = value
+            if source == input_node and not is_first:
+                if slot != 0:
+                    # LoadImage 的 MASK 输出无法由上一阶段的图片替代
+                    raise Exception(f"工作流 {workflow_id} 使用了输入图片的第 {slot} 个输出，无法与前一阶段合并")
+                return list(previous_output)
+            if source not in renumber:
+                raise Exception(f"工作流 {workflow_id} 引用了不存在的节点 {source}")
+            return [renumber[source], slot]
+
+        for node_id, node in workflow.items():
+            if node_id in dropped:
+                continue
+            node["inputs"] = {key: relink(value) for key, value in node.get("inputs", {}).items()}
+            composed[renumber[node_id]] = node
+
+        if is_first:
+            first_input = renumber[input_node]
+        previous_output = relink(output_link)
+
+    return composed, {"image": [first_input, "image"]}
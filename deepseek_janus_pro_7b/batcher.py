@@ -0,0 +1,108 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+
+class BatcherBusy(Exception):
+    """等待队列已满，请求被拒绝"""
+
+
+class RequestBatcher:
+    """把并发到达的请求攒成批次，一次调用批处理函数后把结果分发回各个请求
+
+    process_batch(items) 接收请求列表，返回同样长度、同样顺序的结果列表。
+    第一个请求到达后最多再等待 max_wait 秒，或攒满 max_batch_size 个就立即执行。
+    批处理函数在专用的推理线程中执行，不阻塞事件循环；
+    等待中的请求超过 max_pending 时 submit 直接抛出 BatcherBusy。
+    给出 ready（asyncio.Event）时，置位之前只排队不执行（例如模型仍在加载）。
+    """
+
+    def __init__(self, process_batch, max_batch_size=8, max_wait=0.02, max_pending=64, ready=None):
+        self.process_batch = process_batch
+        self.ready = ready
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self._queue = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vlm-inference")
+
+    @property
+    def pending(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, item):
+        """提交一个请求并等待它所在批次的结果
+
+        Raises:
+            BatcherBusy: 等待队列已满
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((item, future))
+        except asyncio.QueueFull:
+            raise BatcherBusy(f"等待中的请求已达上限 {self.max_pending}")
+        return await future
+
+    async def _collect(self):
+        """阻塞等到第一个请求，然后在时间窗口内尽量多取"""
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        # 窗口结束时已排队的请求也一并带上
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _execute(self, items):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.process_batch, items)
+
+    async def _run(self):
+        if self.ready is not None:
+            await self.ready.wait()
+        while True:
+            batch = await self._collect()
+            # 等待期间已取消的请求不再计算
+            batch = [(item, future) for item, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+            items = [item for item, _ in batch]
+            logger.info(f"执行批次，大小 {len(items)}")
+            try:
+                results = await self._execute(items)
+                if len(results) != len(items):
+                    raise Exception(f"批处理返回 {len(results)} 个结果，期望 {len(items)} 个")
+            except Exception as e:
+                logger.error(f"批处理失败: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
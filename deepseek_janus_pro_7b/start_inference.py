@@ -1,25 +1,36 @@
 import torch
+from PIL import Image
 from transformers import AutoModelForCausalLM
 from janus.models import MultiModalityCausalLM, VLChatProcessor
 from janus.utils.io import load_pil_images
 
 
-def load_model(model_path):
-    """加载并初始化模型和处理器"""
+def load_model(model_path, device="cuda", mmap=False):
+    """加载并初始化模型和处理器，device 如 cuda、cuda:1
+
+    mmap=True 时按 safetensors 内存映射逐个张量读取，直接以 bfloat16 放到目标设备，
+    不在内存中先构造一份 float32 的完整模型（需要 accelerate，权重为 safetensors 格式时效果最好）。
+    """
     vl_chat_processor = VLChatProcessor.from_pretrained(model_path)
     tokenizer = vl_chat_processor.tokenizer
 
+    if mmap:
+        vl_gpt = AutoModelForCausalLM.from_pretrained(
+            model_path, trust_remote_code=True, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True,
+            device_map=device
+        )
+        return vl_chat_processor, vl_gpt.eval(), tokenizer
+
     vl_gpt = AutoModelForCausalLM.from_pretrained(
         model_path, trust_remote_code=True
     )
-    vl_gpt = vl_gpt.to(torch.bfloat16).cuda().eval()
+    vl_gpt = vl_gpt.to(torch.bfloat16).to(device).eval()
 
     return vl_chat_processor, vl_gpt, tokenizer
 
-def to_image_understanding(question, image, vl_chat_processor, vl_gpt, tokenizer):
-    """分析图像并回答问题"""
-    # 创建对话结构
-    conversation = [
+def build_conversation(question, image):
+    """构造单张图片的对话结构"""
+    return [
         {
             "role": "<|User|>",
             "content": f"<image_placeholder>\n{question}",
@@ -31,11 +42,27 @@ def to_image_understanding(question, image, vl_chat_processor, vl_gpt, tokenizer
         },
     ]
 
-    # 处理输入数据
-    pil_images = load_pil_images(conversation)
-    prepare_inputs = vl_chat_processor(
-        conversations=conversation, images=pil_images, force_batchify=True
-    ).to(vl_gpt.device)
+
+def prepare_batch(questions, images, vl_chat_processor, vl_gpt):
+    """逐条处理输入后合成一个批次（batchify 会左侧填充到相同长度并生成 attention_mask）
+
+    images 中每一项可以是图片路径，也可以是已解码的 PIL 图像
+    """
+    prepares = []
+    for question, image in zip(questions, images):
+        if isinstance(image, Image.Image):
+            conversation = build_conversation(question, "")
+            pil_images = [image.convert("RGB")]
+        else:
+            conversation = build_conversation(question, image)
+            pil_images = load_pil_images(conversation)
+        prepares.append(vl_chat_processor.process_one(conversations=conversation, images=pil_images))
+    return vl_chat_processor.batchify(prepares).to(vl_gpt.device)
+
+
+def to_image_understanding_batch(questions, images, vl_chat_processor, vl_gpt, tokenizer, max_new_tokens=512):
+    """一次 generate 分析多张图像，按输入顺序返回回答"""
+    prepare_inputs = prepare_batch(questions, images, vl_chat_processor, vl_gpt)
 
     # 生成回答
     inputs_embeds = vl_gpt.prepare_inputs_embeds(**prepare_inputs)
@@ -45,14 +72,65 @@ def to_image_understanding(question, image, vl_chat_processor, vl_gpt, tokenizer
         pad_token_id=tokenizer.eos_token_id,
         bos_token_id=tokenizer.bos_token_id,
         eos_token_id=tokenizer.eos_token_id,
-        max_new_tokens=512,
+        max_new_tokens=max_new_tokens,
         do_sample=True,
         use_cache=True
     )
 
-    answer = tokenizer.decode(outputs[0].cpu().tolist(), skip_special_tokens=True)
-    print(f"视觉模型回复的信息：{answer}")
-    return answer
+    answers = [tokenizer.decode(output.cpu().tolist(), skip_special_tokens=True) for output in outputs]
+    for answer in answers:
+        print(f"视觉模型回复的信息：{answer}")
+    return answers
+
+
+_answer_token_cache = {}
+
+
+def answer_token_ids(tokenizer, variants):
+    """答案词（含前导空格等写法）对应的 token id，每种写法取最后一个 token"""
+    key = tuple(variants)
+    if key not in _answer_token_cache:
+        ids = []
+        for text in variants:
+            token_ids = tokenizer.encode(text, add_special_tokens=False)
+            if token_ids and token_ids[-1] not in ids:
+                ids.append(token_ids[-1])
+        _answer_token_cache[key] = ids
+    return _answer_token_cache[key]
+
+
+@torch.no_grad()
+def score_yes_no_batch(questions, images, vl_chat_processor, vl_gpt, tokenizer, temperature=1.0,
+                       yes_variants=("Y", " Y"), no_variants=("N", " N")):
+    """一次前向计算，比较回答首个 token 为 Y / N 的 logits，返回每张图片回答 Y 的概率
+
+    temperature 用于温度缩放校准：>1 让概率更保守，<1 更激进。
+    """
+    prepare_inputs = prepare_batch(questions, images, vl_chat_processor, vl_gpt)
+    inputs_embeds = vl_gpt.prepare_inputs_embeds(**prepare_inputs)
+    attention_mask = prepare_inputs.attention_mask
+    # 左侧填充时按 attention_mask 计算位置，和 generate 保持一致
+    position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+    hidden = vl_gpt.language_model.model(
+        inputs_embeds=inputs_embeds,
+        attention_mask=attention_mask,
+        position_ids=position_ids,
+        use_cache=False,
+    ).last_hidden_state
+    # 只对最后一个位置计算词表 logits
+    logits = vl_gpt.language_model.lm_head(hidden[:, -1, :]).float()
+
+    yes_ids = answer_token_ids(tokenizer, yes_variants)
+    no_ids = answer_token_ids(tokenizer, no_variants)
+    yes_logit = torch.logsumexp(logits[:, yes_ids], dim=-1)
+    no_logit = torch.logsumexp(logits[:, no_ids], dim=-1)
+    pair = torch.stack([yes_logit, no_logit], dim=-1) / temperature
+    return torch.softmax(pair, dim=-1)[:, 0].cpu().tolist()
+
+
+def to_image_understanding(question, image, vl_chat_processor, vl_gpt, tokenizer):
+    """分析图像并回答问题"""
+    return to_image_understanding_batch([question], [image], vl_chat_processor, vl_gpt, tokenizer)[0]
 
 
 # if __name__ == "__main__":
@@ -1,20 +1,49 @@
+import argparse
 import base64
+import io
+import multiprocessing
 import json
 import asyncio
 import os
+import time
+from http import HTTPStatus
 
 import yaml
 import websockets
-from start_inference import load_model, to_image_understanding
+from PIL import Image
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from batcher import BatcherBusy, RequestBatcher
 from loguru import logger
 
-# 模型初始化
-model_path = "deepseek-ai/Janus-Pro-7B"
-vl_chat_processor, vl_gpt, tokenizer = load_model(model_path)
+# 进程启动时间，用于计算从启动到可以处理请求的耗时
+PROCESS_START = time.monotonic()
 
+# 模型在 init_model 中按进程加载（每个 worker 进程一份，可放在不同的 GPU 上）
+model_path = os.getenv("VLM_MODEL_PATH", "deepseek-ai/Janus-Pro-7B")
+# 1：按 safetensors 内存映射直接以 bfloat16 加载到设备，见 start_inference.load_model
+VLM_SAFETENSORS_MMAP = os.getenv("VLM_SAFETENSORS_MMAP", "0") == "1"
+# 加载完成后先做一次推理（分配显存、初始化内核），第一个真实请求不再慢
+VLM_WARMUP = os.getenv("VLM_WARMUP", "1") != "0"
+vl_chat_processor = vl_gpt = tokenizer = None
+to_image_understanding_batch = score_yes_no_batch = None
 
-def image_understanding(image_path, require_element):
-    question = f"""
+# 模型状态：loading（端口已可连接，请求排队）→ ready 或 failed
+model_state = {"status": "loading", "device": None, "error": None, "load_seconds": None, "ready_seconds": None}
+# 模型就绪后批处理才开始执行排队的请求（加载失败时也会置位，排队的请求返回错误）
+model_ready = asyncio.Event()
+
+
+def init_model(device="cuda"):
+    """加载模型（在后台线程中执行）；torch 与 Janus 也在这里才导入，不拖慢端口绑定"""
+    global vl_chat_processor, vl_gpt, tokenizer, to_image_understanding_batch, score_yes_no_batch
+    logger.info(f"正在加载模型 {model_path} 到 {device}...")
+    from start_inference import load_model, to_image_understanding_batch as generate, score_yes_no_batch as score
+    to_image_understanding_batch, score_yes_no_batch = generate, score
+    vl_chat_processor, vl_gpt, tokenizer = load_model(model_path, device, mmap=VLM_SAFETENSORS_MMAP)
+
+
+def build_question(require_element):
+    return f"""
        识别图片中是否 同时存在【 {require_element} 】：
        is_include 存在则为Y，不包含则为 N
         
@@ -24,9 +53,9 @@ def image_understanding(image_path, require_element):
            Y或N
        ```
        """
-    # 图像分析
-    image = image_path  # 需要传入图像数据
-    ret = to_image_understanding(question, image, vl_chat_processor, vl_gpt, tokenizer)
+
+
+def parse_answer(ret):
     if "```yaml" not in ret:
         if "没有" in ret:
             return {"water_mark": "N"}
@@ -40,42 +69,270 @@ def image_understanding(image_path, require_element):
     return {"water_mark": str(analysis['is_include'])}
 
 
-# 获取当前脚本的目录
-current_dir = os.path.dirname(os.path.abspath(__file__))
-# 创建tmp目录路径
-tmp_dir = os.path.join(current_dir, "tmp")
-# 如果tmp目录不存在，则创建
-os.makedirs(tmp_dir, exist_ok=True)
+def build_score_question(require_element):
+    return f"识别图片中是否存在【 {require_element} 】。存在回答 Y，不存在回答 N，只输出一个字母。"
+
+
+# 识别模式：logit 为单次前向的 Y/N 打分（默认），generate 为原有的生成式回答
+VLM_MODE = os.getenv("VLM_MODE", "logit")
+# 判定为 Y 的概率阈值，以及概率校准用的温度
+VLM_YN_THRESHOLD = float(os.getenv("VLM_YN_THRESHOLD", "0.5"))
+VLM_YN_TEMPERATURE = float(os.getenv("VLM_YN_TEMPERATURE", "1.0"))
+
+
+def image_understanding_batch(requests):
+    """批量识别：requests 为 (image, require_element, mode) 列表，按顺序返回结果
+
+    image 为图片路径或已解码的 PIL 图像
+    """
+    results = [None] * len(requests)
+    by_mode = {}
+    for index, (_, _, mode) in enumerate(requests):
+        by_mode.setdefault(mode, []).append(index)
+
+    for mode, indexes in by_mode.items():
+        images = [requests[i][0] for i in indexes]
+        if mode == "generate":
+            questions = [build_question(requests[i][1]) for i in indexes]
+            answers = to_image_understanding_batch(questions, images, vl_chat_processor, vl_gpt, tokenizer)
+            for i, ret in zip(indexes, answers):
+                results[i] = parse_answer(ret)
+        else:
+            questions = [build_score_question(requests[i][1]) for i in indexes]
+            probabilities = score_yes_no_batch(questions, images, vl_chat_processor, vl_gpt, tokenizer,
+                                               temperature=VLM_YN_TEMPERATURE)
+            for i, probability in zip(indexes, probabilities):
+                results[i] = {
+                    "water_mark": "Y" if probability >= VLM_YN_THRESHOLD else "N",
+                    "probability": round(probability, 4),
+                }
+    return results
+
+
+# Prometheus 指标，通过服务端口上的 HTTP GET /metrics 读取（与 websocket 共用端口）
+REQUESTS_TOTAL = Counter("vlm_requests_total", "识别请求数", ["result"])
+REQUEST_SECONDS = Histogram("vlm_request_seconds", "从收到请求到返回结果的耗时（含解码与排队）",
+                            buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+DECODE_SECONDS = Histogram("vlm_decode_seconds", "图片解码耗时",
+                           buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+INFERENCE_SECONDS = Histogram("vlm_inference_seconds", "每个批次的推理耗时",
+                              buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+BATCH_SIZE = Histogram("vlm_batch_size", "每个批次合并的请求数", buckets=(1, 2, 4, 8, 16, 32, 64))
+PENDING = Gauge("vlm_pending_requests", "等待推理的请求数")
+MODEL_READY = Gauge("vlm_model_ready", "模型是否已就绪（1 就绪，0 加载中或失败）")
+MODEL_LOAD_SECONDS = Gauge("vlm_model_load_seconds", "模型加载耗时（不含预热）")
+TIME_TO_READY_SECONDS = Gauge("vlm_time_to_ready_seconds", "从进程启动到模型就绪（含预热）的耗时")
+
+
+def timed_understanding_batch(requests):
+    """批处理线程中执行，记录批大小与推理耗时"""
+    if model_state["status"] != "ready":
+        raise Exception(f"模型加载失败: {model_state['error']}")
+    BATCH_SIZE.observe(len(requests))
+    with INFERENCE_SECONDS.time():
+        return image_understanding_batch(requests)
+
+
+def image_understanding(image, require_element, mode=VLM_MODE):
+    return image_understanding_batch([(image, require_element, mode)])[0]
+
+
+# 同时到达的请求合并为一次 generate（VLM_BATCH_SIZE 张 / VLM_BATCH_WAIT_MS 毫秒窗口）
+batcher = RequestBatcher(
+    timed_understanding_batch,
+    max_batch_size=int(os.getenv("VLM_BATCH_SIZE", "8")),
+    max_wait=float(os.getenv("VLM_BATCH_WAIT_MS", "20")) / 1000,
+    max_pending=int(os.getenv("VLM_MAX_PENDING", "64")),
+    ready=model_ready,
+)
+PENDING.set_function(lambda: batcher.pending)
+
+
+def load_in_background(device):
+    """加载并预热模型；在端口绑定之后的线程中执行，期间请求在批处理队列中等待"""
+    model_state["device"] = device
+    start = time.monotonic()
+    try:
+        init_model(device)
+        model_state["load_seconds"] = round(time.monotonic() - start, 3)
+        MODEL_LOAD_SECONDS.set(model_state["load_seconds"])
+        if VLM_WARMUP:
+            logger.info("模型已加载，正在预热...")
+            image_understanding_batch([(Image.new("RGB", (384, 384), (127, 127, 127)), "水印", VLM_MODE)])
+    except Exception as e:
+        logger.exception(f"模型加载失败: {e}")
+        model_state["status"] = "failed"
+        model_state["error"] = str(e)
+        return
+    model_state["status"] = "ready"
+    model_state["ready_seconds"] = round(time.monotonic() - PROCESS_START, 3)
+    MODEL_READY.set(1)
+    TIME_TO_READY_SECONDS.set(model_state["ready_seconds"])
+    logger.info(f"模型已就绪：加载 {model_state['load_seconds']} 秒，启动到就绪 {model_state['ready_seconds']} 秒")
+
+
+def health():
+    """health 消息与 GET /health 的内容"""
+    return {"status": model_state["status"], "ready": model_state["status"] == "ready", "model": model_path,
+            "device": model_state["device"], "error": model_state["error"],
+            "load_seconds": model_state["load_seconds"], "time_to_ready_seconds": model_state["ready_seconds"],
+            "uptime_seconds": round(time.monotonic() - PROCESS_START, 3), "pending": batcher.pending}
+
+
+def decode_image(data):
+    """直接从内存缓冲区解码图片，不落盘"""
+    with Image.open(io.BytesIO(data)) as img:
+        return img.convert("RGB")
+
+
+def request_image_bytes(request):
+    """协议 v2 的图片在紧随消息头的二进制帧中；旧协议在 JSON 的 image_base64 字段中"""
+    if "image_bytes" in request:
+        return request["image_bytes"]
+    return base64.b64decode(request.get("image_base64", ""))
+
+
+async def handle_request(websocket, request):
+    """处理一条请求；响应带回请求的 id，同一连接上的多个请求可以乱序返回"""
+    request_id = request.get("id")
+    if request.get("tool") == "image_understanding":
+        start = time.perf_counter()
+        try:
+            with DECODE_SECONDS.time():
+                image = await asyncio.to_thread(lambda: decode_image(request_image_bytes(request)))
+            mode = request.get("mode") or VLM_MODE
+            result = await batcher.submit((image, "水印", mode))
+            REQUESTS_TOTAL.labels("ok").inc()
+        except BatcherBusy as e:
+            result = {"error": "busy", "message": str(e), "pending": batcher.pending}
+            REQUESTS_TOTAL.labels("busy").inc()
+        except Exception as e:
+            result = {"error": f"识别失败: {e}"}
+            REQUESTS_TOTAL.labels("error").inc()
+        REQUEST_SECONDS.observe(time.perf_counter() - start)
+    elif request.get("tool") == "health":
+        result = health()
+    else:
+        result = {"error": "未知工具"}
+    if request_id is not None:
+        result["id"] = request_id
+    try:
+        await websocket.send(json.dumps(result))
+    except websockets.ConnectionClosed:
+        pass
 
 
 async def handle_websocket(websocket):
     logger.info("WebSocket客户端已连接")
+    tasks = set()
+
+    def dispatch(request):
+        # 推理交给批处理线程，读循环立刻返回，心跳和其他请求不受影响
+        task = asyncio.create_task(handle_request(websocket, request))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    header = None  # 等待二进制帧的消息头（协议 v2）
     try:
         async for message in websocket:
-            request = json.loads(message)
-            logger.info(f"收到消息: {request}")
-            if request.get("tool") == "image_understanding":
-                image_base64 = request.get("image_base64", "")
-                # 生成唯一的文件名
-                filename = f"{os.urandom(16).hex()}.jpg"
-                # 创建完整的文件路径
-                image_path = os.path.join(tmp_dir, filename)
-                # 将base64数据解码并保存为文件
-                with open(image_path, "wb") as f:
-                    f.write(base64.b64decode(image_base64))
-                result = image_understanding(image_path, require_element="水印")
-                await websocket.send(json.dumps(result))
-            else:
-                await websocket.send(json.dumps({"error": "未知工具"}))
+            if isinstance(message, bytes):
+                if header is None:
+                    await websocket.send(json.dumps({"error": "收到二进制帧但缺少消息头"}))
+                    continue
+                request, header = header, None
+                request["image_bytes"] = message
+                dispatch(request)
+                continue
+
+            if header is not None:
+                await websocket.send(json.dumps({"error": "消息头之后缺少二进制帧", "id": header.get("id")}))
+                header = None
+            try:
+                request = json.loads(message)
+            except ValueError:
+                await websocket.send(json.dumps({"error": "无效的 JSON"}))
+                continue
+            logger.debug(f"收到消息: tool={request.get('tool')} id={request.get('id')} v={request.get('v', 1)}")
+            if request.get("binary"):
+                header = request
+                continue
+            dispatch(request)
     except websockets.ConnectionClosed:
+        pass
+    finally:
         logger.info("WebSocket客户端已断开连接")
+        for task in tasks:
+            task.cancel()
+
+
+def http_response(connection, status, body, content_type):
+    response = connection.respond(status, body)
+    del response.headers["Content-Type"]
+    response.headers["Content-Type"] = content_type
+    return response
 
 
-async def main():
-    logger.info("正在启动图片水印识别ws服务器在 ws://0.0.0.0:9200...")
-    async with websockets.serve(handle_websocket, "0.0.0.0", 9200):
+def process_request(connection, request):
+    """同一端口上的普通 HTTP 请求：GET /metrics 返回 Prometheus 指标，GET /health 就绪时返回 200、
+    加载中或失败时返回 503；其余照常升级为 websocket"""
+    if request.path == "/metrics":
+        return http_response(connection, HTTPStatus.OK, generate_latest().decode("utf-8"), CONTENT_TYPE_LATEST)
+    if request.path == "/health":
+        state = health()
+        status = HTTPStatus.OK if state["ready"] else HTTPStatus.SERVICE_UNAVAILABLE
+        return http_response(connection, status, json.dumps(state, ensure_ascii=False) + "\n", "application/json")
+    return None
+
+
+async def serve(host, port, device="cuda"):
+    """先绑定端口再在后台加载模型：加载期间客户端可以连接、查询 health，请求排队等待"""
+    logger.info(f"正在启动图片水印识别ws服务器在 ws://{host}:{port}...")
+    # 单条消息上限，默认 64MB，足够容纳大图（websockets 默认只有 1MB）
+    max_size = int(os.getenv("VLM_MAX_MESSAGE_BYTES", str(64 * 1024 * 1024)))
+    async with websockets.serve(handle_websocket, host, port, max_size=max_size,
+                                process_request=process_request):
+        logger.info(f"端口已就绪（{time.monotonic() - PROCESS_START:.1f} 秒），开始加载模型")
+        loader = asyncio.create_task(asyncio.to_thread(load_in_background, device))
+        loader.add_done_callback(lambda _: model_ready.set())
         await asyncio.Future()  # 永远运行
 
 
+def run_worker(host, port, device):
+    """单个 worker：在指定端口提供服务并加载一份模型"""
+    asyncio.run(serve(host, port, device))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Janus 图片水印识别 websocket 服务")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=9200, help="第一个 worker 的端口，其余依次递增")
+    parser.add_argument("--devices", default="cuda", help="逗号分隔的设备列表，worker 依次轮流使用，如 cuda:0,cuda:1")
+    parser.add_argument("--workers", type=int, default=1, help="worker 进程数，每个进程加载一份模型")
+    args = parser.parse_args()
+
+    devices = [device.strip() for device in args.devices.split(",") if device.strip()]
+    if args.workers <= 1:
+        run_worker(args.host, args.port, devices[0])
+        return
+
+    # 多个 worker：每个进程一份模型、一个端口；客户端在 VLM_MODEL_WS_HOST 中列出全部端口
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for index in range(args.workers):
+        port, device = args.port + index, devices[index % len(devices)]
+        process = context.Process(target=run_worker, args=(args.host, port, device), name=f"vlm-worker-{port}")
+        process.start()
+        processes.append(process)
+        logger.info(f"已启动 worker {process.name}（{device}）")
+    endpoints = ",".join(f"ws://<host>:{args.port + index}" for index in range(args.workers))
+    logger.info(f"客户端配置: VLM_MODEL_WS_HOST={endpoints}")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
@@ -0,0 +1,9 @@
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 与各脚本的运行方式一致：项目根目录作为包的根，ws_server 与 webui 下的模块按脚本目录导入
+for path in (ROOT_DIR, os.path.join(ROOT_DIR, "deepseek_janus_pro_7b"), os.path.join(ROOT_DIR, "webui")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
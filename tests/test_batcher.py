@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from batcher import BatcherBusy, RequestBatcher
+
+
+class FakeModel:
+    """记录每次调用的批次，结果为输入乘 10"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.batches = []
+        self.threads = set()
+
+    def __call__(self, items):
+        self.batches.append(list(items))
+        self.threads.add(threading.current_thread().name)
+        time.sleep(self.delay)
+        return [item * 10 for item in items]
+
+
+def test_requests_within_window_share_one_batch():
+    model = FakeModel()
+
+    async def main():
+        batcher = RequestBatcher(model, max_batch_size=8, max_wait=0.05)
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(5)))
+        finally:
+            await batcher.stop()
+
+    assert asyncio.run(main()) == [0, 10, 20, 30, 40]
+    assert model.batches == [[0, 1, 2, 3, 4]]
+    # 批处理函数在推理线程中执行，不在事件循环线程
+    assert model.threads and threading.current_thread().name not in model.threads
+
+
+def test_requests_after_window_go_to_next_batch():
+    model = FakeModel()
+
+    async def main():
+        batcher = RequestBatcher(model, max_batch_size=8, max_wait=0.02)
+        try:
+            first = asyncio.gather(batcher.submit(1), batcher.submit(2))
+            await asyncio.sleep(0.2)
+            second = await batcher.submit(3)
+            return await first, second
+        finally:
+            await batcher.stop()
+
+    assert asyncio.run(main()) == ([10, 20], 30)
+    assert model.batches == [[1, 2], [3]]
+
+
+def test_batch_size_is_capped():
+    model = FakeModel()
+
+    async def main():
+        batcher = RequestBatcher(model, max_batch_size=2, max_wait=0.05)
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(5)))
+        finally:
+            await batcher.stop()
+
+    assert asyncio.run(main()) == [0, 10, 20, 30, 40]
+    assert [len(batch) for batch in model.batches] == [2, 2, 1]
+
+
+def test_full_queue_raises_busy_until_drained():
+    model = FakeModel()
+
+    async def main():
+        ready = asyncio.Event()
+        batcher = RequestBatcher(model, max_batch_size=8, max_wait=0.01, max_pending=2, ready=ready)
+        try:
+            # 未就绪时请求只排队，不执行
+            queued = [asyncio.create_task(batcher.submit(i)) for i in range(2)]
+            await asyncio.sleep(0.05)
+            assert batcher.pending == 2
+            with pytest.raises(BatcherBusy):
+                await batcher.submit(2)
+            ready.set()
+            results = await asyncio.gather(*queued)
+            # 排空后又可以提交
+            return results, await batcher.submit(3)
+        finally:
+            await batcher.stop()
+
+    assert asyncio.run(main()) == ([0, 10], 30)
+    assert model.batches == [[0, 1], [3]]
+
+
+def test_batch_failure_reaches_every_request():
+    def failing(items):
+        raise RuntimeError("CUDA out of memory")
+
+    async def main():
+        batcher = RequestBatcher(failing, max_wait=0.05)
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(3)), return_exceptions=True)
+        finally:
+            await batcher.stop()
+
+    results = asyncio.run(main())
+    assert len(results) == 3
+    assert all(isinstance(result, RuntimeError) for result in results)
@@ -0,0 +1,106 @@
+import os
+
+from journal import Journal
+from service import ImageJob
+
+STAGE_NAMES = ["check", "remove", "extend", "scale"]
+HOST = "http://127.0.0.1:8188"
+
+
+def finish_stage(journal, job, stage, seconds=1.0):
+    """与流水线相同的写入顺序：阶段开始 → 阶段结束"""
+    journal.stage_started(job, stage)
+    job.timings[stage] = seconds
+    journal.stage_finished(job, stage)
+
+
+def write_interrupted_run(tmp_path):
+    """模拟中断的批处理：a.png 扩图与放大合并执行后崩溃，b.png 的去水印任务已提交到 ComfyUI"""
+    journal = Journal(str(tmp_path / "process_journal.db"))
+    first, second = ImageJob(str(tmp_path / "a.png")), ImageJob(str(tmp_path / "b.png"))
+    for job in (first, second):
+        with open(job.source_path, "wb") as f:
+            f.write(b"source")
+        journal.image_started(job)
+        job.width, job.height = 900, 1200
+        finish_stage(journal, job, "check")
+
+    first.has_water_mark = False
+    finish_stage(journal, first, "remove", 0.0)
+    first.image_path = str(tmp_path / "a_extend_scale.png")
+    with open(first.image_path, "wb") as f:
+        f.write(b"output")
+    first.width, first.height = 1080, 1920
+    first.stages = ["extend", "scale"]
+    first.routes = {"extend": ("comfyui", "合并执行"), "scale": ("comfyui", "合并执行")}
+    finish_stage(journal, first, "extend", 3.5)
+    # 合并执行的放大阶段同样记录开始与结束
+    journal.stage_started(first, "scale")
+    journal.stage_finished(first, "scale")
+
+    second.has_water_mark = True
+    journal.stage_started(second, "remove")
+    journal.prompt_submitted(second, "remove", HOST, "prompt-1")
+    journal.close()
+    return Journal(str(tmp_path / "process_journal.db")), first, second
+
+
+def test_restore_replays_finished_and_fused_stages(tmp_path):
+    journal, first, _ = write_interrupted_run(tmp_path)
+    try:
+        record = journal.load()[first.source_path]
+    finally:
+        journal.close()
+
+    job = ImageJob(first.source_path)
+    assert Journal.restore(job, record, STAGE_NAMES) is True
+    assert job.completed == {"check", "remove", "extend", "scale"}
+    assert job.prompts == {}
+    assert job.image_path == first.image_path
+    assert (job.width, job.height) == (1080, 1920)
+    assert job.stages == ["extend", "scale"]
+    assert job.routes == first.routes
+    assert job.timings["extend"] == 3.5
+    assert not job.done
+
+
+def test_restore_recovers_submitted_prompt(tmp_path):
+    journal, _, second = write_interrupted_run(tmp_path)
+    try:
+        record = journal.load()[second.source_path]
+    finally:
+        journal.close()
+
+    job = ImageJob(second.source_path)
+    assert Journal.restore(job, record, STAGE_NAMES) is True
+    assert job.completed == {"check"}
+    assert job.prompts == {"remove": (HOST, "prompt-1")}
+    assert job.image_path == second.source_path
+
+
+def test_restore_stops_at_missing_output(tmp_path):
+    journal, first, _ = write_interrupted_run(tmp_path)
+    try:
+        record = journal.load()[first.source_path]
+    finally:
+        journal.close()
+    os.remove(first.image_path)
+
+    job = ImageJob(first.source_path)
+    assert Journal.restore(job, record, STAGE_NAMES) is True
+    assert job.completed == {"check", "remove"}
+    assert job.image_path == first.source_path
+
+
+def test_restore_ignores_changed_source(tmp_path):
+    journal, first, _ = write_interrupted_run(tmp_path)
+    try:
+        record = journal.load()[first.source_path]
+    finally:
+        journal.close()
+    with open(first.source_path, "wb") as f:
+        f.write(b"new content")
+
+    job = ImageJob(first.source_path)
+    assert Journal.restore(job, record, STAGE_NAMES) is False
+    assert job.completed == set() and job.prompts == {}
@@ -0,0 +1,20 @@
+import os
+
+from PIL import Image
+
+from local_engine import extend_locally, scale_locally
+
+
+def test_same_named_images_get_separate_outputs(tmp_path):
+    # 两个文件夹中的同名图片依次处理，输出到同一目录时互不覆盖
+    outputs = []
+    for folder, color in (("a", (255, 0, 0)), ("b", (0, 0, 255))):
+        os.makedirs(tmp_path / folder)
+        source = str(tmp_path / folder / "photo.png")
+        Image.new("RGB", (1040, 1849), color).save(source)
+        outputs.append((extend_locally(source, 1, 1, 0, 0, output_dir=str(tmp_path / "extend")), color))
+        outputs.append((scale_locally(source, output_dir=str(tmp_path / "scale")), color))
+    assert len({path for path, _ in outputs}) == 4
+    for path, color in outputs:
+        with Image.open(path) as img:
+            assert img.getpixel((img.width // 2, img.height // 2)) == color
@@ -0,0 +1,86 @@
+import json
+import os
+
+from comfyui_client.result_cache import ResultCache
+
+
+def make_result(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(os.urandom(size))
+    return str(path)
+
+
+def test_key_depends_on_every_component():
+    base = ResultCache.make_key("content", "extend_image_api", "wf1", {"left": 1, "right": 2})
+    # 参数顺序不影响键
+    assert base == ResultCache.make_key("content", "extend_image_api", "wf1", {"right": 2, "left": 1})
+    assert base != ResultCache.make_key("other", "extend_image_api", "wf1", {"left": 1, "right": 2})
+    assert base != ResultCache.make_key("content", "scale_image_api", "wf1", {"left": 1, "right": 2})
+    assert base != ResultCache.make_key("content", "extend_image_api", "wf2", {"left": 1, "right": 2})
+    assert base != ResultCache.make_key("content", "extend_image_api", "wf1", {"left": 1, "right": 3})
+
+
+def test_put_copies_and_get_hits(tmp_path):
+    cache = ResultCache(cache_dir=str(tmp_path / "cache"), max_bytes=10 ** 6)
+    result = make_result(tmp_path, "out.png", 100)
+    original = open(result, "rb").read()
+    cached = cache.put("k", result, "wf", "h")
+    assert cached.endswith("k.png")
+    # 下载目录中的文件之后被改写，不影响缓存
+    with open(result, "wb") as f:
+        f.write(b"overwritten")
+    assert cache.get("k") == cached
+    assert open(cached, "rb").read() == original
+    assert cache.get("missing") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_lru_eviction_keeps_recently_used(tmp_path):
+    cache = ResultCache(cache_dir=str(tmp_path / "cache"), max_bytes=250)
+    cache.put("a", make_result(tmp_path, "a.png", 100), "wf", "h")
+    cache.put("b", make_result(tmp_path, "b.png", 100), "wf", "h")
+    assert cache.get("a")  # a 比 b 更近使用
+    cache.put("c", make_result(tmp_path, "c.png", 100), "wf", "h")
+    assert cache.get("b") is None
+    assert cache.get("a") and cache.get("c")
+    assert cache.evictions == 1
+    assert cache.total_bytes == 200
+    assert sorted(os.listdir(tmp_path / "cache")) == ["a.png", "c.png"]
+
+
+def test_workflow_change_invalidates_only_that_workflow(tmp_path):
+    cache = ResultCache(cache_dir=str(tmp_path / "cache"), max_bytes=10 ** 6)
+    cache.put("old", make_result(tmp_path, "1.png", 10), "extend_image_api", "v1")
+    cache.put("current", make_result(tmp_path, "2.png", 10), "extend_image_api", "v2")
+    cache.put("other", make_result(tmp_path, "3.png", 10), "scale_image_api", "v1")
+    assert cache.invalidate_workflow("extend_image_api", "v2") == 1
+    assert cache.get("old") is None
+    assert cache.get("current") and cache.get("other")
+    assert cache.invalidate_workflow("extend_image_api", "v2") == 0
+
+
+def test_index_is_written_in_batches_and_on_flush(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    cache = ResultCache(cache_dir=cache_dir, max_bytes=10 ** 6, index_every=3)
+    index_path = os.path.join(cache_dir, "index.json")
+    cache.put("a", make_result(tmp_path, "a.png", 10), "wf", "h")
+    cache.put("b", make_result(tmp_path, "b.png", 10), "wf", "h")
+    assert not os.path.exists(index_path)
+    cache.put("c", make_result(tmp_path, "c.png", 10), "wf", "h")
+    assert sorted(json.load(open(index_path))) == ["a", "b", "c"]
+    cache.put("d", make_result(tmp_path, "d.png", 10), "wf", "h")
+    cache.flush()
+    reloaded = ResultCache(cache_dir=cache_dir, max_bytes=10 ** 6)
+    assert reloaded.get("d") and reloaded.total_bytes == 40
+
+
+def test_unindexed_files_are_removed_on_load(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    cache = ResultCache(cache_dir=cache_dir, max_bytes=10 ** 6, index_every=100)
+    cache.put("a", make_result(tmp_path, "a.png", 10), "wf", "h")
+    cache.flush()
+    # 写入索引前进程退出：b 的文件在，索引里没有
+    cache.put("b", make_result(tmp_path, "b.png", 10), "wf", "h")
+    reloaded = ResultCache(cache_dir=cache_dir, max_bytes=10 ** 6)
+    assert reloaded.get("a") and reloaded.get("b") is None
+    assert sorted(os.listdir(cache_dir)) == ["a.png", "index.json"]
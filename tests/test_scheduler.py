@@ -0,0 +1,176 @@
+import asyncio
+import io
+import os
+import socket
+
+import pytest
+from aiohttp import web
+from PIL import Image
+
+from benchmark.stub_comfyui import StubComfyUI
+from comfyui_client.scheduler import ComfyUIScheduler
+
+# 最简单的工作流：读入上传的图片后原样保存
+WORKFLOW = {
+    "1": {"class_type": "LoadImage", "inputs": {"image": None}},
+    "2": {"class_type": "SaveImage", "inputs": {"images": ["1", 0]}},
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_workflow(image_name):
+    workflow = {node_id: {**node, "inputs": dict(node["inputs"])} for node_id, node in WORKFLOW.items()}
+    workflow["1"]["inputs"]["image"] = image_name
+    return workflow
+
+
+def png_bytes(width=64, height=64):
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 30, 30)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class StubServer:
+    """在当前事件循环中运行的模拟 ComfyUI，可以随时停掉以模拟节点宕机"""
+
+    def __init__(self, exec_delay=0.2):
+        self.stub = StubComfyUI(exec_delay=exec_delay)
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.app = self.stub.make_app()
+        self.runner = None
+
+    async def start(self):
+        # 停止时不等待已有连接处理完，和进程崩溃一样立即断开
+        self.runner = web.AppRunner(self.app, shutdown_timeout=0)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", self.port).start()
+
+    async def stop(self):
+        if self.runner is None:
+            return
+        for worker in self.app.get("workers", []):
+            worker.cancel()
+        for ws in list(self.stub.clients.values()):
+            await ws.close()
+        await self.runner.cleanup()
+        self.runner = None
+
+
+def make_job(output_dir, calls):
+    """与 call_workflow 中的 submit 相同：上传、提交、等待完成、下载"""
+
+    async def job(client):
+        calls.append(client.base_url)
+        image_name = await client.upload_image(png_bytes(), filename="input.png")
+        await client.connect_ws(wait=1)
+        prompt_id = await client.queue_prompt(make_workflow(image_name))
+        outputs = await client.wait_for_prompt(prompt_id, timeout=30, fallback_interval=0.2)
+        return client.base_url, await client._download_outputs(outputs, output_dir, prefix=prompt_id)
+
+    return job
+
+
+def run_with_servers(count, scenario, exec_delay=0.2):
+    async def main():
+        servers = [StubServer(exec_delay) for _ in range(count)]
+        for server in servers:
+            await server.start()
+        scheduler = ComfyUIScheduler([server.url for server in servers], health_interval=60)
+        try:
+            return await scenario(servers, scheduler)
+        finally:
+            await scheduler.close()
+            for server in servers:
+                await server.stop()
+
+    return asyncio.run(main())
+
+
+def test_fails_over_when_backend_is_down(tmp_path):
+    calls = []
+
+    async def scenario(servers, scheduler):
+        dead, alive = servers
+        await dead.stop()
+        result = await scheduler.run(make_job(str(tmp_path), calls))
+        return result, dead.url, alive.url, scheduler.stats()
+
+    (base_url, path), dead_url, alive_url, stats = run_with_servers(2, scenario)
+    # 负载相同时先选到第一个节点，连接失败后换到另一个节点重新执行
+    assert calls == [dead_url, alive_url]
+    assert base_url == alive_url
+    assert os.path.exists(path)
+    assert stats[0]["healthy"] is False and stats[0]["failures"] == 1
+
+
+def test_fails_over_when_backend_dies_mid_job(tmp_path):
+    calls = []
+
+    async def scenario(servers, scheduler):
+        first, second = servers
+        task = asyncio.create_task(scheduler.run(make_job(str(tmp_path), calls)))
+        # 任务已提交到第一个节点、仍在执行时停掉该节点
+        while first.stub.stats["prompts"] == 0:
+            await asyncio.sleep(0.05)
+        await first.stop()
+        return await task, first.url, second.url
+
+    (base_url, path), first_url, second_url = run_with_servers(2, scenario, exec_delay=2)
+    assert calls == [first_url, second_url]
+    assert base_url == second_url
+    assert os.path.exists(path)
+
+
+def test_pinned_backend_does_not_fail_over(tmp_path):
+    calls = []
+
+    async def scenario(servers, scheduler):
+        dead, _ = servers
+        await dead.stop()
+        with pytest.raises(Exception):
+            await scheduler.run(make_job(str(tmp_path), calls), base_url=dead.url)
+        return dead.url
+
+    dead_url = run_with_servers(2, scenario)
+    assert calls == [dead_url]
+
+
+def test_spreads_jobs_to_least_loaded_backend(tmp_path):
+    calls = []
+
+    async def scenario(servers, scheduler):
+        results = await asyncio.gather(*(scheduler.run(make_job(str(tmp_path), calls)) for _ in range(6)))
+        return results, [server.stub.stats["prompts"] for server in servers]
+
+    results, prompts = run_with_servers(2, scenario)
+    assert prompts == [3, 3]
+    # 两个节点各自从 ComfyUI_00001_.png 开始编号，下载到同一目录时不能互相覆盖
+    paths = [path for _, path in results]
+    assert len(set(paths)) == 6
+    assert all(os.path.exists(path) for path in paths)
+
+
+def test_avoids_backend_with_deep_queue(tmp_path):
+    calls = []
+
+    async def scenario(servers, scheduler):
+        busy, idle = servers
+        # 其他客户端在第一个节点上排了 3 个任务，健康检查读到队列深度后新任务都去空闲节点
+        other = scheduler.backends[0].client
+        image_name = await other.upload_image(png_bytes(), filename="queued.png")
+        for _ in range(3):
+            await other.queue_prompt(make_workflow(image_name))
+        await scheduler.check_backend(scheduler.backends[0])
+        assert scheduler.backends[0].queue_depth == 3
+        await asyncio.gather(*(scheduler.run(make_job(str(tmp_path), calls)) for _ in range(3)))
+        return busy.url, idle.url
+
+    busy_url, idle_url = run_with_servers(2, scenario, exec_delay=1)
+    assert busy_url not in calls
+    assert calls == [idle_url] * 3
@@ -0,0 +1,55 @@
+import os
+import threading
+
+import pytest
+from PIL import Image
+
+import thumbnails
+
+
+@pytest.fixture
+def thumb_dir(tmp_path, monkeypatch):
+    directory = tmp_path / "thumbnails"
+    monkeypatch.setattr(thumbnails, "THUMBNAIL_DIR", str(directory))
+    return directory
+
+
+def make_image(path, size=(1200, 1800), color=(10, 20, 30)):
+    Image.new("RGB", size, color).save(path)
+    return str(path)
+
+
+def test_concurrent_requests_share_one_thumbnail(tmp_path, thumb_dir):
+    # 完成时预生成、翻页预取与当前页同时请求同一张图片，全部拿到同一个缩略图
+    for attempt in range(10):
+        source = make_image(tmp_path / f"{attempt}.png")
+        stat = os.stat(source)
+        barrier = threading.Barrier(4)
+        results = []
+
+        def build():
+            barrier.wait()
+            results.append(thumbnails.make_thumbnail(source, stat))
+
+        threads = [threading.Thread(target=build) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(results) == 4 and None not in results
+        assert len(set(results)) == 1
+    # 没有留下临时文件
+    assert sorted(name.rsplit(".", 1)[1] for name in os.listdir(thumb_dir)) == ["webp"] * 10
+
+
+def test_prune_removes_least_recently_used(tmp_path, thumb_dir):
+    thumbs = []
+    for index in range(3):
+        source = make_image(tmp_path / f"{index}.png", size=(300, 300), color=(index * 80, 0, 0))
+        thumbs.append(thumbnails.make_thumbnail(source, os.stat(source)))
+    for index, thumb in enumerate(thumbs):
+        os.utime(thumb, ns=(index * 10 ** 9, index * 10 ** 9))
+    # 只够保留最新的一张
+    keep = os.path.getsize(thumbs[2])
+    assert thumbnails.prune(max_bytes=keep) == 2
+    assert os.listdir(thumb_dir) == [os.path.basename(thumbs[2])]
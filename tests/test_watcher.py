@@ -0,0 +1,30 @@
+import os
+
+from service import ImageJob
+from watcher import FolderWatcher
+
+
+def finished_job(source, output):
+    job = ImageJob(str(source))
+    job.image_path = str(output)
+    job.finish()
+    return job
+
+
+def test_publish_keeps_sources_apart_and_copies(tmp_path):
+    folder, output_dir = tmp_path / "in", tmp_path / "out"
+    folder.mkdir()
+    for name in ("a.jpg", "a.png"):
+        (folder / name).write_bytes(name.encode())
+    watcher = FolderWatcher(str(folder), str(output_dir), use_events=False)
+    try:
+        # 跳过的图片结果就是源文件本身
+        targets = [watcher.publish(finished_job(folder / name, folder / name)) for name in ("a.jpg", "a.png")]
+    finally:
+        watcher.journal.close()
+
+    assert [os.path.basename(target) for target in targets] == ["a_jpg.jpg", "a_png.png"]
+    assert [open(target, "rb").read() for target in targets] == [b"a.jpg", b"a.png"]
+    # 输出是独立的副本，修改输出不会影响源文件；输出目录中没有残留的临时文件
+    assert not os.path.samefile(targets[0], folder / "a.jpg")
+    assert sorted(os.listdir(output_dir)) == ["a_jpg.jpg", "a_png.png"]
@@ -0,0 +1,69 @@
+import copy
+
+import pytest
+
+from comfyui_client.workflow_composer import compose_workflows
+
+# 扩图阶段：LoadImage -> 扩图 -> SaveImage
+EXTEND = {
+    "1": {"class_type": "LoadImage", "inputs": {"image": None}},
+    "2": {"class_type": "ImagePadForOutpaint", "inputs": {"image": ["1", 0], "bottom": 0}},
+    "3": {"class_type": "SaveImage", "inputs": {"images": ["2", 0], "filename_prefix": "extend"}},
+}
+EXTEND_MAPPING = {"image": ["1", "image"], "bottom": ["2", "bottom"]}
+
+# 放大阶段：节点编号与扩图阶段不同，LoadImage 的输出被两个节点引用
+SCALE = {
+    "10": {"class_type": "LoadImage", "inputs": {"image": None}},
+    "11": {"class_type": "UpscaleModelLoader", "inputs": {"model_name": "4x.pth"}},
+    "12": {"class_type": "ImageUpscaleWithModel", "inputs": {"upscale_model": ["11", 0], "image": ["10", 0]}},
+    "13": {"class_type": "ImageBlend", "inputs": {"image1": ["12", 0], "image2": ["10", 0]}},
+    "14": {"class_type": "SaveImage", "inputs": {"images": ["13", 0], "filename_prefix": "scale"}},
+}
+SCALE_MAPPING = {"image": ["10", "image"]}
+
+
+def test_chains_stages_into_one_workflow():
+    extend, scale = copy.deepcopy(EXTEND), copy.deepcopy(SCALE)
+    workflow, mapping = compose_workflows([("extend", extend, EXTEND_MAPPING, {"bottom": 256}),
+                                           ("scale", scale, SCALE_MAPPING, {})])
+
+    # 扩图阶段的保存节点和放大阶段的 LoadImage 被删除，其余节点按顺序重新编号
+    assert workflow == {
+        "1": {"class_type": "LoadImage", "inputs": {"image": None}},
+        "2": {"class_type": "ImagePadForOutpaint", "inputs": {"image": ["1", 0], "bottom": 256}},
+        "3": {"class_type": "UpscaleModelLoader", "inputs": {"model_name": "4x.pth"}},
+        "4": {"class_type": "ImageUpscaleWithModel", "inputs": {"upscale_model": ["3", 0], "image": ["2", 0]}},
+        "5": {"class_type": "ImageBlend", "inputs": {"image1": ["4", 0], "image2": ["2", 0]}},
+        "6": {"class_type": "SaveImage", "inputs": {"images": ["5", 0], "filename_prefix": "scale"}},
+    }
+    assert mapping == {"image": ["1", "image"]}
+    # 传入的工作流不会被修改（缓存的模板可以重复使用）
+    assert extend == EXTEND and scale == SCALE
+
+
+def test_single_stage_is_only_renumbered():
+    workflow, mapping = compose_workflows([("scale", SCALE, SCALE_MAPPING, {})])
+    assert sorted(workflow, key=int) == ["1", "2", "3", "4", "5"]
+    assert workflow["5"]["inputs"]["images"] == ["4", 0]
+    assert mapping == {"image": ["1", "image"]}
+
+
+def test_rejects_stage_using_input_mask():
+    masked = copy.deepcopy(SCALE)
+    masked["13"]["inputs"]["image2"] = ["10", 1]  # LoadImage 的 MASK 输出
+    with pytest.raises(Exception, match="第 1 个输出"):
+        compose_workflows([("extend", EXTEND, EXTEND_MAPPING, {}), ("scale", masked, SCALE_MAPPING, {})])
+
+
+def test_mask_is_allowed_in_first_stage():
+    masked = copy.deepcopy(SCALE)
+    masked["13"]["inputs"]["image2"] = ["10", 1]
+    workflow, _ = compose_workflows([("scale", masked, SCALE_MAPPING, {}), ("extend", EXTEND, EXTEND_MAPPING, {})])
+    assert workflow["4"]["inputs"]["image2"] == ["1", 1]
+
+
+def test_rejects_workflow_without_single_save_node():
+    broken = {node_id: node for node_id, node in EXTEND.items() if node_id != "3"}
+    with pytest.raises(Exception, match="恰好一个保存图片的节点"):
+        compose_workflows([("extend", broken, EXTEND_MAPPING, {})])
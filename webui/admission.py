@@ -0,0 +1,104 @@
+import asyncio
+import collections
+import os
+
+from loguru import logger
+from prometheus_client import Gauge
+
+from local_engine import scale_target
+from preprocess import vlm_decode_size
+
+# 批处理中同时在途图片的估算内存上限（MB），0 表示不限制
+ADMISSION_MEMORY_BUDGET_MB = int(os.getenv("ADMISSION_MEMORY_BUDGET_MB", "2048"))
+# 解码后每像素的字节数（RGB）
+BYTES_PER_PIXEL = 3
+
+ADMITTED_BYTES = Gauge("ibp_admission_bytes", "已放行图片的估算内存（字节）")
+WAITING_IMAGES = Gauge("ibp_admission_waiting", "等待内存预算的图片数")
+
+
+def estimate_cost(entry):
+    """按文件头尺寸估算一张图片处理时的峰值解码内存（字节）
+
+    只有本地解码像素的步骤占内存：水印检测（JPEG 按 draft 缩小解码）、本地扩图与本地放大；
+    ComfyUI 阶段的上传和下载都是流式的。各阶段依次执行，取最大的阶段。
+
+    Args:
+        entry (PlanEntry): planner 生成的计划条目
+    """
+    if entry.skipped or not entry.width:
+        return 0
+    width, height = entry.width, entry.height
+    check_width, check_height = vlm_decode_size(entry.path, width, height)
+    # 解码 + convert("RGB") 两份
+    peaks = [check_width * check_height * 2]
+    if "extend" in entry.stages:
+        new_width = width + entry.left + entry.right
+        new_height = height + entry.top + entry.bottom
+        if entry.routes.get("extend") == "local":
+            # 原图：解码、转换、numpy 数组；结果：填充数组、填充图片、模糊图片
+            peaks.append(width * height * 3 + new_width * new_height * 3)
+        width, height = new_width, new_height
+    if entry.routes.get("scale") == "local":
+        _, (scaled_width, scaled_height) = scale_target(width, height)
+        # 原图：解码、转换；结果：缩放图片与保存时的编码缓冲
+        peaks.append(width * height * 2 + scaled_width * scaled_height * 2)
+    return max(peaks) * BYTES_PER_PIXEL
+
+
+class MemoryBudget:
+    """按估算内存放行图片：已放行的总量不超过预算时才放行下一张
+
+    按提交顺序放行，大图不会被后面的小图一直插队；单张就超过预算的图片在没有其他图片在途时单独放行。
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget = budget_bytes
+        self.in_use = 0
+        self.peak = 0
+        self._waiters = collections.deque()  # (cost, Future)
+
+    def _fits(self, cost):
+        return self.in_use == 0 or self.in_use + cost <= self.budget
+
+    def _take(self, cost):
+        if cost > self.budget:
+            logger.warning(f"图片估算内存 {cost / 2 ** 20:.0f}MB 超过预算 {self.budget / 2 ** 20:.0f}MB，单独处理")
+        self.in_use += cost
+        self.peak = max(self.peak, self.in_use)
+        ADMITTED_BYTES.set(self.in_use)
+
+    def _wake(self):
+        while self._waiters and self._fits(self._waiters[0][0]):
+            cost, future = self._waiters.popleft()
+            if future.done():
+                continue
+            self._take(cost)
+            future.set_result(None)
+        WAITING_IMAGES.set(len(self._waiters))
+
+    async def acquire(self, cost):
+        if not self._waiters and self._fits(cost):
+            self._take(cost)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((cost, future))
+        WAITING_IMAGES.set(len(self._waiters))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                try:
+                    self._waiters.remove((cost, future))
+                except ValueError:
+                    pass
+                self._wake()
+            else:
+                # 已放行但调用方被取消
+                self.release(cost)
+            raise
+
+    def release(self, cost):
+        self.in_use -= cost
+        ADMITTED_BYTES.set(self.in_use)
+        self._wake()
@@ -0,0 +1,232 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+from comfyui_client.call_workflow import ServerImage
+
+# 日志文件保存在被处理的文件夹内
+JOURNAL_NAME = "process_journal.db"
+# 批量写入：攒够条数或到达间隔后在一个事务中提交
+JOURNAL_BATCH_SIZE = int(os.getenv("JOURNAL_BATCH_SIZE", "256"))
+JOURNAL_FLUSH_INTERVAL = float(os.getenv("JOURNAL_FLUSH_INTERVAL", "0.5"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    source_path TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    size INTEGER,
+    status TEXT,
+    output TEXT,
+    skip_reason TEXT,
+    error TEXT,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    source_path TEXT,
+    stage TEXT,
+    status TEXT,
+    host TEXT,
+    prompt_id TEXT,
+    output TEXT,
+    width INTEGER,
+    height INTEGER,
+    detail TEXT,
+    started_at REAL,
+    finished_at REAL,
+    seconds REAL,
+    error TEXT,
+    PRIMARY KEY (source_path, stage)
+);
+"""
+
+
+def encode_image(image):
+    """本地路径原样保存；留在 ComfyUI 服务器上的结果保存为 JSON"""
+    if isinstance(image, ServerImage):
+        return json.dumps(image.to_dict())
+    return image
+
+
+def decode_image(value):
+    if value and value.startswith("{"):
+        return ServerImage(**json.loads(value))
+    return value
+
+
+def file_signature(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+class Journal:
+    """批处理日志（SQLite WAL）：记录每张图片每个阶段的状态、prompt_id、输出和耗时
+
+    写入由后台线程批量提交，调用方只是把记录放入队列，不会阻塞流水线。
+    进程崩溃后重新处理同一文件夹时，从每张图片最后完成的阶段继续，
+    仍在 ComfyUI 上运行的任务按 prompt_id 重新接上。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        conn.close()
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="journal-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL 下 NORMAL 只在断电时可能丢最后几个事务，不会损坏数据库
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _write_loop(self):
+        conn = self._connect()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + JOURNAL_FLUSH_INTERVAL
+                stop = False
+                while len(batch) < JOURNAL_BATCH_SIZE:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stop = True
+                        break
+                    batch.append(item)
+                try:
+                    with conn:
+                        for sql, args in batch:
+                            conn.execute(sql, args)
+                except sqlite3.Error as e:
+                    logger.error(f"写入批处理日志失败: {e}")
+                if stop:
+                    break
+        finally:
+            conn.close()
+
+    def _execute(self, sql, args):
+        self._queue.put((sql, args))
+
+    def load(self):
+        """读取全部记录：source_path -> {"image": 行, "stages": {阶段名: 行}}"""
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        try:
+            records = {row["source_path"]: {"image": dict(row), "stages": {}}
+                       for row in conn.execute("SELECT * FROM images")}
+            for row in conn.execute("SELECT * FROM stages"):
+                if row["source_path"] in records:
+                    records[row["source_path"]]["stages"][row["stage"]] = dict(row)
+            return records
+        finally:
+            conn.close()
+
+    def image_started(self, job, resumed=False):
+        mtime_ns, size = file_signature(job.source_path)
+        if not resumed:
+            # 源文件重新开始处理时清除旧的阶段记录
+            self._execute("DELETE FROM stages WHERE source_path = ?", (job.source_path,))
+        self._execute(
+            "INSERT OR REPLACE INTO images (source_path, mtime_ns, size, status, output, skip_reason, error, updated_at) "
+            "VALUES (?, ?, ?, 'running', NULL, NULL, NULL, ?)",
+            (job.source_path, mtime_ns, size, time.time()))
+
+    def image_finished(self, job):
+        status = "failed" if job.error else "skipped" if job.skip_reason else "done"
+        self._execute(
+            "UPDATE images SET status = ?, output = ?, skip_reason = ?, error = ?, updated_at = ? WHERE source_path = ?",
+            (status, encode_image(job.output_path), job.skip_reason, job.error, time.time(), job.source_path))
+
+    def stage_started(self, job, stage):
+        self._execute(
+            "INSERT INTO stages (source_path, stage, status, started_at) VALUES (?, ?, 'running', ?) "
+            "ON CONFLICT (source_path, stage) DO UPDATE SET status = 'running', started_at = excluded.started_at, "
+            "finished_at = NULL, error = NULL",
+            (job.source_path, stage, time.time()))
+
+    def prompt_submitted(self, job, stage, host, prompt_id):
+        self._execute("UPDATE stages SET host = ?, prompt_id = ? WHERE source_path = ? AND stage = ?",
+                      (host, prompt_id, job.source_path, stage))
+
+    def stage_finished(self, job, stage):
+        if job.error:
+            status = "failed"
+        elif job.skip_reason:
+            status = "skipped"
+        else:
+            status = "done"
+        detail = {"has_water_mark": job.has_water_mark, "stages": list(job.stages),
+                  "routes": {name: list(route) for name, route in job.routes.items()}}
+        self._execute(
+            "UPDATE stages SET status = ?, output = ?, width = ?, height = ?, detail = ?, finished_at = ?, "
+            "seconds = ?, error = ? WHERE source_path = ? AND stage = ?",
+            (status, encode_image(job.image_path), job.width, job.height, json.dumps(detail), time.time(),
+             job.timings.get(stage), job.error, job.source_path, stage))
+
+    @staticmethod
+    def restore(job, record, stage_names):
+        """按日志恢复任务状态
+
+        源文件未变化时：已结束的图片直接标记结束；否则依次恢复已完成的阶段（输出仍存在时），
+        第一个未完成阶段若已提交到 ComfyUI，记下 (节点地址, prompt_id) 以便重新接上。
+
+        Returns:
+            bool: 是否从日志恢复了状态
+        """
+        image = record["image"]
+        try:
+            if file_signature(job.source_path) != (image["mtime_ns"], image["size"]):
+                return False
+        except OSError:
+            return False
+
+        if image["status"] in ("done", "skipped"):
+            output = decode_image(image["output"])
+            if image["status"] == "skipped" or (output and not isinstance(output, ServerImage)
+                                                and os.path.exists(output)):
+                job.image_path = output or job.source_path
+                job.finish(skip_reason=image["skip_reason"])
+                return True
+
+        for stage in stage_names:
+            row = record["stages"].get(stage)
+            if row is None:
+                break
+            if row["status"] != "done":
+                if row["status"] == "running" and row["prompt_id"]:
+                    job.prompts[stage] = (row["host"], row["prompt_id"])
+                break
+            output = decode_image(row["output"])
+            if not output or (not isinstance(output, ServerImage) and not os.path.exists(output)):
+                break
+            detail = json.loads(row["detail"] or "{}")
+            job.image_path = output
+            job.width, job.height = row["width"], row["height"]
+            job.has_water_mark = detail.get("has_water_mark")
+            job.stages = detail.get("stages", [])
+            job.routes = {name: tuple(route) for name, route in detail.get("routes", {}).items()}
+            job.timings[stage] = row["seconds"]
+            job.completed.add(stage)
+        return bool(job.completed or job.prompts)
+
+    def close(self):
+        """写完队列中的全部记录后关闭"""
+        self._queue.put(None)
+        self._writer.join()
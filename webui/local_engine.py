@@ -0,0 +1,88 @@
+import os
+import uuid
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+# 本地处理阈值：扩图总像素不超过原边长的比例（且每侧不超过像素上限）、放大倍数上限
+LOCAL_EXTEND_MAX_RATIO = float(os.getenv("LOCAL_EXTEND_MAX_RATIO", "0.03"))
+LOCAL_EXTEND_MAX_PIXELS = int(os.getenv("LOCAL_EXTEND_MAX_PIXELS", "48"))
+LOCAL_SCALE_MAX_FACTOR = float(os.getenv("LOCAL_SCALE_MAX_FACTOR", "1.25"))
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 与 ComfyUI 结果放在同一目录，方便统一查看
+OUTPUT_ROOT = os.getenv("COMFYUI_OUTPUT_DIR", os.path.join(ROOT_DIR, "comfyui_client"))
+EXTEND_IMAGE_DIR = os.path.join(OUTPUT_ROOT, "extend_image")
+SCALE_IMAGE_DIR = os.path.join(OUTPUT_ROOT, "scale_image")
+
+
+def extend_route(width, height, left, right, top, bottom):
+    """判断扩图是否可以在本地完成
+
+    Returns:
+        tuple: (是否本地处理, 原因)
+    """
+    horizontal, vertical = left + right, top + bottom
+    ratio = max(horizontal / width, vertical / height)
+    largest = max(left, right, top, bottom)
+    if ratio <= LOCAL_EXTEND_MAX_RATIO and largest <= LOCAL_EXTEND_MAX_PIXELS:
+        return True, f"扩展 {ratio:.1%}（单侧最多 {largest}px），本地边缘填充"
+    return False, f"扩展 {ratio:.1%}（单侧最多 {largest}px），超出本地阈值，使用 ComfyUI 扩图"
+
+
+def scale_target(width, height, target_width=1080, target_height=1920):
+    """放大到不低于目标分辨率所需的倍数与尺寸"""
+    factor = max(target_width / width, target_height / height)
+    return factor, (round(width * factor), round(height * factor))
+
+
+def scale_route(width, height):
+    """判断放大是否可以在本地完成
+
+    Returns:
+        tuple: (是否本地处理, 原因)
+    """
+    factor, _ = scale_target(width, height)
+    if factor <= LOCAL_SCALE_MAX_FACTOR:
+        return True, f"放大 {factor:.2f} 倍，本地 Lanczos 重采样"
+    return False, f"放大 {factor:.2f} 倍，超出本地阈值，使用 ComfyUI 放大"
+
+
+def _output_path(image_path, output_dir, suffix):
+    """输出文件名加随机前缀：不同文件夹、不同批次（以及监视文件夹）中的同名图片不会互相覆盖，
+    批处理日志恢复时引用的结果也不会被其他任务改写"""
+    os.makedirs(output_dir, exist_ok=True)
+    name, ext = os.path.splitext(os.path.basename(image_path))
+    return os.path.join(output_dir, f"{uuid.uuid4().hex[:12]}_{name}_{suffix}{ext or '.png'}")
+
+
+def _save(img, path):
+    if path.lower().endswith((".jpg", ".jpeg")):
+        img.save(path, quality=95)
+    else:
+        img.save(path)
+    return path
+
+
+def extend_locally(image_path, left, right, top, bottom, output_dir=EXTEND_IMAGE_DIR):
+    """边缘镜像填充后对填充区域做模糊，原图区域保持不变"""
+    with Image.open(image_path) as img:
+        img = img.convert("RGB")
+    pixels = np.asarray(img)
+    padded = np.pad(pixels, ((top, bottom), (left, right), (0, 0)), mode="symmetric")
+    extended = Image.fromarray(padded)
+
+    # 只模糊填充出来的部分，避免镜像内容过于清晰显得突兀
+    radius = max(2, max(left, right, top, bottom) // 2)
+    blurred = extended.filter(ImageFilter.GaussianBlur(radius))
+    blurred.paste(img, (left, top))
+    return _save(blurred, _output_path(image_path, output_dir, "extend"))
+
+
+def scale_locally(image_path, output_dir=SCALE_IMAGE_DIR):
+    """Lanczos 放大到不低于 1080x1920"""
+    with Image.open(image_path) as img:
+        img = img.convert("RGB")
+        _, size = scale_target(*img.size)
+        scaled = img.resize(size, Image.Resampling.LANCZOS)
+    return _save(scaled, _output_path(image_path, output_dir, "scale"))
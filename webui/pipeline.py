@@ -0,0 +1,183 @@
+import asyncio
+import os
+
+from admission import ADMISSION_MEMORY_BUDGET_MB, MemoryBudget, estimate_cost
+from comfyui_client import tracing
+from comfyui_client.call_workflow import close_client
+from planner import PlanEntry, plan_image
+from service import ImageJob, STAGES, get_image_size, run_stage, close_vlm_client
+
+# 每个阶段的并发上限，默认值可通过环境变量覆盖（与后端 GPU 数量匹配）
+DEFAULT_CONCURRENCY = {
+    "check": int(os.getenv("PIPELINE_CHECK_CONCURRENCY", "4")),
+    "remove": int(os.getenv("PIPELINE_REMOVE_CONCURRENCY", "2")),
+    "extend": int(os.getenv("PIPELINE_EXTEND_CONCURRENCY", "2")),
+    "scale": int(os.getenv("PIPELINE_SCALE_CONCURRENCY", "2")),
+}
+
+
+class BatchPipeline:
+    """流水线式批处理：水印判断 → 去水印 → 扩图 → 放大
+
+    每个阶段是一组独立的 worker，阶段之间用有界队列连接，
+    因此第 N+1 张图片在做水印判断时，第 N 张图片可以同时在 ComfyUI 上处理。
+    送入流水线前按文件头估算每张图片的解码内存，在途总量不超过 memory_budget（字节）。
+    """
+
+    def __init__(self, concurrency=None, stages=None, journal=None, memory_budget=None):
+        self.concurrency = dict(DEFAULT_CONCURRENCY)
+        self.concurrency.update(concurrency or {})
+        self.stages = stages or STAGES
+        self.journal = journal  # 批处理日志，用于崩溃后恢复
+        if memory_budget is None:
+            memory_budget = ADMISSION_MEMORY_BUDGET_MB * 2 ** 20
+        self.budget = MemoryBudget(memory_budget) if memory_budget else None
+
+    def prepare_job(self, job, record):
+        """按日志恢复任务，并把后续的阶段与 prompt_id 记录到日志"""
+        if self.journal is None or job.done:
+            return
+        resumed = record is not None and self.journal.restore(job, record, [name for name, _ in self.stages])
+        if job.done:
+            print(f"已在上次运行中完成，跳过: {job.source_path}")
+            return
+        if resumed:
+            print(f"从上次中断处继续: {job.source_path}，已完成阶段 {sorted(job.completed)}")
+        self.journal.image_started(job, resumed=resumed)
+        job.on_submit = lambda stage, host, prompt_id: self.journal_write("prompt_submitted", job, stage, host, prompt_id)
+
+    def journal_write(self, method, *args):
+        """写批处理日志；日志出错只打印，不影响图片处理，也不能让 worker 退出导致队列无法排空"""
+        try:
+            getattr(self.journal, method)(*args)
+        except Exception as e:
+            print(f"写入批处理日志失败（{method}）: {e}")
+
+    @staticmethod
+    def make_job(item, index):
+        """由图片路径或处理计划条目创建任务；计划中跳过的图片直接结束"""
+        if not isinstance(item, PlanEntry):
+            return ImageJob(item, index)
+        job = ImageJob(item.path, index)
+        job.width, job.height = item.width, item.height
+        if item.error:
+            job.finish(error=item.error)
+        elif item.skip_reason:
+            job.finish(skip_reason=item.skip_reason)
+        return job
+
+    @staticmethod
+    def memory_cost(item, job):
+        """已结束的图片不占预算；只给了路径时读取文件头生成计划再估算"""
+        if job.done:
+            return 0
+        entry = item
+        if not isinstance(item, PlanEntry):
+            try:
+                entry = plan_image(job.source_path, *get_image_size(job.source_path), skip_compliant=False)
+            except Exception:
+                return 0  # 读不了文件头的图片在 check 阶段直接失败
+        return estimate_cost(entry)
+
+    async def run(self, items, on_result=None, cancel=None):
+        """处理一批图片
+
+        Args:
+            items (list[str | PlanEntry]): 图片路径或 planner 生成的计划条目
+            on_result (callable): 每张图片处理结束时回调 on_result(job)
+            cancel (threading.Event): 置位后不再处理新图片，已进入流水线的图片处理完后返回；
+                未处理的图片标记为“已取消”，下次处理同一文件夹时会重新处理
+
+        Returns:
+            list[ImageJob]: 与输入顺序一致的处理结果
+        """
+        jobs = [self.make_job(item, index) for index, item in enumerate(items)]
+        records = self.journal.load() if self.journal is not None else {}
+        for job in jobs:
+            self.prepare_job(job, records.get(job.source_path))
+        # queues[i] 是第 i 个阶段的输入，最后一个队列收集结果
+        queues = [asyncio.Queue(maxsize=self.concurrency.get(name, 1) * 2) for name, _ in self.stages]
+        queues.append(asyncio.Queue())
+
+        async def stage_worker(index, name, stage):
+            inbox, outbox = queues[index], queues[index + 1]
+            while True:
+                job = await inbox.get()
+                try:
+                    track = self.journal is not None and not job.done and name not in job.completed
+                    completed = set(job.completed)
+                    if track:
+                        self.journal_write("stage_started", job, name)
+                    await run_stage(job, name, stage)
+                    if track:
+                        self.journal_write("stage_finished", job, name)
+                        # 与本阶段合并执行的后续阶段也记为完成，恢复时不会再重新判断
+                        for fused, _ in self.stages:
+                            if fused == name or fused in completed or fused not in job.completed:
+                                continue
+                            self.journal_write("stage_started", job, fused)
+                            self.journal_write("stage_finished", job, fused)
+                    await outbox.put(job)
+                finally:
+                    inbox.task_done()
+
+        async def collector():
+            results = queues[-1]
+            while True:
+                job = await results.get()
+                try:
+                    if not job.done:
+                        job.finish()
+                    if self.budget is not None:
+                        self.budget.release(job.memory_cost)
+                    tracing.image_finished(job)
+                    if self.journal is not None:
+                        self.journal_write("image_finished", job)
+                    if on_result:
+                        try:
+                            on_result(job)
+                        except Exception as e:
+                            print(f"结果回调出错: {e}")
+                finally:
+                    results.task_done()
+
+        workers = [asyncio.create_task(collector())]
+        for index, (name, stage) in enumerate(self.stages):
+            for _ in range(max(1, self.concurrency.get(name, 1))):
+                workers.append(asyncio.create_task(stage_worker(index, name, stage)))
+
+        try:
+            for item, job in zip(items, jobs):
+                if cancel is not None and cancel.is_set() and not job.done:
+                    # 已取消的图片直接穿过各阶段，结果回调仍会收到
+                    job.finish(error="已取消")
+                if self.budget is not None:
+                    if isinstance(item, PlanEntry):
+                        job.memory_cost = self.memory_cost(item, job)
+                    else:
+                        job.memory_cost = await asyncio.to_thread(self.memory_cost, item, job)
+                    # 等待在途图片释放内存预算
+                    await self.budget.acquire(job.memory_cost)
+                    if cancel is not None and cancel.is_set() and not job.done:
+                        job.finish(error="已取消")
+                await queues[0].put(job)
+            # 按阶段顺序等待队列排空：前一阶段 join 完成时，其全部输出都已进入下一个队列
+            for queue in queues:
+                await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        if self.budget is not None and self.budget.peak:
+            print(f"内存预算：峰值在途估算 {self.budget.peak / 2 ** 20:.0f}MB / {self.budget.budget / 2 ** 20:.0f}MB")
+        return jobs
+
+
+async def process_images(items, concurrency=None, on_result=None, journal=None, cancel=None):
+    try:
+        return await BatchPipeline(concurrency, journal=journal).run(items, on_result=on_result, cancel=cancel)
+    finally:
+        await close_client()
+        await close_vlm_client()
+        if journal is not None:
+            await asyncio.to_thread(journal.close)
@@ -0,0 +1,185 @@
+import argparse
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from local_engine import extend_route, scale_route
+from service import MIN_WIDTH, calculate_extension, calculate_scale, get_image_size
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# 各阶段的单张 GPU 耗时估计（秒），按实际机器调整
+STAGE_COST_SECONDS = {
+    "check": float(os.getenv("PLAN_CHECK_SECONDS", "0.5")),
+    "remove": float(os.getenv("PLAN_REMOVE_SECONDS", "20")),
+    "extend": float(os.getenv("PLAN_EXTEND_SECONDS", "30")),
+    "scale": float(os.getenv("PLAN_SCALE_SECONDS", "15")),
+}
+# 预计有水印的图片比例（去水印阶段要等检测后才能确定）
+WATERMARK_RATE = float(os.getenv("PLAN_WATERMARK_RATE", "0.3"))
+
+CSV_FIELDS = ["path", "width", "height", "stages", "left", "right", "top", "bottom", "scale_by", "routes",
+              "estimated_seconds", "skip_reason", "error"]
+
+
+class PlanEntry:
+    """一张图片的处理计划"""
+
+    def __init__(self, path, width=None, height=None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.stages = []  # 需要执行的阶段，remove 表示“检测到水印时执行”
+        self.left = self.right = self.top = self.bottom = 0
+        self.scale_by = None
+        self.routes = {}  # 阶段名 -> 执行位置 local/comfyui
+        self.estimated_seconds = 0.0
+        self.skip_reason = None
+        self.error = None
+
+    @property
+    def skipped(self):
+        return self.skip_reason is not None or self.error is not None
+
+    def to_dict(self):
+        return {
+            "path": self.path,
+            "width": self.width,
+            "height": self.height,
+            "stages": list(self.stages),
+            "left": self.left,
+            "right": self.right,
+            "top": self.top,
+            "bottom": self.bottom,
+            "scale_by": self.scale_by,
+            "routes": dict(self.routes),
+            "estimated_seconds": round(self.estimated_seconds, 2),
+            "skip_reason": self.skip_reason,
+            "error": self.error,
+        }
+
+
+def plan_image(path, width, height, skip_compliant=True):
+    """根据图片尺寸决定需要的阶段、扩图像素和放大倍数"""
+    entry = PlanEntry(path, width, height)
+    if width < MIN_WIDTH:
+        entry.skip_reason = "分辨率过低"
+        return entry
+
+    entry.left, entry.right, entry.top, entry.bottom = calculate_extension(width, height)
+    new_width = width + entry.left + entry.right
+    new_height = height + entry.top + entry.bottom
+    entry.scale_by = calculate_scale(new_width, new_height)
+    needs_extend = any((entry.left, entry.right, entry.top, entry.bottom))
+
+    if skip_compliant and not needs_extend and entry.scale_by is None:
+        # 已是 9:16 且不低于 1080x1920，连水印检测也跳过
+        entry.skip_reason = "已符合目标尺寸"
+        return entry
+
+    entry.stages = ["check", "remove"]
+    entry.estimated_seconds = STAGE_COST_SECONDS["check"] + WATERMARK_RATE * STAGE_COST_SECONDS["remove"]
+    # 本地快速处理的阶段不占用 GPU
+    if needs_extend:
+        entry.stages.append("extend")
+        local, _ = extend_route(width, height, entry.left, entry.right, entry.top, entry.bottom)
+        entry.routes["extend"] = "local" if local else "comfyui"
+        if not local:
+            entry.estimated_seconds += STAGE_COST_SECONDS["extend"]
+    if entry.scale_by is not None:
+        entry.stages.append("scale")
+        local, _ = scale_route(new_width, new_height)
+        entry.routes["scale"] = "local" if local else "comfyui"
+        if not local:
+            entry.estimated_seconds += STAGE_COST_SECONDS["scale"]
+    return entry
+
+
+def _plan_path(path, skip_compliant):
+    try:
+        # Image.open 只解析文件头，不解码像素
+        width, height = get_image_size(path)
+    except Exception as e:
+        entry = PlanEntry(path)
+        entry.error = f"无法读取图片: {e}"
+        return entry
+    return plan_image(path, width, height, skip_compliant)
+
+
+class Plan:
+    """一个文件夹的处理计划"""
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    @property
+    def pending(self):
+        """需要处理的图片"""
+        return [entry for entry in self.entries if not entry.skipped]
+
+    @property
+    def skipped(self):
+        return [entry for entry in self.entries if entry.skipped]
+
+    @property
+    def estimated_seconds(self):
+        return sum(entry.estimated_seconds for entry in self.entries)
+
+    def summary(self):
+        counts = {stage: 0 for stage in STAGE_COST_SECONDS}
+        for entry in self.pending:
+            for stage in entry.stages:
+                counts[stage] += 1
+        return (f"共 {len(self.entries)} 张图片，需处理 {len(self.pending)} 张，跳过 {len(self.skipped)} 张；"
+                f"水印检测 {counts['check']}，扩图 {counts['extend']}，放大 {counts['scale']}；"
+                f"预计 GPU 耗时 {self.estimated_seconds / 60:.1f} 分钟"
+                f"（按 {WATERMARK_RATE:.0%} 图片需要去水印估算）")
+
+    def to_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "estimated_seconds": round(self.estimated_seconds, 2),
+                "stage_cost_seconds": STAGE_COST_SECONDS,
+                "watermark_rate": WATERMARK_RATE,
+                "entries": [entry.to_dict() for entry in self.entries],
+            }, f, ensure_ascii=False, indent=2)
+
+    def to_csv(self, path):
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            for entry in self.entries:
+                row = entry.to_dict()
+                row["stages"] = "|".join(row["stages"])
+                row["routes"] = "|".join(f"{stage}:{route}" for stage, route in row["routes"].items())
+                writer.writerow(row)
+
+
+def list_images(folder_path):
+    return sorted(os.path.join(folder_path, f) for f in os.listdir(folder_path)
+                  if f.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def scan_folder(folder_path, skip_compliant=True, workers=None):
+    """并行读取文件夹中所有图片的文件头并生成处理计划"""
+    paths = list_images(folder_path)
+    with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 4)) as executor:
+        entries = list(executor.map(lambda path: _plan_path(path, skip_compliant), paths))
+    return Plan(entries)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="扫描图片文件夹并生成处理计划（不调用任何模型）")
+    parser.add_argument("folder", help="图片文件夹路径")
+    parser.add_argument("--csv", help="导出 CSV 的路径")
+    parser.add_argument("--json", help="导出 JSON 的路径")
+    parser.add_argument("--keep-compliant", action="store_true", help="已符合目标尺寸的图片也做水印检测")
+    args = parser.parse_args()
+
+    plan = scan_folder(args.folder, skip_compliant=not args.keep_compliant)
+    print(plan.summary())
+    if args.csv:
+        plan.to_csv(args.csv)
+    if args.json:
+        plan.to_json(args.json)
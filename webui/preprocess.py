@@ -0,0 +1,108 @@
+import io
+import math
+import os
+
+from PIL import Image
+
+# Janus-Pro 视觉编码器输入为 384x384（长边缩放到 384 后补成正方形），发送更大的图片没有意义
+VLM_INPUT_SIZE = int(os.getenv("VLM_INPUT_SIZE", "384"))
+# off：发送原图；full：只发送缩小后的整图；corners：整图 + 四角放大拼图（避免角落的小水印被缩没）
+VLM_CROP_POLICY = os.getenv("VLM_CROP_POLICY", "corners")
+# 四角裁剪区域占宽/高的比例
+VLM_CORNER_FRACTION = float(os.getenv("VLM_CORNER_FRACTION", "0.25"))
+# 超过该像素数的图片走降级路径：不做四角拼图，只按模型输入分辨率解码整图（JPEG 即 draft 模式的最小解码）
+VLM_DRAFT_PIXELS = int(os.getenv("VLM_DRAFT_PIXELS", "40000000"))
+
+
+def open_reduced(image_path, max_side):
+    """按长边不小于 max_side 打开图片
+
+    JPEG 使用 draft 模式在 DCT 阶段直接按 1/2、1/4、1/8 缩小解码，几乎不解码全尺寸像素。
+    """
+    img = Image.open(image_path)
+    width, height = img.size
+    ratio = max_side / max(width, height)
+    if ratio < 1:
+        img.draft("RGB", (math.ceil(width * ratio), math.ceil(height * ratio)))
+    return img.convert("RGB")
+
+
+def shrink(img, max_side):
+    """把长边缩小到 max_side（reducing_gap 先做整数倍快速缩小再精细重采样）"""
+    img = img.copy()
+    img.thumbnail((max_side, max_side), Image.Resampling.BICUBIC, reducing_gap=2.0)
+    return img
+
+
+def corner_mosaic(img, max_side, fraction=VLM_CORNER_FRACTION):
+    """把四个角的区域拼成 2x2 拼图，长边为 max_side"""
+    width, height = img.size
+    crop_w, crop_h = max(1, int(width * fraction)), max(1, int(height * fraction))
+    boxes = [
+        (0, 0, crop_w, crop_h),
+        (width - crop_w, 0, width, crop_h),
+        (0, height - crop_h, crop_w, height),
+        (width - crop_w, height - crop_h, width, height),
+    ]
+    scale = min(1.0, (max_side // 2) / max(crop_w, crop_h))
+    tile = (max(1, round(crop_w * scale)), max(1, round(crop_h * scale)))
+    mosaic = Image.new("RGB", (tile[0] * 2, tile[1] * 2))
+    for index, box in enumerate(boxes):
+        corner = img.crop(box).resize(tile, Image.Resampling.BICUBIC)
+        mosaic.paste(corner, ((index % 2) * tile[0], (index // 2) * tile[1]))
+    return mosaic
+
+
+def encode_jpeg(img, quality=90):
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def vlm_policy(width, height, policy=None):
+    """实际使用的裁剪策略：超大图片的 corners 降级为 full"""
+    policy = policy or VLM_CROP_POLICY
+    if policy == "corners" and width * height > VLM_DRAFT_PIXELS:
+        return "full"
+    return policy
+
+
+def vlm_decode_size(image_path, width, height, policy=None, max_side=None):
+    """prepare_vlm_images 实际解码出的像素尺寸（JPEG 按 draft 的 1/2、1/4、1/8 缩小），用于估算内存"""
+    policy = vlm_policy(width, height, policy)
+    if policy == "off":
+        return 0, 0  # 原始字节直接发送，不解码
+    max_side = max_side or VLM_INPUT_SIZE
+    if policy == "corners":
+        max_side = int(max_side / VLM_CORNER_FRACTION / 2)
+    ratio = max_side / max(width, height)
+    if ratio >= 1 or not image_path.lower().endswith((".jpg", ".jpeg")):
+        return width, height
+    # 与 JpegImageFile.draft 的取值一致
+    reduce = min(width // math.ceil(width * ratio), height // math.ceil(height * ratio))
+    scale = next(s for s in (8, 4, 2, 1) if reduce >= s)
+    return math.ceil(width / scale), math.ceil(height / scale)
+
+
+def prepare_vlm_images(image_path, max_side=None, policy=None, size=None):
+    """生成发送给视觉模型的图片数据
+
+    Args:
+        size (tuple): 已知的 (宽, 高)，超过 VLM_DRAFT_PIXELS 时走降级路径
+
+    Returns:
+        list[bytes]: 需要逐一检测的图片，任意一张检测到水印即认为有水印
+    """
+    max_side = max_side or VLM_INPUT_SIZE
+    policy = vlm_policy(*size, policy) if size else policy or VLM_CROP_POLICY
+    if policy == "off":
+        with open(image_path, "rb") as f:
+            return [f.read()]
+
+    if policy == "corners":
+        # 四角拼图中每个角只占一半边长，需要更高的解码分辨率
+        img = open_reduced(image_path, int(max_side / VLM_CORNER_FRACTION / 2))
+        return [encode_jpeg(shrink(img, max_side)), encode_jpeg(corner_mosaic(img, max_side))]
+
+    img = open_reduced(image_path, max_side)
+    return [encode_jpeg(shrink(img, max_side))]
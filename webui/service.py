@@ -1,28 +1,30 @@
 import asyncio
-import base64
-import json
 import os
+import time
 
-import websockets
+from comfyui_client import tracing
+from comfyui_client.call_workflow import (remove_watermark, extend_image, scale_image, run_fused_workflow,
+                                          download_server_image, result_cache, ServerImage)
+from local_engine import (EXTEND_IMAGE_DIR, SCALE_IMAGE_DIR, extend_locally, extend_route, scale_locally,
+                          scale_route)
+from preprocess import prepare_vlm_images
+from vlm_client import VLMPool
 
-from comfyui_client.call_workflow import remove_watermark, extend_image, scale_image
 
+# 全局视觉模型客户端：长连接复用，所有图片共用；VLM_MODEL_WS_HOST 可以是逗号分隔的多个实例
+vlm_client = VLMPool(os.getenv("VLM_MODEL_WS_HOST"))
 
-async def check_water_mark_image(payload):
-    uri = os.getenv("VLM_MODEL_WS_HOST")
-    try:
-        async with websockets.connect(uri) as ws:
-            print("已连接到MCP服务器")
-            await ws.send(json.dumps(payload))
-            response = await ws.recv()
-            print("来自服务器的响应:")
-            print(json.dumps(json.loads(response), indent=2, ensure_ascii=False))
-            if json.loads(response).get("water_mark").lower() == "y":
-                return True
-            return False
 
-    except Exception as e:
-        print(f"WebSocket错误: {e}")
+async def check_water_mark_image(image):
+    """检测图片是否有水印，返回 CheckResult"""
+    result = await vlm_client.check(image)
+    tracing.record("vlm_round_trip", result.latency)
+    print(f"水印检测结果: {result}")
+    return result
+
+
+async def close_vlm_client():
+    await vlm_client.close()
 
 
 from PIL import Image
@@ -74,9 +76,26 @@ def calculate_extension(width, height):
         # 宽等于高，无需扩展
         left = right = top = bottom = 0
 
+    if min(left, right, top, bottom) < 0:
+        # 与 9:16 只差整数取整误差（如 1040x1849），无需扩展
+        return 0, 0, 0, 0
     return left, right, top, bottom
 
 
+# 最小可处理宽度与目标输出分辨率
+MIN_WIDTH = 400
+TARGET_WIDTH = 1080
+TARGET_HEIGHT = 1920
+
+
+def calculate_scale(width, height):
+    """9:16 图片分辨率不足 1080x1920 时返回放大工作流的 scale_by，否则返回 None"""
+    if width >= TARGET_WIDTH and height >= TARGET_HEIGHT:
+        return None
+    # 计算放大倍数 1080/new_width/4
+    return TARGET_WIDTH / width / 4
+
+
 def get_image_size(image_path):
     """
     获取图片的尺寸。
@@ -91,52 +110,269 @@ def get_image_size(image_path):
         return img.size
 
 
-async def sync_process_image(image_path):
-    if not image_path or not os.path.exists(image_path):
-        print("无效的图片路径")
+class ImageJob:
+    """一张图片在处理流程中的状态，按阶段逐步更新"""
+
+    def __init__(self, source_path, index=0):
+        self.index = index
+        self.source_path = source_path
+        self.image_path = source_path  # 当前阶段的输入/输出图片
+        self.width = None
+        self.height = None
+        self.has_water_mark = None
+        self.stages = []  # 实际执行过的阶段
+        self.routes = {}  # 阶段名 -> (执行位置 local/comfyui, 原因)
+        self.timings = {}  # 阶段名 -> 耗时（秒）
+        self.spans = []  # 阶段内各步骤的耗时：(阶段名, 步骤名, 秒)，见 comfyui_client.tracing
+        self.skip_reason = None
+        self.error = None
+        self.done = False
+        self.completed = set()  # 已完成的阶段：从批处理日志恢复，或已与前面的阶段合并执行
+        self.prompts = {}  # 阶段名 -> 重启前已提交的 (节点地址, prompt_id)
+        self.on_submit = None  # 提交到 ComfyUI 后的回调 on_submit(阶段名, 节点地址, prompt_id)
+        self.memory_cost = 0  # 批处理内存预算中占用的估算字节数，见 admission.estimate_cost
+
+    @property
+    def ok(self):
+        return self.done and self.error is None
+
+    @property
+    def output_path(self):
+        return self.image_path if self.ok else None
+
+    def comfyui_options(self, stage):
+        """提交 ComfyUI 任务时的恢复参数：重新接上之前的任务，并在提交后通知日志"""
+        def on_submit(host, prompt_id):
+            if self.on_submit:
+                self.on_submit(stage, host, prompt_id)
+        return {"attach": self.prompts.pop(stage, None), "on_submit": on_submit}
+
+    def finish(self, skip_reason=None, error=None):
+        self.skip_reason = skip_reason
+        self.error = error
+        self.done = True
+
+
+async def check_stage(job):
+    """校验图片并用视觉模型判断是否有水印"""
+    if not job.image_path or not os.path.exists(job.image_path):
+        job.finish(error="无效的图片路径")
+        return
+    if job.width is None:
+        job.width, job.height = get_image_size(job.image_path)
+    if job.width < MIN_WIDTH:
+        print(f"图片宽度 {job.width} 小于 {MIN_WIDTH}，分辨率过低，跳过处理")
+        job.finish(skip_reason="分辨率过低")
+        return
+    # 缩小到视觉模型输入分辨率（可附带四角拼图，超大图片只解码整图），任意一张检测到水印即认为有水印
+    with tracing.span("vlm_encode"):
+        images = await asyncio.to_thread(prepare_vlm_images, job.image_path, size=(job.width, job.height))
+    results = await asyncio.gather(*[check_water_mark_image(image) for image in images])
+    errors = [result.error for result in results if not result.ok]
+    if errors:
+        raise Exception(errors[0])
+    job.has_water_mark = any(result.has_water_mark for result in results)
+
+
+async def remove_stage(job):
+    if not job.has_water_mark:
+        return
+    print("检测到水印，正在去水印...")
+    if await fused_stage(job, "remove"):
+        return
+    # 去水印不改变尺寸
+    keep = keep_on_server(job, "extend", job.width, job.height)
+    image_path = await remove_watermark(job.image_path, keep_on_server=keep, **job.comfyui_options("remove"))
+    if not image_path:
+        raise Exception("去水印失败")
+    set_image(job, image_path, (job.width, job.height))
+    job.stages.append("remove")
+
+
+async def extend_stage(job):
+    left, right, top, bottom = calculate_extension(job.width, job.height)
+    if left == 0 and right == 0 and top == 0 and bottom == 0:
+        return
+    print(f"图片需扩图，宽: {job.width}, 高: {job.height}, 左: {left}, 右: {right}, 上: {top}, 下: {bottom}")
+    if await fused_stage(job, "extend"):
+        return
+    local, reason = extend_route(job.width, job.height, left, right, top, bottom)
+    job.routes["extend"] = ("local" if local else "comfyui", reason)
+    size = (job.width + left + right, job.height + top + bottom)
+    if local:
+        source = await local_image_path(job, EXTEND_IMAGE_DIR)
+        with tracing.span("local_extend"):
+            image_path = await asyncio.to_thread(extend_locally, source, left, right, top, bottom)
+    else:
+        keep = keep_on_server(job, "scale", *size)
+        image_path = await extend_image(job.image_path, left, right, top, bottom, keep_on_server=keep,
+                                        **job.comfyui_options("extend"))
+    if not image_path:
+        raise Exception("扩图失败")
+    set_image(job, image_path, size)
+    job.stages.append("extend")
+    print(f"扩图后尺寸: {job.width}x{job.height}")
+
+
+async def scale_stage(job):
+    scale_num = calculate_scale(job.width, job.height)
+    if scale_num is None:
         return
-    width, height = get_image_size(image_path)
-    if width < 400:
-        print(f"图片宽度 {width} 小于 400，分辨率过低，跳过处理")
-        return image_path  # 或根据需求返回 None 或抛出提示
-    # 读取图片并转为 base64
-    with open(image_path, "rb") as f:
-        image_base64 = base64.b64encode(f.read()).decode("utf-8")
-    payload = {
-        "tool": "image_understanding",
-        "image_base64": image_base64,
-    }
-    if await check_water_mark_image(payload):
-        print("检测到水印，正在去水印...")
-        image_path = remove_watermark(image_base64)
-
-        # 更新 base64 和尺寸
-        with open(image_path, "rb") as f:
-            image_base64 = base64.b64encode(f.read()).decode("utf-8")
-        width, height = get_image_size(image_path)
+    print("图片尺寸不足 1080x1920，正在进行放大...")
+    local, reason = scale_route(job.width, job.height)
+    job.routes["scale"] = ("local" if local else "comfyui", reason)
+    if local:
+        source = await local_image_path(job, SCALE_IMAGE_DIR)
+        with tracing.span("local_scale"):
+            image_path = await asyncio.to_thread(scale_locally, source)
+    else:
+        image_path = await scale_image(job.image_path, scale_num, **job.comfyui_options("scale"))
+    if not image_path:
+        raise Exception("放大失败")
+    set_image(job, image_path)
+    job.stages.append("scale")
+
+
+# 连续多个 ComfyUI 阶段合并成一次提交，COMFYUI_FUSE=0 关闭
+COMFYUI_FUSE = os.getenv("COMFYUI_FUSE", "1") != "0"
+FUSABLE_STAGES = ("remove", "extend", "scale")
+# 分开提交时，下一阶段也在 ComfyUI 上执行的中间结果留在服务器上直接引用，COMFYUI_KEEP_INTERMEDIATE=0 关闭。
+# 服务器上的结果没有本地内容可算哈希、也不会写入结果缓存，启用结果缓存（COMFYUI_CACHE，默认开启）时不保留，
+# 否则重复处理同一文件夹时链上的每个阶段都要重新执行；合并提交（COMFYUI_FUSE）时连续的 ComfyUI 阶段已在
+# 一次提交中完成。因此只有 COMFYUI_CACHE=0 且 COMFYUI_FUSE=0 时才实际生效，见 Readme.md
+COMFYUI_KEEP_INTERMEDIATE = os.getenv("COMFYUI_KEEP_INTERMEDIATE", "1") != "0" and result_cache is None
+
+
+def comfyui_chain(job, start):
+    """从 start 阶段开始，预测后续连续在 ComfyUI 上执行的阶段及其参数
+
+    去水印不改变尺寸，扩图后尺寸为原尺寸加扩展像素；遇到本地处理或不需要的阶段即停止。
+
+    Returns:
+        list: [(阶段名, 参数), ...]
+    """
+    width, height = job.width, job.height
+    chain = []
+    for name in FUSABLE_STAGES[FUSABLE_STAGES.index(start):]:
+        if name == "remove":
+            if job.has_water_mark:
+                chain.append(("remove", {}))
+            continue
+        if name == "extend":
+            left, right, top, bottom = calculate_extension(width, height)
+            if not any((left, right, top, bottom)):
+                continue
+            local, _ = extend_route(width, height, left, right, top, bottom)
+            if local:
+                break
+            chain.append(("extend", {"left": left, "right": right, "top": top, "bottom": bottom}))
+            width, height = width + left + right, height + top + bottom
+            continue
+        scale_num = calculate_scale(width, height)
+        if scale_num is None or scale_route(width, height)[0]:
+            break
+        chain.append(("scale", {"scale_by": scale_num}))
+    return chain
+
+
+async def fused_stage(job, start):
+    """后续有多个 ComfyUI 阶段时合并为一次提交执行，返回是否已执行
+
+    合并执行的阶段都记为已完成，后续阶段直接跳过而不按结果尺寸重新判断
+    （放大按倍数取整，例如 500x888 放大后为 1080x1918，重新判断会多做一次扩图）。
+    """
+    if not COMFYUI_FUSE:
+        return False
+    chain = comfyui_chain(job, start)
+    if len(chain) < 2 or chain[0][0] != start:
+        return False
+    names = [name for name, _ in chain]
+    print(f"合并执行 ComfyUI 阶段: {' -> '.join(names)}")
+    image_path = await run_fused_workflow(job.image_path, chain, **job.comfyui_options(start))
+    if not image_path:
+        raise Exception(f"合并执行 {'+'.join(names)} 失败")
+    set_image(job, image_path)
+    for name, _ in chain:
+        job.routes[name] = ("comfyui", f"与 {'+'.join(names)} 合并为一次提交")
+        job.stages.append(name)
+        job.completed.add(name)
+    return True
+
+
+def keep_on_server(job, next_stage, width, height):
+    """下一个需要执行的阶段也在 ComfyUI 上时，本阶段结果留在服务器上"""
+    if not COMFYUI_KEEP_INTERMEDIATE:
+        return False
+    current = (job.width, job.height)
+    job.width, job.height = width, height
+    try:
+        return bool(comfyui_chain(job, next_stage))
+    finally:
+        job.width, job.height = current
+
+
+def set_image(job, image_path, size=None):
+    """更新当前图片；留在服务器上的结果无法读取文件头，使用预测的尺寸"""
+    job.image_path = image_path
+    if isinstance(image_path, ServerImage):
+        job.width, job.height = size
     else:
-        width, height = get_image_size(image_path)
+        job.width, job.height = get_image_size(image_path)
+
+
+async def local_image_path(job, output_dir):
+    """本地处理前，把留在服务器上的中间结果下载下来"""
+    if isinstance(job.image_path, ServerImage):
+        image_path = await download_server_image(job.image_path, output_dir)
+        if not image_path:
+            raise Exception(f"下载中间结果失败: {job.image_path}")
+        job.image_path = image_path
+    return job.image_path
 
-    left, right, top, bottom = calculate_extension(width, height)
-    if left != 0 or right != 0 or top != 0 or bottom != 0:
-        print(f"图片需扩图，宽: {width}, 高: {height}, 左: {left}, 右: {right}, 上: {top}, 下: {bottom}")
-        image_path = await extend_image(image_base64, left, right, top, bottom)
-        width, height = get_image_size(image_path)
 
-    new_width = width + left + right
-    new_height = height + top + bottom
+# 处理顺序：去水印 --> 改尺寸（扩图） --> 放大
+STAGES = [
+    ("check", check_stage),
+    ("remove", remove_stage),
+    ("extend", extend_stage),
+    ("scale", scale_stage),
+]
 
-    print(f"扩图后尺寸: {new_width}x{new_height}")
 
-    if new_width < 1080 or new_height < 1920:
-        print("图片尺寸不足 1080x1920，正在进行放大...")
-        # 计算放大倍数 1080/new_width/4
-        scale_num = 1080 / new_width / 4
-        with open(image_path, "rb") as f:
-            image_base64 = base64.b64encode(f.read()).decode("utf-8")
-        image_path = await scale_image(image_base64, scale_num)
+async def run_stage(job, name, stage):
+    """执行单个阶段并记录耗时；失败时标记该图片结束，不抛出"""
+    if job.done or name in job.completed:
+        return
+    start = time.perf_counter()
+    try:
+        with tracing.stage(job.spans, name):
+            await stage(job)
+    except Exception as e:
+        print(f"{name} 阶段处理失败 {job.source_path}: {e}")
+        tracing.STAGE_ERRORS_TOTAL.labels(name).inc()
+        job.finish(error=f"{name}: {e}")
+    finally:
+        job.timings[name] = time.perf_counter() - start
+
 
-    print(f"最终输出图片路径: {image_path}")
+async def process_image_job(image_path):
+    """逐阶段处理单张图片，返回 ImageJob（包含各阶段耗时与结果）"""
+    job = ImageJob(image_path)
+    for name, stage in STAGES:
+        await run_stage(job, name, stage)
+    if not job.done:
+        job.finish()
+    tracing.image_finished(job)
+    return job
+
+
+async def sync_process_image(image_path):
+    job = await process_image_job(image_path)
+    if job.error:
+        print(job.error)
+        return None
+    print(f"最终输出图片路径: {job.image_path}")
+    return job.image_path
 
 
 if __name__ == '__main__':
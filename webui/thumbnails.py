@@ -0,0 +1,164 @@
+import hashlib
+import math
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PIL import Image
+
+from preprocess import open_reduced
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 缩略图缓存目录，文件名由原图路径 + 修改时间 + 大小的哈希决定，原图变化后自动生成新的缩略图
+THUMBNAIL_DIR = os.getenv("THUMBNAIL_DIR", os.path.join(ROOT_DIR, "comfyui_client", "thumbnails"))
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "256"))
+GALLERY_PAGE_SIZE = int(os.getenv("GALLERY_PAGE_SIZE", "40"))
+# 缩略图缓存的总大小上限（MB），超出后按最近使用时间删除最旧的缩略图，0 表示不限制
+THUMBNAIL_MAX_MB = int(os.getenv("THUMBNAIL_MAX_MB", "512"))
+# 每新生成多少张缩略图检查一次缓存大小
+THUMBNAIL_PRUNE_EVERY = 200
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+_executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix="thumbnail")
+
+
+def list_images(directory):
+    """列出目录中的图片，最新的在前；只读目录项，不打开图片
+
+    Returns:
+        list: [(路径, os.stat_result), ...]
+    """
+    if not os.path.exists(directory):
+        return []
+    with os.scandir(directory) as it:
+        entries = [(entry.path, entry.stat()) for entry in it
+                   if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS)]
+    entries.sort(key=lambda item: item[1].st_mtime_ns, reverse=True)
+    return entries
+
+
+def thumbnail_path(path, stat, size=THUMBNAIL_SIZE):
+    key = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{size}"
+    return os.path.join(THUMBNAIL_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".webp")
+
+
+def _render(path, thumb, size):
+    try:
+        img = open_reduced(path, size)
+        img.thumbnail((size, size), Image.Resampling.BICUBIC)
+        os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+        # 每次调用使用自己的临时文件再替换，避免并发请求读到写了一半的缩略图
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=THUMBNAIL_DIR)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                img.save(f, format="WEBP", quality=80)
+            os.replace(tmp, thumb)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return thumb
+    except Exception as e:
+        print(f"无法生成缩略图 {path}: {e}")
+        return None
+
+
+_inflight = {}  # 缩略图路径 -> Future，同一张缩略图同时只生成一次
+_inflight_lock = threading.Lock()
+_generated = 0
+
+
+def make_thumbnail(path, stat, size=THUMBNAIL_SIZE):
+    """生成（或直接返回已缓存的）WebP 缩略图路径；图片无法读取时返回 None
+
+    批处理完成时的预生成、翻页预取和当前页生成可能同时请求同一张缩略图，后来的调用等待第一个调用的结果。
+    """
+    global _generated
+    thumb = thumbnail_path(path, stat, size)
+    if os.path.exists(thumb):
+        try:
+            os.utime(thumb)  # 记录最近使用时间，清理时保留常用的缩略图
+        except OSError:
+            pass
+        return thumb
+    with _inflight_lock:
+        future = _inflight.get(thumb)
+        owner = future is None
+        if owner:
+            future = _inflight[thumb] = Future()
+    if not owner:
+        return future.result()
+    try:
+        result = _render(path, thumb, size)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+    finally:
+        with _inflight_lock:
+            del _inflight[thumb]
+            _generated += 1
+            prune_now = THUMBNAIL_MAX_MB and _generated % THUMBNAIL_PRUNE_EVERY == 0
+    if prune_now:
+        prune()
+    return result
+
+
+def prune(max_bytes=None):
+    """缩略图缓存超过上限时，按最近使用时间删除最旧的缩略图，返回删除的数量"""
+    max_bytes = THUMBNAIL_MAX_MB * 2 ** 20 if max_bytes is None else max_bytes
+    try:
+        with os.scandir(THUMBNAIL_DIR) as it:
+            entries = [(entry.path, entry.stat()) for entry in it
+                       if entry.is_file() and entry.name.endswith(".webp")]
+    except OSError:
+        return 0
+    total = sum(stat.st_size for _, stat in entries)
+    removed = 0
+    for path, stat in sorted(entries, key=lambda item: item[1].st_mtime_ns):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= stat.st_size
+        removed += 1
+    return removed
+
+
+def warm(path):
+    """后台预先生成缩略图（例如图片刚处理完时），不等待结果
+
+    Returns:
+        Future: 结果为缩略图路径（无法生成时为 None）；原图不存在时返回 None
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return _executor.submit(make_thumbnail, path, stat)
+
+
+def thumbnail_page(directory, page=1, page_size=GALLERY_PAGE_SIZE):
+    """读取目录中某一页图片的缩略图（并行生成缺失的缩略图）
+
+    Returns:
+        tuple: ([(缩略图路径, 文件名), ...], [原图路径, ...], 当前页, 总页数)
+    """
+    entries = list_images(directory)
+    pages = max(1, math.ceil(len(entries) / page_size))
+    page = min(max(1, int(page or 1)), pages)
+    selected = entries[(page - 1) * page_size:page * page_size]
+    thumbs = list(_executor.map(lambda item: make_thumbnail(*item), selected))
+    # 顺便在后台生成下一页，翻页时直接命中缓存
+    for item in entries[page * page_size:(page + 1) * page_size]:
+        _executor.submit(make_thumbnail, *item)
+    items, originals = [], []
+    for (path, _), thumb in zip(selected, thumbs):
+        if thumb:
+            items.append((thumb, os.path.basename(path)))
+            originals.append(path)
+    return items, originals, page, pages
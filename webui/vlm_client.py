@@ -0,0 +1,353 @@
+import asyncio
+import base64
+import itertools
+import json
+import os
+import time
+
+import websockets
+from loguru import logger
+
+
+class CheckResult:
+    """一次水印检测的结果"""
+
+    def __init__(self, has_water_mark=None, probability=None, error=None, latency=0.0, raw=None):
+        self.has_water_mark = has_water_mark
+        self.probability = probability
+        self.error = error
+        self.latency = latency
+        self.raw = raw
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.error:
+            return f"CheckResult(error={self.error!r})"
+        return f"CheckResult(has_water_mark={self.has_water_mark}, probability={self.probability}, " \
+               f"latency={self.latency:.3f})"
+
+
+class _Connection:
+    """一条到 VLM 服务的 websocket 连接，按 id 把响应分发给等待中的请求
+
+    旧版服务端的响应不带 id：只有一个请求在等待时交给它。single_flight=True 时同一时间只发一个请求，
+    请求超时或取消后丢弃这条连接，迟到的响应不会被当成下一个请求的结果。
+    """
+
+    def __init__(self, uri, single_flight=False):
+        self.uri = uri
+        self.single_flight = single_flight
+        self.ws = None
+        self.pending = {}  # id -> Future
+        self.inflight = 0  # 含正在建立连接的请求
+        self._reader = None
+        self._connect_lock = asyncio.Lock()
+        self._send_lock = asyncio.Lock()  # 消息头和二进制帧必须相邻发送
+        self._flight_lock = asyncio.Lock()  # single_flight 时从发送到收到响应一直持有
+        self._discard = False  # 连接上可能还有迟到的无 id 响应，下次请求前重连
+        self._closing = False
+
+    @property
+    def alive(self):
+        return self._reader is not None and not self._reader.done() and not self._discard
+
+    async def ensure_connected(self):
+        async with self._connect_lock:
+            if self.alive:
+                return
+            if self._discard:
+                await self.close()
+                self._discard = False
+            self.ws = await websockets.connect(self.uri, max_size=None)
+            self._reader = asyncio.create_task(self._read())
+            logger.info(f"已连接到视觉模型服务 {self.uri}")
+
+    async def _read(self):
+        try:
+            async for message in self.ws:
+                try:
+                    response = json.loads(message)
+                except ValueError:
+                    continue
+                request_id = response.get("id")
+                if request_id is None and len(self.pending) == 1:
+                    request_id = next(iter(self.pending))
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if not self._closing:
+                logger.warning(f"与视觉模型服务 {self.uri} 的连接已断开")
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("视觉模型服务连接断开"))
+            self.pending.clear()
+
+    async def request(self, request_id, payload, binary=None):
+        self.inflight += 1
+        try:
+            if not self.single_flight:
+                return await self._request(request_id, payload, binary)
+            async with self._flight_lock:
+                try:
+                    return await self._request(request_id, payload, binary)
+                except BaseException:
+                    self._discard = True
+                    raise
+        finally:
+            self.inflight -= 1
+
+    async def _request(self, request_id, payload, binary):
+        await self.ensure_connected()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            try:
+                async with self._send_lock:
+                    await self.ws.send(json.dumps(payload))
+                    if binary is not None:
+                        await self.ws.send(binary)
+            except Exception:
+                # 发送失败时读协程可能已给 future 设置了断线异常，取出以免告警
+                if future.done() and not future.cancelled():
+                    future.exception()
+                raise
+            return await future
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def close(self):
+        self._closing = True
+        if self.ws is not None:
+            await self.ws.close()
+        if self._reader is not None:
+            try:
+                await self._reader
+            except Exception:
+                pass
+        self.ws = None
+        self._reader = None
+        self._closing = False
+
+
+class VLMClient:
+    """常驻的视觉模型客户端
+
+    在少量长连接上复用并发的检测请求（按 id 匹配响应），断线自动重连，
+    服务端返回 busy 或连接断开时退避重试，每个请求都有超时。
+    服务端刚启动、模型仍在加载时（health 返回 loading）先等待就绪，等待时间不计入请求超时。
+    """
+
+    def __init__(self, uri, connections=None, timeout=None, max_retries=3, retry_backoff=0.5, protocol=None):
+        self.uri = uri
+        # 2：JSON 消息头 + 二进制帧；1：旧版 base64 JSON，用于未升级的服务端
+        # （旧版响应不带 id，每条连接同一时间只发一个请求）
+        self.protocol = protocol or int(os.getenv("VLM_PROTOCOL", "2"))
+        self.connections = connections or int(os.getenv("VLM_CONNECTIONS", "2"))
+        self.timeout = timeout or float(os.getenv("VLM_TIMEOUT", "120"))
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        # 等待服务端模型加载完成的上限（秒）
+        self.ready_timeout = float(os.getenv("VLM_READY_TIMEOUT", "900"))
+        self.ready_poll_interval = 2
+        self._ids = itertools.count(1)
+        self._loop = None
+        self._pool = []
+        self._ready = False
+        self._ready_lock = None
+
+    def _ensure_loop(self):
+        """事件循环变化时（例如每批一次 asyncio.run）重建连接"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._pool = [_Connection(self.uri, single_flight=self.protocol < 2) for _ in range(self.connections)]
+            self._ready = False
+            self._ready_lock = asyncio.Lock()
+
+    def _pick(self):
+        """选择在途请求最少的连接"""
+        return min(self._pool, key=lambda conn: conn.inflight)
+
+    async def check(self, image, timeout=None):
+        """检测图片是否有水印
+
+        Args:
+            image (bytes): 图片文件内容
+            timeout (float): 本次请求的超时（秒），包含重试
+
+        Returns:
+            CheckResult: 出错时 error 字段非空，不抛出异常
+        """
+        if not self.uri:
+            return CheckResult(error="未配置 VLM_MODEL_WS_HOST")
+        self._ensure_loop()
+        await self.wait_ready()
+        timeout = timeout or self.timeout
+        start = time.perf_counter()
+        try:
+            response = await self._request_with_retry(image, timeout)
+        except asyncio.TimeoutError:
+            return CheckResult(error=f"水印检测超时（{timeout} 秒）", latency=time.perf_counter() - start)
+        except Exception as e:
+            return CheckResult(error=f"水印检测失败: {e}", latency=time.perf_counter() - start)
+
+        latency = time.perf_counter() - start
+        if response.get("error"):
+            return CheckResult(error=str(response.get("message") or response["error"]), latency=latency,
+                               raw=response)
+        water_mark = str(response.get("water_mark", "")).strip().lower()
+        return CheckResult(has_water_mark=water_mark == "y", probability=response.get("probability"),
+                           latency=latency, raw=response)
+
+    async def wait_ready(self):
+        """服务端模型仍在加载时等待其就绪
+
+        Returns:
+            bool: 是否等待过服务端加载（False 表示已就绪、连不上或服务端不支持 health）
+        """
+        if self._ready and any(conn.alive for conn in self._pool):
+            return False
+        async with self._ready_lock:
+            if self._ready and any(conn.alive for conn in self._pool):
+                return False
+            deadline = time.monotonic() + self.ready_timeout
+            waited = False
+            while True:
+                request_id = next(self._ids)
+                try:
+                    state = await asyncio.wait_for(
+                        self._pick().request(request_id, {"tool": "health", "id": request_id}), 10)
+                except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+                    return False  # 连不上交给请求本身的重试与实例切换处理
+                # ready、failed，或不认识 health 的旧服务端都不再等待
+                if state.get("status") != "loading" or time.monotonic() >= deadline:
+                    self._ready = True
+                    if waited:
+                        logger.info(f"视觉模型服务 {self.uri} 已就绪")
+                    return waited
+                if not waited:
+                    logger.info(f"视觉模型服务 {self.uri} 正在加载模型，等待就绪...")
+                    waited = True
+                await asyncio.sleep(self.ready_poll_interval)
+
+    async def _request_with_retry(self, image, timeout):
+        """发送请求，busy 或连接断开时退避重试；超时包含重试，但不包含等待服务端重新加载模型的时间"""
+        image_base64 = base64.b64encode(image).decode("utf-8") if self.protocol < 2 else None
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        attempt = 0
+        while True:
+            request_id = next(self._ids)
+            if image_base64 is None:
+                payload = {"tool": "image_understanding", "id": request_id, "v": 2, "binary": True,
+                           "size": len(image)}
+                binary = image
+            else:
+                payload = {"tool": "image_understanding", "id": request_id, "image_base64": image_base64}
+                binary = None
+            try:
+                response = await asyncio.wait_for(self._pick().request(request_id, payload, binary),
+                                                  max(0.0, deadline - loop.time()))
+            except (OSError, websockets.WebSocketException) as e:
+                response = None
+                error = e
+                # 连接断开多半是服务端重启：等它加载完模型，等待时间不计入超时
+                self._ready = False
+                waiting_since = loop.time()
+                if await self.wait_ready():
+                    deadline += loop.time() - waiting_since
+                    continue
+            else:
+                if response.get("error") != "busy":
+                    return response
+                error = "服务繁忙"
+            attempt += 1
+            if attempt > self.max_retries:
+                if response is not None:
+                    return response
+                raise error
+            delay = self.retry_backoff * 2 ** (attempt - 1)
+            if loop.time() + delay >= deadline:
+                raise asyncio.TimeoutError()
+            logger.warning(f"水印检测请求失败（{error}），{delay:.1f} 秒后重试 {attempt}/{self.max_retries}")
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        for conn in self._pool:
+            await conn.close()
+
+
+class _Worker:
+    """连接池中的一个视觉模型实例及其负载、健康状态"""
+
+    def __init__(self, client):
+        self.client = client
+        self.outstanding = 0
+        self.failures = 0
+        self.unhealthy_until = 0.0
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.unhealthy_until
+
+
+class VLMPool:
+    """多个视觉模型实例之间的客户端路由
+
+    每个请求发给在途请求最少的健康实例；实例出错后暂时移出（cooldown 秒后再试），
+    并把请求换到其他实例重试。只有一个地址时与 VLMClient 行为一致。
+    """
+
+    def __init__(self, uris, cooldown=None, **client_kwargs):
+        if isinstance(uris, str) or uris is None:
+            uris = [uri.strip() for uri in (uris or "").split(",") if uri.strip()]
+        self.cooldown = cooldown or float(os.getenv("VLM_RETRY_COOLDOWN", "10"))
+        if len(uris) > 1:
+            # 有其他实例可换时，单个实例内部少重试，尽快切换
+            client_kwargs.setdefault("max_retries", 1)
+        self.workers = [_Worker(VLMClient(uri, **client_kwargs)) for uri in uris]
+
+    def _pick(self, tried):
+        candidates = [w for w in self.workers if w not in tried and w.healthy] or \
+                     [w for w in self.workers if w not in tried]
+        return min(candidates, key=lambda worker: worker.outstanding)
+
+    async def check(self, image, timeout=None):
+        """检测图片是否有水印，失败时换实例重试，返回 CheckResult"""
+        if not self.workers:
+            return CheckResult(error="未配置 VLM_MODEL_WS_HOST")
+        tried = []
+        result = None
+        while len(tried) < len(self.workers):
+            worker = self._pick(tried)
+            tried.append(worker)
+            worker.outstanding += 1
+            try:
+                result = await worker.client.check(image, timeout)
+            finally:
+                worker.outstanding -= 1
+            if result.ok:
+                worker.failures = 0
+                worker.unhealthy_until = 0.0
+                return result
+            if not (result.raw and result.raw.get("error") == "busy"):
+                # 繁忙只是暂时满载，不算故障
+                worker.failures += 1
+                worker.unhealthy_until = time.monotonic() + self.cooldown
+            if len(tried) < len(self.workers):
+                logger.warning(f"视觉模型实例 {worker.client.uri} 出错（{result.error}），换实例重试")
+        return result
+
+    def stats(self):
+        return [{"uri": w.client.uri, "healthy": w.healthy, "outstanding": w.outstanding,
+                 "failures": w.failures} for w in self.workers]
+
+    async def close(self):
+        for worker in self.workers:
+            await worker.client.close()
@@ -0,0 +1,259 @@
+"""监视文件夹（无界面）：新放入或内容变化的图片自动处理，结果写入输出目录
+
+    python watcher.py /mnt/share/incoming --output /mnt/share/processed
+
+有 watchdog 时使用系统文件事件（Linux 上为 inotify），否则按 WATCH_POLL_INTERVAL 轮询目录项。
+文件在 WATCH_SETTLE_SECONDS 内大小与修改时间都不再变化才开始处理，避免读到还没写完的文件。
+每张图片按 (修改时间, 大小) 记录在文件夹内的批处理日志中，重启后已处理过且未变化的图片不会重复处理。
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from loguru import logger
+from prometheus_client import Histogram
+
+from comfyui_client import tracing
+from comfyui_client.call_workflow import close_client
+from comfyui_client.result_cache import copy_atomic
+from journal import JOURNAL_NAME, Journal, file_signature
+from planner import IMAGE_EXTENSIONS
+from service import ImageJob, process_image_job, close_vlm_client
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # 没有 watchdog 时退回轮询
+    FileSystemEventHandler = object
+    Observer = None
+
+# 文件大小与修改时间保持不变多久后认为已写完（秒）
+WATCH_SETTLE_SECONDS = float(os.getenv("WATCH_SETTLE_SECONDS", "1.0"))
+# 轮询模式的扫描间隔；文件事件模式下也按 WATCH_RESCAN_INTERVAL 补扫一次，防止漏掉事件（秒）
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", "1.0"))
+WATCH_RESCAN_INTERVAL = float(os.getenv("WATCH_RESCAN_INTERVAL", "60"))
+# 同时处理的图片数
+WATCH_CONCURRENCY = int(os.getenv("WATCH_CONCURRENCY", "2"))
+
+WATCH_LATENCY_SECONDS = Histogram("ibp_watch_latency_seconds", "图片写完到结果写入输出目录的耗时",
+                                  buckets=tracing.BUCKETS)
+
+
+def is_candidate(name):
+    """只处理图片；忽略隐藏文件和常见的临时文件（上传中的 .part/.tmp 等不带图片扩展名）"""
+    return not name.startswith((".", "~")) and name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+class _EventHandler(FileSystemEventHandler):
+    """watchdog 回调在观察线程中执行，转交给事件循环"""
+
+    def __init__(self, watcher, loop):
+        self.watcher = watcher
+        self.loop = loop
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        path = getattr(event, "dest_path", None) or event.src_path
+        if os.path.dirname(os.path.abspath(path)) == self.watcher.folder:
+            self.loop.call_soon_threadsafe(self.watcher.touch, os.path.abspath(path))
+
+
+class FolderWatcher:
+    """监视一个文件夹，图片写完后逐张调用 process_image_job 处理"""
+
+    def __init__(self, folder, output_dir, settle=None, poll_interval=None, concurrency=None, use_events=True):
+        self.folder = os.path.abspath(folder)
+        self.output_dir = os.path.abspath(output_dir)
+        self.settle = WATCH_SETTLE_SECONDS if settle is None else settle
+        self.poll_interval = poll_interval or WATCH_POLL_INTERVAL
+        self.concurrency = concurrency or WATCH_CONCURRENCY
+        self.use_events = use_events and Observer is not None
+        self.journal = Journal(os.path.join(self.folder, JOURNAL_NAME))
+        self.handled = {}  # 路径 -> 已处理（或正在处理）的 (修改时间, 大小)
+        self.settling = {}  # 路径 -> (最近一次看到的 (修改时间, 大小), 该签名首次出现的时间)
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._tasks = set()
+        self._wakeup = asyncio.Event()
+
+    def load_history(self):
+        """已处理完成且文件未变化的图片不再处理；失败的图片重启后重试"""
+        for path, record in self.journal.load().items():
+            image = record["image"]
+            if image["status"] in ("done", "skipped"):
+                self.handled[path] = (image["mtime_ns"], image["size"])
+
+    def touch(self, path):
+        """文件事件或扫描发现文件变化：（重新）开始计算稳定时间"""
+        if not is_candidate(os.path.basename(path)):
+            return
+        try:
+            signature = file_signature(path)
+        except OSError:
+            self.settling.pop(path, None)
+            return
+        if self.handled.get(path) == signature:
+            return
+        current = self.settling.get(path)
+        if current is None or current[0] != signature:
+            self.settling[path] = (signature, time.monotonic())
+            self._wakeup.set()
+
+    def scan(self):
+        """只读目录项（不打开图片），把新出现或变化了的文件加入待稳定列表"""
+        try:
+            with os.scandir(self.folder) as it:
+                entries = [entry for entry in it if entry.is_file() and is_candidate(entry.name)]
+        except OSError as e:
+            logger.warning(f"扫描 {self.folder} 失败: {e}")
+            return
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if self.handled.get(entry.path) != signature:
+                self.touch(entry.path)
+
+    def ready_files(self):
+        """取出签名已保持 settle 秒不变的文件"""
+        now = time.monotonic()
+        ready = []
+        for path, (signature, since) in list(self.settling.items()):
+            if now - since < self.settle:
+                continue
+            try:
+                current = file_signature(path)
+            except OSError:
+                del self.settling[path]
+                continue
+            if current != signature:
+                self.settling[path] = (current, now)
+            elif current[1] > 0:
+                del self.settling[path]
+                ready.append((path, signature, since))
+        return ready
+
+    def output_path(self, job):
+        """输出文件名由源文件名和源扩展名组成（a.jpg 与 a.png 不会互相覆盖），扩展名与实际结果一致"""
+        stem, ext = os.path.splitext(os.path.basename(job.source_path))
+        return os.path.join(self.output_dir, f"{stem}_{ext.lstrip('.').lower()}{os.path.splitext(job.output_path)[1]}")
+
+    def publish(self, job):
+        """把最终结果复制到输出目录；先写临时文件再替换，下游不会读到写了一半的文件
+
+        跳过的图片结果就是源文件本身，必须复制而不是硬链接，否则下游修改输出文件会改到源文件。
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        target = self.output_path(job)
+        copy_atomic(job.output_path, target)
+        return target
+
+    async def process(self, path, signature, since):
+        async with self._slots:
+            try:
+                self.journal.image_started(ImageJob(path))
+            except OSError:  # 稳定后又被移走
+                self.handled.pop(path, None)
+                return
+            job = await process_image_job(path)
+        # 处理期间文件又被改写：按新内容重新处理，本次结果不输出
+        try:
+            changed = file_signature(path) != signature
+        except OSError:
+            changed = True
+        if changed:
+            logger.info(f"处理期间文件发生变化，稍后重新处理: {path}")
+            self.handled.pop(path, None)
+            self.touch(path)
+            return
+        if job.ok and isinstance(job.output_path, str):
+            try:
+                target = await asyncio.to_thread(self.publish, job)
+                WATCH_LATENCY_SECONDS.observe(time.monotonic() - since)
+                logger.info(f"已处理 {os.path.basename(path)} -> {target}（{time.monotonic() - since:.1f} 秒）")
+            except OSError as e:
+                job.error = f"写入输出目录失败: {e}"
+        if job.error:
+            logger.error(f"处理失败 {path}: {job.error}")
+        elif job.skip_reason:
+            logger.info(f"跳过 {os.path.basename(path)}: {job.skip_reason}")
+        self.journal.image_finished(job)
+
+    def dispatch(self, path, signature, since):
+        self.handled[path] = signature  # 等待处理期间再次扫描到也不会重复提交
+        task = asyncio.create_task(self.process(path, signature, since))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _wake_on(self, stop):
+        await stop.wait()
+        self._wakeup.set()
+
+    async def run(self, stop=None):
+        """持续监视直到 stop（asyncio.Event）被置位；已开始处理的图片会处理完再返回"""
+        os.makedirs(self.folder, exist_ok=True)
+        if os.path.dirname(self.output_dir) == self.folder:
+            logger.info(f"输出目录在监视目录内，其中的文件不会被处理: {self.output_dir}")
+        self.load_history()
+        observer = None
+        if self.use_events:
+            observer = Observer()
+            observer.schedule(_EventHandler(self, asyncio.get_running_loop()), self.folder, recursive=False)
+            observer.start()
+            rescan_interval = WATCH_RESCAN_INTERVAL
+            logger.info(f"正在监视 {self.folder}（文件事件），输出到 {self.output_dir}")
+        else:
+            rescan_interval = self.poll_interval
+            logger.info(f"正在监视 {self.folder}（每 {self.poll_interval} 秒轮询），输出到 {self.output_dir}")
+
+        # 启动时扫描一次：补上停止期间放入的图片
+        self.scan()
+        last_scan = time.monotonic()
+        stopper = asyncio.create_task(self._wake_on(stop)) if stop is not None else None
+        try:
+            while stop is None or not stop.is_set():
+                for path, signature, since in self.ready_files():
+                    self.dispatch(path, signature, since)
+                if time.monotonic() - last_scan >= rescan_interval:
+                    self.scan()
+                    last_scan = time.monotonic()
+                # 有文件等待稳定时按稳定时间的一部分频繁检查，否则等到下次扫描或新的文件事件
+                timeout = min(rescan_interval, max(0.05, self.settle / 4)) if self.settling else rescan_interval
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if stopper is not None:
+                stopper.cancel()
+            if observer is not None:
+                observer.stop()
+                await asyncio.to_thread(observer.join)
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            await close_client()
+            await close_vlm_client()
+            await asyncio.to_thread(self.journal.close)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="监视文件夹，自动处理新放入的图片")
+    parser.add_argument("folder", help="监视的图片文件夹")
+    parser.add_argument("--output", help="结果输出目录，默认读取 WATCH_OUTPUT_DIR，否则为监视目录下的 processed")
+    parser.add_argument("--settle", type=float, help=f"文件多久不变化视为写完（秒），默认 {WATCH_SETTLE_SECONDS}")
+    parser.add_argument("--concurrency", type=int, help=f"同时处理的图片数，默认 {WATCH_CONCURRENCY}")
+    parser.add_argument("--poll", action="store_true", help="不使用文件事件，始终轮询")
+    args = parser.parse_args()
+
+    output_dir = args.output or os.getenv("WATCH_OUTPUT_DIR") or os.path.join(args.folder, "processed")
+    tracing.start_metrics_server()
+    watcher = FolderWatcher(args.folder, output_dir, settle=args.settle, concurrency=args.concurrency,
+                            use_events=not args.poll)
+    try:
+        asyncio.run(watcher.run())
+    except KeyboardInterrupt:
+        pass
@@ -1,78 +1,162 @@
 import asyncio
+import collections
+import threading
+import time
 
 import gradio as gr
 import os
-from PIL import Image
-from service import sync_process_image  # 上面定义的封装函数
-
-
-# 图片处理函数（模拟调用你的流程）
-def batch_process_images(folder_path):
+from comfyui_client import tracing
+from journal import JOURNAL_NAME, Journal
+from pipeline import process_images
+from planner import scan_folder
+from thumbnails import thumbnail_page, warm as warm_thumbnail
+
+
+# 取消标志：点击“取消”后不再送入新图片，已在处理中的图片处理完后结束
+cancel_event = threading.Event()
+# 界面上保留的最近结果条数（只保存路径和文字，不保存解码后的图片）
+RECENT_ROWS = 50
+RECENT_IMAGES = 8
+RESULT_HEADERS = ["图片", "结果", "阶段", "耗时(秒)", "输出"]
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+def job_row(job):
+    if job.error:
+        outcome = f"失败: {job.error}"
+    elif job.skip_reason:
+        outcome = f"跳过: {job.skip_reason}"
+    else:
+        outcome = "成功"
+    return [os.path.basename(job.source_path), outcome, "+".join(job.stages),
+            round(sum(t for t in job.timings.values() if t), 1), job.output_path or ""]
+
+
+def progress_text(plan, finished, failed, processed, start, cancelled=False):
+    """进度、吞吐量与预计剩余时间"""
+    total = len(plan.entries)
+    elapsed = time.monotonic() - start
+    lines = [f"进度 {finished}/{total}，失败 {failed}，已用时 {format_duration(elapsed)}"]
+    if processed and elapsed > 0:
+        rate = processed / elapsed  # 只按实际处理的图片估算，跳过的图片不计入
+        remaining = total - finished
+        lines.append(f"吞吐量 {rate * 60:.1f} 张/分钟，预计剩余 {format_duration(remaining / rate)}")
+    if cancelled:
+        lines.append("正在取消：等待处理中的图片完成...")
+    return "\n".join(lines)
+
+
+# 图片处理函数：先只读文件头生成计划，再把整个文件夹交给流水线并发处理
+# 处理进度记录在文件夹内的日志中，中断后再次处理同一文件夹会从断点继续
+# 以生成器方式逐步返回进度、每张图片的结果和最近的输出图片（只传路径）
+async def batch_process_images(folder_path):
     if not os.path.exists(folder_path):
-        return "错误：路径不存在", []
-
-    image_files = [f for f in os.listdir(folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-    results = []
-
-    for img_file in image_files:
-        full_path = os.path.join(folder_path, img_file)
+        yield "错误：路径不存在", [], []
+        return
+
+    cancel_event.clear()
+    # 已符合目标尺寸的图片同样要做水印检测，不能在计划阶段跳过
+    plan = await asyncio.to_thread(scan_folder, folder_path, skip_compliant=False)
+    print(plan.summary())
+    yield plan.summary(), [], []
+
+    journal = Journal(os.path.join(folder_path, JOURNAL_NAME))
+    finished_jobs = asyncio.Queue()
+    task = asyncio.create_task(process_images(plan.entries, on_result=finished_jobs.put_nowait,
+                                              journal=journal, cancel=cancel_event))
+    start = time.monotonic()
+    finished = failed = processed = 0
+    rows = collections.deque(maxlen=RECENT_ROWS)
+    recent_images = collections.deque(maxlen=RECENT_IMAGES)  # (缩略图路径, 文件名)
+    while not task.done() or not finished_jobs.empty():
         try:
-            output_path = asyncio.run(sync_process_image(full_path))
-            original = Image.open(full_path)
-            processed = Image.open(output_path)
-            results.append((original, processed))
-        except Exception as e:
-            results.append((Image.new('RGB', (200, 200), color='red'), Image.new('RGB', (200, 200), color='red')))
-            print(f"处理失败 {img_file}: {e}")
-
-    return f"共处理 {len(results)} 张图片"
+            job = await asyncio.wait_for(finished_jobs.get(), timeout=1)
+        except asyncio.TimeoutError:
+            job = None
+        if job is None:
+            # 没有新结果时只刷新状态文字（已用时），表格和画廊保持不变
+            yield (progress_text(plan, finished, failed, processed, start, cancel_event.is_set()),
+                   gr.update(), gr.update())
+            continue
+        # 把已经结束的图片一次取完，避免每张图片都刷新一次界面
+        thumbnails = []
+        while job is not None:
+            finished += 1
+            failed += 0 if job.ok else 1
+            processed += 1 if job.timings else 0
+            rows.appendleft(job_row(job))
+            if job.ok and job.stages and isinstance(job.output_path, str):
+                future = warm_thumbnail(job.output_path)
+                if future is not None:
+                    thumbnails.append((asyncio.wrap_future(future), os.path.basename(job.output_path)))
+            job = finished_jobs.get_nowait() if not finished_jobs.empty() else None
+        # 画廊只显示缩略图，不把全分辨率的输出图片传给浏览器
+        for (_, name), thumb in zip(thumbnails, await asyncio.gather(*(future for future, _ in thumbnails))):
+            if thumb:
+                recent_images.appendleft((thumb, name))
+        yield (progress_text(plan, finished, failed, processed, start, cancel_event.is_set()),
+               list(rows), list(recent_images))
+
+    jobs = task.result()
+    failed_jobs = [job for job in jobs if not job.ok]
+    cancelled = [job for job in failed_jobs if job.error == "已取消"]
+    skipped = [job for job in jobs if job.ok and job.skip_reason]
+    for job in failed_jobs:
+        if job not in cancelled:
+            print(f"处理失败 {os.path.basename(job.source_path)}: {job.error}")
+    lines = [f"共处理 {len(jobs)} 张图片，成功 {len(jobs) - len(failed_jobs)} 张（其中跳过 {len(skipped)} 张），"
+             f"失败 {len(failed_jobs) - len(cancelled)} 张，取消 {len(cancelled)} 张，"
+             f"用时 {format_duration(time.monotonic() - start)}"]
+    lines += [f"{os.path.basename(job.source_path)}: {job.error}" for job in failed_jobs if job not in cancelled]
+    yield "\n".join(lines), list(rows), list(recent_images)
+
+
+def cancel_processing():
+    cancel_event.set()
+    return "正在取消：不再处理新图片，等待处理中的图片完成..."
+
+
+# 只扫描文件头，预估需要的阶段和 GPU 耗时，并导出计划
+def plan_images(folder_path):
+    if not os.path.exists(folder_path):
+        return "错误：路径不存在"
+    plan = scan_folder(folder_path)
+    plan_path = os.path.join(folder_path, "process_plan.csv")
+    plan.to_csv(plan_path)
+    return f"{plan.summary()}\n计划已导出: {plan_path}"
 
 
 # 获取当前脚本所在目录
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-EXTEND_IMAGE_DIR = os.path.join(ROOT_DIR, "comfyui_client", "extend_image")
-SCALE_IMAGE_DIR = os.path.join(ROOT_DIR, "comfyui_client", "scale_image")
-
+OUTPUT_ROOT = os.getenv("COMFYUI_OUTPUT_DIR", os.path.join(ROOT_DIR, "comfyui_client"))
+EXTEND_IMAGE_DIR = os.path.join(OUTPUT_ROOT, "extend_image")
+SCALE_IMAGE_DIR = os.path.join(OUTPUT_ROOT, "scale_image")
 
-# 加载 extend_image 文件夹中的图片
-def load_extend_images():
-    if not os.path.exists(EXTEND_IMAGE_DIR):
-        return []
 
-    image_files = [f for f in os.listdir(EXTEND_IMAGE_DIR) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-    images = []
-
-    for img_file in image_files:
-        full_path = os.path.join(EXTEND_IMAGE_DIR, img_file)
-        try:
-            img = Image.open(full_path)
-            images.append(img)
-        except Exception as e:
-            print(f"无法打开图片 {img_file}: {e}")
+# 分页加载输出文件夹的缩略图，原图只在点击时打开
+def load_gallery_page(directory, page):
+    items, originals, page, pages = thumbnail_page(directory, page)
+    return items, originals, page, f"第 {page}/{pages} 页"
 
-    if not images:
-        return []
-    return images
 
+def load_extend_images(page=1):
+    return load_gallery_page(EXTEND_IMAGE_DIR, page)
 
-def load_scale_images():
-    if not os.path.exists(SCALE_IMAGE_DIR):
-        return []
 
-    image_files = [f for f in os.listdir(SCALE_IMAGE_DIR) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-    images = []
+def load_scale_images(page=1):
+    return load_gallery_page(SCALE_IMAGE_DIR, page)
 
-    for img_file in image_files:
-        full_path = os.path.join(SCALE_IMAGE_DIR, img_file)
-        try:
-            img = Image.open(full_path)
-            images.append(img)
-        except Exception as e:
-            print(f"无法打开图片 {img_file}: {e}")
 
-    if not images:
-        return []
-    return images
+def show_original(originals, evt: gr.SelectData):
+    """点击缩略图时才返回原图路径"""
+    if originals and evt.index is not None and evt.index < len(originals):
+        return originals[evt.index]
+    return None
 
 
 # Gradio 界面
@@ -91,34 +175,56 @@ with gr.Blocks() as demo:
     with gr.Row():
         folder_input = gr.Textbox(label="输入图片文件夹路径", value=image_path)
 
-    process_btn = gr.Button("开始批量处理")
-
+    with gr.Row():
+        plan_btn = gr.Button("预估处理计划")
+        process_btn = gr.Button("开始批量处理")
+        cancel_btn = gr.Button("取消")
+    status_output = gr.Textbox(label="处理状态")
+    result_table = gr.Dataframe(headers=RESULT_HEADERS, label=f"最近 {RECENT_ROWS} 张图片的处理结果")
+    recent_gallery = gr.Gallery(label="最近输出的图片", columns=RECENT_IMAGES, height="auto")
+
+    plan_btn.click(
+        fn=plan_images,
+        inputs=folder_input,
+        outputs=status_output
+    )
     # 处理按钮绑定
     process_btn.click(
         fn=batch_process_images,
         inputs=folder_input,
-        outputs=gr.Textbox(label="处理状态")
+        outputs=[status_output, result_table, recent_gallery]
     )
+    # 取消不会中断处理中的图片，由流水线自然排空后结束
+    cancel_btn.click(
+        fn=cancel_processing,
+        inputs=[],
+        outputs=status_output
+    )
+    def paged_gallery(title, label, load):
+        """带翻页的缩略图画廊，点击缩略图查看原图"""
+        show_btn = gr.Button(title)
+        with gr.Row():
+            prev_btn = gr.Button("上一页")
+            page_info = gr.Markdown()
+            next_btn = gr.Button("下一页")
+        gallery = gr.Gallery(label=label, columns=8, height="auto")
+        original = gr.Image(label="原图", type="filepath")
+        page = gr.State(1)
+        originals = gr.State([])
+        outputs = [gallery, originals, page, page_info]
+
+        show_btn.click(fn=load, inputs=[page], outputs=outputs)
+        prev_btn.click(fn=lambda p: load(p - 1), inputs=[page], outputs=outputs)
+        next_btn.click(fn=lambda p: load(p + 1), inputs=[page], outputs=outputs)
+        gallery.select(fn=show_original, inputs=[originals], outputs=[original])
+
     with gr.Row():
         with gr.Column():
-            show_extend_btn = gr.Button("查看去水印并扩图后的图片")
-            extend_gallery = gr.Gallery(label="Extend Image 文件夹图片", columns=20, height="auto")
-
-            show_extend_btn.click(
-                fn=load_extend_images,
-                inputs=[],
-                outputs=[extend_gallery]
-            )
+            paged_gallery("查看去水印并扩图后的图片", "Extend Image 文件夹图片", load_extend_images)
 
         with gr.Column():
-            show_scale_btn = gr.Button("查看放大后的图片")
-            scale_gallery = gr.Gallery(label="Scale Image 文件夹图片", columns=20, height="auto")
-
-            show_scale_btn.click(
-                fn=load_scale_images,
-                inputs=[],
-                outputs=[scale_gallery]
-            )
+            paged_gallery("查看放大后的图片", "Scale Image 文件夹图片", load_scale_images)
 
-# 启动 Gradio 应用
+# 启动 Gradio 应用，Prometheus 指标在 METRICS_PORT 端口的 /metrics（默认 9108，0 关闭）
+tracing.start_metrics_server()
 demo.launch()